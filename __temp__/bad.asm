@@ -0,0 +1,3 @@
+.inc "nope.inc"
+END:
+ JP
@@ -0,0 +1,581 @@
+; Disassembled from py/test_files/countlcd.hex (ihex, HC4)
+    NP              ; 0000: E1
+    LI #0           ; 0001: A0
+    LI #15          ; 0002: AF
+    LI #0           ; 0003: A0
+    SM              ; 0004: 00
+    LI #0           ; 0005: A0
+    SA r15          ; 0006: 7F
+    LI #0           ; 0007: A0
+    SA r14          ; 0008: 7E
+    LI #15          ; 0009: AF
+    SA r13          ; 000A: 7D
+    LI #L_183:2     ; 000B: A1
+    LI #L_183:1     ; 000C: A8
+    LI #L_183:0     ; 000D: A3
+    JP              ; 000E: E0  -> L_183
+    LI #3           ; 000F: A3
+    LI #15          ; 0010: AF
+    LI #2           ; 0011: A2
+    SM              ; 0012: 00
+    LI #12          ; 0013: AC
+    SA r0           ; 0014: 70
+L_015:
+    LI #0           ; 0015: A0
+    SA r15          ; 0016: 7F
+    LI #1           ; 0017: A1
+    SA r14          ; 0018: 7E
+    LI #15          ; 0019: AF
+    SA r13          ; 001A: 7D
+    LI #L_157:2     ; 001B: A1
+    LI #L_157:1     ; 001C: A5
+    LI #L_157:0     ; 001D: A7
+    JP              ; 001E: E0  -> L_157
+    LD r0           ; 001F: 90
+    LI #1           ; 0020: A1
+    AD r0           ; 0021: 30
+    LI #L_015:2     ; 0022: A0
+    LI #L_015:1     ; 0023: A1
+    LI #L_015:0     ; 0024: A5
+    JP NC           ; 0025: E3  -> L_015
+    LI #3           ; 0026: A3
+    LI #15          ; 0027: AF
+    LI #2           ; 0028: A2
+    SM              ; 0029: 00
+    LI #0           ; 002A: A0
+    SA r15          ; 002B: 7F
+    LI #3           ; 002C: A3
+    SA r14          ; 002D: 7E
+    LI #4           ; 002E: A4
+    SA r13          ; 002F: 7D
+    LI #L_157:2     ; 0030: A1
+    LI #L_157:1     ; 0031: A5
+    LI #L_157:0     ; 0032: A7
+    JP              ; 0033: E0  -> L_157
+    LI #3           ; 0034: A3
+    LI #15          ; 0035: AF
+    LI #2           ; 0036: A2
+    SM              ; 0037: 00
+    LI #0           ; 0038: A0
+    SA r15          ; 0039: 7F
+    LI #4           ; 003A: A4
+    SA r14          ; 003B: 7E
+    LI #2           ; 003C: A2
+    SA r13          ; 003D: 7D
+    LI #L_16D:2     ; 003E: A1
+    LI #L_16D:1     ; 003F: A6
+    LI #L_16D:0     ; 0040: AD
+    JP              ; 0041: E0  -> L_16D
+    LI #2           ; 0042: A2
+    LI #15          ; 0043: AF
+    LI #2           ; 0044: A2
+    SM              ; 0045: 00
+    LI #8           ; 0046: A8
+    LI #15          ; 0047: AF
+    LI #2           ; 0048: A2
+    SM              ; 0049: 00
+    LI #0           ; 004A: A0
+    SA r15          ; 004B: 7F
+    LI #5           ; 004C: A5
+    SA r14          ; 004D: 7E
+    LI #4           ; 004E: A4
+    SA r13          ; 004F: 7D
+    LI #L_16D:2     ; 0050: A1
+    LI #L_16D:1     ; 0051: A6
+    LI #L_16D:0     ; 0052: AD
+    JP              ; 0053: E0  -> L_16D
+    LI #0           ; 0054: A0
+    LI #15          ; 0055: AF
+    LI #2           ; 0056: A2
+    SM              ; 0057: 00
+    LI #8           ; 0058: A8
+    LI #15          ; 0059: AF
+    LI #2           ; 005A: A2
+    SM              ; 005B: 00
+    LI #0           ; 005C: A0
+    SA r15          ; 005D: 7F
+    LI #6           ; 005E: A6
+    SA r14          ; 005F: 7E
+    LI #6           ; 0060: A6
+    SA r13          ; 0061: 7D
+    LI #L_16D:2     ; 0062: A1
+    LI #L_16D:1     ; 0063: A6
+    LI #L_16D:0     ; 0064: AD
+    JP              ; 0065: E0  -> L_16D
+    LI #0           ; 0066: A0
+    LI #15          ; 0067: AF
+    LI #2           ; 0068: A2
+    SM              ; 0069: 00
+    LI #1           ; 006A: A1
+    LI #15          ; 006B: AF
+    LI #2           ; 006C: A2
+    SM              ; 006D: 00
+    LI #14          ; 006E: AE
+    SA r0           ; 006F: 70
+L_070:
+    LI #0           ; 0070: A0
+    SA r15          ; 0071: 7F
+    LI #7           ; 0072: A7
+    SA r14          ; 0073: 7E
+    LI #10          ; 0074: AA
+    SA r13          ; 0075: 7D
+    LI #L_157:2     ; 0076: A1
+    LI #L_157:1     ; 0077: A5
+    LI #L_157:0     ; 0078: A7
+    JP              ; 0079: E0  -> L_157
+    LD r0           ; 007A: 90
+    LI #1           ; 007B: A1
+    AD r0           ; 007C: 30
+    LI #L_070:2     ; 007D: A0
+    LI #L_070:1     ; 007E: A7
+    LI #L_070:0     ; 007F: A0
+    JP NC           ; 0080: E3  -> L_070
+    LI #0           ; 0081: A0
+    LI #15          ; 0082: AF
+    LI #2           ; 0083: A2
+    SM              ; 0084: 00
+    LI #6           ; 0085: A6
+    LI #15          ; 0086: AF
+    LI #2           ; 0087: A2
+    SM              ; 0088: 00
+    LI #0           ; 0089: A0
+    SA r15          ; 008A: 7F
+    LI #9           ; 008B: A9
+    SA r14          ; 008C: 7E
+    LI #3           ; 008D: A3
+    SA r13          ; 008E: 7D
+    LI #L_16D:2     ; 008F: A1
+    LI #L_16D:1     ; 0090: A6
+    LI #L_16D:0     ; 0091: AD
+    JP              ; 0092: E0  -> L_16D
+    LI #0           ; 0093: A0
+    LI #15          ; 0094: AF
+    LI #2           ; 0095: A2
+    SM              ; 0096: 00
+    LI #12          ; 0097: AC
+    LI #15          ; 0098: AF
+    LI #2           ; 0099: A2
+    SM              ; 009A: 00
+    LI #0           ; 009B: A0
+    SA r15          ; 009C: 7F
+    LI #10          ; 009D: AA
+    SA r14          ; 009E: 7E
+    LI #5           ; 009F: A5
+    SA r13          ; 00A0: 7D
+    LI #L_16D:2     ; 00A1: A1
+    LI #L_16D:1     ; 00A2: A6
+    LI #L_16D:0     ; 00A3: AD
+    JP              ; 00A4: E0  -> L_16D
+    LI #0           ; 00A5: A0
+    SA r4           ; 00A6: 74
+    LI #0           ; 00A7: A0
+    SA r5           ; 00A8: 75
+    LI #0           ; 00A9: A0
+    SA r6           ; 00AA: 76
+    LI #0           ; 00AB: A0
+    SA r7           ; 00AC: 77
+    LI #L_1C5:2     ; 00AD: A1
+    LI #L_1C5:1     ; 00AE: AC
+    LI #L_1C5:0     ; 00AF: A5
+    JP              ; 00B0: E0  -> L_1C5
+L_0B1:
+    LI #12          ; 00B1: AC
+    LI #15          ; 00B2: AF
+    LI #2           ; 00B3: A2
+    SM              ; 00B4: 00
+    LI #0           ; 00B5: A0
+    LI #15          ; 00B6: AF
+    LI #2           ; 00B7: A2
+    SM              ; 00B8: 00
+    LI #0           ; 00B9: A0
+    SA r15          ; 00BA: 7F
+    LI #12          ; 00BB: AC
+    SA r14          ; 00BC: 7E
+    LI #3           ; 00BD: A3
+    SA r13          ; 00BE: 7D
+    LI #L_16D:2     ; 00BF: A1
+    LI #L_16D:1     ; 00C0: A6
+    LI #L_16D:0     ; 00C1: AD
+    JP              ; 00C2: E0  -> L_16D
+    LI #3           ; 00C3: A3
+    LI #15          ; 00C4: AF
+    LI #3           ; 00C5: A3
+    SM              ; 00C6: 00
+    LD r7           ; 00C7: 97
+    LI #15          ; 00C8: AF
+    LI #3           ; 00C9: A3
+    SM              ; 00CA: 00
+    LI #0           ; 00CB: A0
+    SA r15          ; 00CC: 7F
+    LI #13          ; 00CD: AD
+    SA r14          ; 00CE: 7E
+    LI #5           ; 00CF: A5
+    SA r13          ; 00D0: 7D
+    LI #L_16D:2     ; 00D1: A1
+    LI #L_16D:1     ; 00D2: A6
+    LI #L_16D:0     ; 00D3: AD
+    JP              ; 00D4: E0  -> L_16D
+    LI #3           ; 00D5: A3
+    LI #15          ; 00D6: AF
+    LI #3           ; 00D7: A3
+    SM              ; 00D8: 00
+    LD r6           ; 00D9: 96
+    LI #15          ; 00DA: AF
+    LI #3           ; 00DB: A3
+    SM              ; 00DC: 00
+    LI #0           ; 00DD: A0
+    SA r15          ; 00DE: 7F
+    LI #14          ; 00DF: AE
+    SA r14          ; 00E0: 7E
+    LI #7           ; 00E1: A7
+    SA r13          ; 00E2: 7D
+    LI #L_16D:2     ; 00E3: A1
+    LI #L_16D:1     ; 00E4: A6
+    LI #L_16D:0     ; 00E5: AD
+    JP              ; 00E6: E0  -> L_16D
+    LI #3           ; 00E7: A3
+    LI #15          ; 00E8: AF
+    LI #3           ; 00E9: A3
+    SM              ; 00EA: 00
+    LD r5           ; 00EB: 95
+    LI #15          ; 00EC: AF
+    LI #3           ; 00ED: A3
+    SM              ; 00EE: 00
+    LI #0           ; 00EF: A0
+    SA r15          ; 00F0: 7F
+    LI #15          ; 00F1: AF
+    SA r14          ; 00F2: 7E
+    LI #9           ; 00F3: A9
+    SA r13          ; 00F4: 7D
+    LI #L_16D:2     ; 00F5: A1
+    LI #L_16D:1     ; 00F6: A6
+    LI #L_16D:0     ; 00F7: AD
+    JP              ; 00F8: E0  -> L_16D
+    LI #3           ; 00F9: A3
+    LI #15          ; 00FA: AF
+    LI #3           ; 00FB: A3
+    SM              ; 00FC: 00
+    LD r4           ; 00FD: 94
+    LI #15          ; 00FE: AF
+    LI #3           ; 00FF: A3
+    SM              ; 0100: 00
+    LI #0           ; 0101: A0
+    LI #15          ; 0102: AF
+    LI #0           ; 0103: A0
+    SM              ; 0104: 00
+L_105:
+    LI #15          ; 0105: AF
+    LI #0           ; 0106: A0
+    LM              ; 0107: 80
+    SA r15          ; 0108: 7F
+    LI #L_105:2     ; 0109: A1
+    LI #L_105:1     ; 010A: A0
+    LI #L_105:0     ; 010B: A5
+    JP NZ           ; 010C: E5  -> L_105
+L_10D:
+    LI #15          ; 010D: AF
+    LI #0           ; 010E: A0
+    LM              ; 010F: 80
+    SA r15          ; 0110: 7F
+    LI #L_10D:2     ; 0111: A1
+    LI #L_10D:1     ; 0112: A0
+    LI #L_10D:0     ; 0113: AD
+    JP Z            ; 0114: E4  -> L_10D
+    LI #1           ; 0115: A1
+    LD r4           ; 0116: 94
+    AD r4           ; 0117: 34
+    LI #6           ; 0118: A6
+    LD r4           ; 0119: 94
+    AD r15          ; 011A: 3F
+    LI #L_0B1:2     ; 011B: A0
+    LI #L_0B1:1     ; 011C: AB
+    LI #L_0B1:0     ; 011D: A1
+    JP NC           ; 011E: E3  -> L_0B1
+    LI #0           ; 011F: A0
+    SA r4           ; 0120: 74
+    LI #1           ; 0121: A1
+    LD r5           ; 0122: 95
+    AD r5           ; 0123: 35
+    LI #6           ; 0124: A6
+    LD r5           ; 0125: 95
+    AD r15          ; 0126: 3F
+    LI #L_0B1:2     ; 0127: A0
+    LI #L_0B1:1     ; 0128: AB
+    LI #L_0B1:0     ; 0129: A1
+    JP NC           ; 012A: E3  -> L_0B1
+    LI #0           ; 012B: A0
+    SA r5           ; 012C: 75
+    LI #1           ; 012D: A1
+    LD r6           ; 012E: 96
+    AD r6           ; 012F: 36
+    LI #6           ; 0130: A6
+    LD r6           ; 0131: 96
+    AD r15          ; 0132: 3F
+    LI #L_0B1:2     ; 0133: A0
+    LI #L_0B1:1     ; 0134: AB
+    LI #L_0B1:0     ; 0135: A1
+    JP NC           ; 0136: E3  -> L_0B1
+    LI #0           ; 0137: A0
+    SA r6           ; 0138: 76
+    LI #1           ; 0139: A1
+    LD r7           ; 013A: 97
+    AD r7           ; 013B: 37
+    LI #6           ; 013C: A6
+    LD r7           ; 013D: 97
+    AD r15          ; 013E: 3F
+    LI #L_0B1:2     ; 013F: A0
+    LI #L_0B1:1     ; 0140: AB
+    LI #L_0B1:0     ; 0141: A1
+    JP NC           ; 0142: E3  -> L_0B1
+    LI #0           ; 0143: A0
+    SA r7           ; 0144: 77
+    LI #5           ; 0145: A5
+    LI #15          ; 0146: AF
+    LI #0           ; 0147: A0
+    SM              ; 0148: 00
+    LI #1           ; 0149: A1
+    SA r15          ; 014A: 7F
+    LI #5           ; 014B: A5
+    SA r14          ; 014C: 7E
+    LI #3           ; 014D: A3
+    SA r13          ; 014E: 7D
+    LI #L_183:2     ; 014F: A1
+    LI #L_183:1     ; 0150: A8
+    LI #L_183:0     ; 0151: A3
+    JP              ; 0152: E0  -> L_183
+    LI #L_0B1:2     ; 0153: A0
+    LI #L_0B1:1     ; 0154: AB
+    LI #L_0B1:0     ; 0155: A1
+    JP              ; 0156: E0  -> L_0B1
+L_157:
+    LI #5           ; 0157: A5
+    SA r9           ; 0158: 79
+L_159:
+    LI #4           ; 0159: A4
+    SA r8           ; 015A: 78
+L_15B:
+    LD r8           ; 015B: 98
+    LI #1           ; 015C: A1
+    AD r8           ; 015D: 38
+    LI #L_15B:2     ; 015E: A1
+    LI #L_15B:1     ; 015F: A5
+    LI #L_15B:0     ; 0160: AB
+    JP NC           ; 0161: E3  -> L_15B
+    LD r9           ; 0162: 99
+    LI #1           ; 0163: A1
+    AD r9           ; 0164: 39
+    LI #L_159:2     ; 0165: A1
+    LI #L_159:1     ; 0166: A5
+    LI #L_159:0     ; 0167: A9
+    JP NC           ; 0168: E3  -> L_159
+    LD r15          ; 0169: 9F
+    LD r14          ; 016A: 9E
+    LD r13          ; 016B: 9D
+    JP              ; 016C: E0
+L_16D:
+    LI #3           ; 016D: A3
+    SA r9           ; 016E: 79
+L_16F:
+    LI #13          ; 016F: AD
+    SA r8           ; 0170: 78
+L_171:
+    LD r8           ; 0171: 98
+    LI #1           ; 0172: A1
+    AD r8           ; 0173: 38
+    LI #L_171:2     ; 0174: A1
+    LI #L_171:1     ; 0175: A7
+    LI #L_171:0     ; 0176: A1
+    JP NC           ; 0177: E3  -> L_171
+    LD r9           ; 0178: 99
+    LI #1           ; 0179: A1
+    AD r9           ; 017A: 39
+    LI #L_16F:2     ; 017B: A1
+    LI #L_16F:1     ; 017C: A6
+    LI #L_16F:0     ; 017D: AF
+    JP NC           ; 017E: E3  -> L_16F
+    LD r15          ; 017F: 9F
+    LD r14          ; 0180: 9E
+    LD r13          ; 0181: 9D
+    JP              ; 0182: E0
+L_183:
+    LD r15          ; 0183: 9F
+    LI #1           ; 0184: A1
+    LI #15          ; 0185: AF
+    SM              ; 0186: 00
+    LD r14          ; 0187: 9E
+    LI #1           ; 0188: A1
+    LI #14          ; 0189: AE
+    SM              ; 018A: 00
+    LD r13          ; 018B: 9D
+    LI #1           ; 018C: A1
+    LI #13          ; 018D: AD
+    SM              ; 018E: 00
+    LI #2           ; 018F: A2
+    SA r9           ; 0190: 79
+L_191:
+    LI #9           ; 0191: A9
+    SA r8           ; 0192: 78
+    LD r9           ; 0193: 99
+    LI #1           ; 0194: A1
+    LI #9           ; 0195: A9
+    SM              ; 0196: 00
+L_197:
+    LD r8           ; 0197: 98
+    LI #1           ; 0198: A1
+    LI #8           ; 0199: A8
+    SM              ; 019A: 00
+    LI #1           ; 019B: A1
+    SA r15          ; 019C: 7F
+    LI #10          ; 019D: AA
+    SA r14          ; 019E: 7E
+    LI #5           ; 019F: A5
+    SA r13          ; 01A0: 7D
+    LI #L_157:2     ; 01A1: A1
+    LI #L_157:1     ; 01A2: A5
+    LI #L_157:0     ; 01A3: A7
+    JP              ; 01A4: E0  -> L_157
+    LI #1           ; 01A5: A1
+    LI #8           ; 01A6: A8
+    LM              ; 01A7: 80
+    LI #1           ; 01A8: A1
+    AD r8           ; 01A9: 38
+    LI #L_197:2     ; 01AA: A1
+    LI #L_197:1     ; 01AB: A9
+    LI #L_197:0     ; 01AC: A7
+    JP NC           ; 01AD: E3  -> L_197
+    LI #1           ; 01AE: A1
+    LI #9           ; 01AF: A9
+    LM              ; 01B0: 80
+    LI #1           ; 01B1: A1
+    AD r9           ; 01B2: 39
+    LI #L_191:2     ; 01B3: A1
+    LI #L_191:1     ; 01B4: A9
+    LI #L_191:0     ; 01B5: A1
+    JP NC           ; 01B6: E3  -> L_191
+    LI #1           ; 01B7: A1
+    LI #13          ; 01B8: AD
+    LM              ; 01B9: 80
+    SA r13          ; 01BA: 7D
+    LI #1           ; 01BB: A1
+    LI #14          ; 01BC: AE
+    LM              ; 01BD: 80
+    SA r14          ; 01BE: 7E
+    LI #1           ; 01BF: A1
+    LI #15          ; 01C0: AF
+    LM              ; 01C1: 80
+    LD r14          ; 01C2: 9E
+    LD r13          ; 01C3: 9D
+    JP              ; 01C4: E0
+L_1C5:
+    LI #4           ; 01C5: A4
+    LI #15          ; 01C6: AF
+    LI #3           ; 01C7: A3
+    SM              ; 01C8: 00
+    LI #8           ; 01C9: A8
+    LI #15          ; 01CA: AF
+    LI #3           ; 01CB: A3
+    SM              ; 01CC: 00
+    LI #1           ; 01CD: A1
+    SA r15          ; 01CE: 7F
+    LI #13          ; 01CF: AD
+    SA r14          ; 01D0: 7E
+    LI #7           ; 01D1: A7
+    SA r13          ; 01D2: 7D
+    LI #L_16D:2     ; 01D3: A1
+    LI #L_16D:1     ; 01D4: A6
+    LI #L_16D:0     ; 01D5: AD
+    JP              ; 01D6: E0  -> L_16D
+    LI #6           ; 01D7: A6
+    LI #15          ; 01D8: AF
+    LI #3           ; 01D9: A3
+    SM              ; 01DA: 00
+    LI #5           ; 01DB: A5
+    LI #15          ; 01DC: AF
+    LI #3           ; 01DD: A3
+    SM              ; 01DE: 00
+    LI #1           ; 01DF: A1
+    SA r15          ; 01E0: 7F
+    LI #14          ; 01E1: AE
+    SA r14          ; 01E2: 7E
+    LI #9           ; 01E3: A9
+    SA r13          ; 01E4: 7D
+    LI #L_16D:2     ; 01E5: A1
+    LI #L_16D:1     ; 01E6: A6
+    LI #L_16D:0     ; 01E7: AD
+    JP              ; 01E8: E0  -> L_16D
+    LI #6           ; 01E9: A6
+    LI #15          ; 01EA: AF
+    LI #3           ; 01EB: A3
+    SM              ; 01EC: 00
+    LI #12          ; 01ED: AC
+    LI #15          ; 01EE: AF
+    LI #3           ; 01EF: A3
+    SM              ; 01F0: 00
+    LI #1           ; 01F1: A1
+    SA r15          ; 01F2: 7F
+    LI #15          ; 01F3: AF
+    SA r14          ; 01F4: 7E
+    LI #11          ; 01F5: AB
+    SA r13          ; 01F6: 7D
+    LI #L_16D:2     ; 01F7: A1
+    LI #L_16D:1     ; 01F8: A6
+    LI #L_16D:0     ; 01F9: AD
+    JP              ; 01FA: E0  -> L_16D
+    LI #6           ; 01FB: A6
+    LI #15          ; 01FC: AF
+    LI #3           ; 01FD: A3
+    SM              ; 01FE: 00
+    LI #12          ; 01FF: AC
+    LI #15          ; 0200: AF
+    LI #3           ; 0201: A3
+    SM              ; 0202: 00
+    LI #2           ; 0203: A2
+    SA r15          ; 0204: 7F
+    LI #0           ; 0205: A0
+    SA r14          ; 0206: 7E
+    LI #13          ; 0207: AD
+    SA r13          ; 0208: 7D
+    LI #L_16D:2     ; 0209: A1
+    LI #L_16D:1     ; 020A: A6
+    LI #L_16D:0     ; 020B: AD
+    JP              ; 020C: E0  -> L_16D
+    LI #6           ; 020D: A6
+    LI #15          ; 020E: AF
+    LI #3           ; 020F: A3
+    SM              ; 0210: 00
+    LI #15          ; 0211: AF
+    LI #15          ; 0212: AF
+    LI #3           ; 0213: A3
+    SM              ; 0214: 00
+    LI #2           ; 0215: A2
+    SA r15          ; 0216: 7F
+    LI #1           ; 0217: A1
+    SA r14          ; 0218: 7E
+    LI #15          ; 0219: AF
+    SA r13          ; 021A: 7D
+    LI #L_16D:2     ; 021B: A1
+    LI #L_16D:1     ; 021C: A6
+    LI #L_16D:0     ; 021D: AD
+    JP              ; 021E: E0  -> L_16D
+    LI #2           ; 021F: A2
+    LI #15          ; 0220: AF
+    LI #3           ; 0221: A3
+    SM              ; 0222: 00
+    LI #1           ; 0223: A1
+    LI #15          ; 0224: AF
+    LI #3           ; 0225: A3
+    SM              ; 0226: 00
+    LI #2           ; 0227: A2
+    SA r15          ; 0228: 7F
+    LI #3           ; 0229: A3
+    SA r14          ; 022A: 7E
+    LI #1           ; 022B: A1
+    SA r13          ; 022C: 7D
+    LI #L_16D:2     ; 022D: A1
+    LI #L_16D:1     ; 022E: A6
+    LI #L_16D:0     ; 022F: AD
+    JP              ; 0230: E0  -> L_16D
+    LI #L_0B1:2     ; 0231: A0
+    LI #L_0B1:1     ; 0232: AB
+    LI #L_0B1:0     ; 0233: A1
+    JP              ; 0234: E0  -> L_0B1
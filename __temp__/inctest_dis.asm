@@ -0,0 +1,19 @@
+; Disassembled from py/test_files/inctest.hex (vhex, HC4E)
+L_00:
+    LD r1           ; 0000: 91
+    LD r2           ; 0001: 92
+    AD r0           ; 0002: 30
+    LI #10          ; 0003: AA
+    SA r3           ; 0004: 73
+    LD r3           ; 0005: 93
+    SA r14          ; 0006: 7E
+    LI #L_00:1      ; 0007: A0
+    LI #L_00:0      ; 0008: A0
+    JP              ; 0009: E0  -> L_00
+    LI #L_0D:1      ; 000A: A0
+    LI #L_0D:0      ; 000B: AD
+    JP C            ; 000C: E2  -> L_0D
+L_0D:
+    LI #L_0D:1      ; 000D: A0
+    LI #L_0D:0      ; 000E: AD
+    JP              ; 000F: E0  -> L_0D
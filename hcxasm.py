@@ -4,25 +4,47 @@ HCX アセンブラ - .asmファイルをアセンブルして機械語コード
 
 使用方法:
     python hcxasm.py input.asm [-o output.bin] [-a architecture] [-f format]
+    python hcxasm.py a.asm b.asm ... [-j N] [-o output_dir]
 
 引数:
-    input.asm           : 入力アセンブリファイル
+    input.asm           : 入力アセンブリファイル (複数指定でバッチアセンブル)
+    -m, --manifest      : 入力ファイル一覧 (1行1ファイル, "ファイル [アーキテクチャ]", #以降はコメント)
+    -j, --jobs          : バッチアセンブルの並列プロセス数 (0: CPU数, デフォルト: 1)
+    --cache-dir         : ビルドキャッシュのディレクトリ (指定時のみキャッシュを使用)
     -o, --output        : 出力ファイル名 (デフォルト: input.bin)
     -a, --architecture  : アーキテクチャ (HC4 または HC4E, デフォルト: HC4)
     -f, --format        : 出力形式 (binary, hex, text, デフォルト: binary)
-    -v, --verbose       : 詳細出力
+                          カンマ区切りまたは複数回指定で一度に複数形式を出力
+    -O, --optimize      : 覗き穴最適化 (冗長なロード・JP後の到達不能コード・定数演算を削除)
+    -v, --verbose       : 詳細出力 (-O では行ごとの削減量も表示)
+    --diagnostics       : エラーで止まらず全エラーを報告 (text または json)
+    --stats, --timings  : 各段階の所要時間とカウンタを報告 (text または json)
+    --profile           : cProfile の結果をファイルに保存
+    --clock             : リストファイルに静的なサイクル数とループ時間を注記 (クロック周波数 Hz)
+    --serve             : 常駐モード (標準入出力で1行1JSONのリクエストを処理)
     -h, --help          : ヘルプ表示
 """
 
 import argparse
 import sys
 import os
-from typing import Optional, Sequence
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Protocol, Sequence, TextIO
 from pathlib import Path
 import re
+import io
+import json
+import base64
+import cProfile
+import tracemalloc
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
 import assembler
+import buildcache
+import incremental
+import optimizer
+import timing
 
 def parse_arguments():
     """コマンドライン引数の解析"""
@@ -41,14 +63,28 @@ Examples:
     python hcxasm.py program.asm -o output.bin
     python hcxasm.py program.asm -a HC4E -f ihex
     python hcxasm.py program.asm -o program.hex -f ihex -v
+    python hcxasm.py program.asm -f binary,ihex,list
+    python hcxasm.py lcd.asm dice4e.asm test.asm -j 4 -f ihex -o build/
+    python hcxasm.py -m programs.txt -j 0
         """
     )
     
-    parser.add_argument('input_file', 
-                        help='Input assembly file (.asm)')
+    parser.add_argument('input_files', 
+                        nargs='*',
+                        metavar='input_file',
+                        help='Input assembly file (.asm). Several files are assembled as a batch')
+    
+    parser.add_argument('-m', '--manifest',
+                        help='File listing input files, one per line as "file [architecture]" (# starts a comment)')
+    
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes for batch assembly (0: number of CPUs, default: 1)')
     
     parser.add_argument('-o', '--output',
-                        help='Output file name (default: input file name with .bin extension)')
+                        help='Output file name (default: input file name with .bin extension). '
+                             'Output directory for batch assembly')
     
     parser.add_argument('-a', '--architecture',
                         choices=['HC4', 'HC4E'],
@@ -56,9 +92,15 @@ Examples:
                         help='Target architecture (default: HC4)')
     
     parser.add_argument('-f', '--format',
-                        choices=['binary', 'hex', 'ihex', 'vhex', 'text', 'list'],
-                        default='binary',
-                        help='Output format (default: binary)')
+                        action='append',
+                        type=parse_formats,
+                        help='Output format (default: binary). Several formats can be given '
+                             'comma separated or by repeating -f; the source is assembled once.')
+    
+    parser.add_argument('-O', '--optimize',
+                        action='store_true',
+                        help='Remove redundant loads and unreachable code and fold constant operations '
+                             '(with -v, report the bytes and cycles saved per source line)')
     
     parser.add_argument('-v', '--verbose',
                         action='store_true',
@@ -73,7 +115,94 @@ Examples:
                         default=[],
                         help='Additional include path for .INCLUDE directives')
     
-    return parser.parse_args()
+    parser.add_argument('--cache-dir',
+                        help='Reuse results of unchanged sources from this build cache directory')
+    
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=64,
+                        help='Maximum size of the build cache in MiB (default: 64)')
+    
+    parser.add_argument('--diagnostics',
+                        choices=['text', 'json'],
+                        help='Keep going after errors and report all of them, as text on stderr or as JSON on stdout')
+    
+    parser.add_argument('--stats', '--timings',
+                        nargs='?',
+                        const='text',
+                        choices=['text', 'json'],
+                        help='Report the time spent in each stage, counters and peak memory (tracemalloc, '
+                             'which slows the run down), as text or as JSON on stdout (default: text; '
+                             'with --diagnostics json, the JSON report is its "stats" member). One input file only')
+    
+    parser.add_argument('--profile',
+                        metavar='FILE',
+                        help='Run under cProfile and save the profile to FILE (read it with pstats)')
+    
+    parser.add_argument('--clock',
+                        type=float,
+                        metavar='HZ',
+                        help='Annotate list output with static cycle counts and loop timing at this clock frequency')
+    
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='Stay resident and assemble line-delimited JSON requests from stdin')
+    
+    args = parser.parse_args()
+    # input file -> architecture given in the manifest
+    args.architectures = {}
+    if args.manifest:
+        try:
+            for input_file, arch in read_manifest(args.manifest):
+                args.input_files.append(input_file)
+                if arch is not None:
+                    args.architectures[input_file] = arch
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot read manifest '{args.manifest}': {e}")
+    if not args.input_files and not args.serve:
+        parser.error('the following arguments are required: input_file')
+    if args.stats and len(args.input_files) > 1:
+        parser.error('--stats reports on one input file; run the files one by one (or use hcxbench.py)')
+    args.input_file = args.input_files[0] if args.input_files else None
+    # flatten [['binary', 'ihex'], ['list']] and drop duplicates
+    args.formats = list(dict.fromkeys(f for group in (args.format or [['binary']]) for f in group))
+    args.format = args.formats[0]
+    # formats with the same extension (hex, ihex, vhex) would overwrite each other's file
+    extensions = [Path(determine_output_filename('x', '', f)).suffix for f in args.formats]
+    if len(set(extensions)) != len(extensions):
+        parser.error(f"output formats {', '.join(args.formats)} would write to the same file; write them separately")
+    return args
+
+
+FORMATS = ['binary', 'hex', 'ihex', 'vhex', 'text', 'list']
+
+def parse_formats(value:str) -> list[str]:
+    """-f の値をカンマで分割して検証"""
+    formats = [f.strip() for f in value.split(',') if f.strip()]
+    for f in formats:
+        if f not in FORMATS:
+            raise argparse.ArgumentTypeError(f"invalid choice: '{f}' (choose from {', '.join(FORMATS)})")
+    return formats
+
+
+def read_manifest(filename:str) -> list[tuple[str, Optional[str]]]:
+    """
+    マニフェスト(1行1ファイル)を読み込む。相対パスはマニフェストの場所から解決する
+    Returns:
+        list[tuple[str, Optional[str]]]: (input file, architecture or None)
+    """
+    base = Path(filename).parent
+    inputs: list[tuple[str, Optional[str]]] = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        for lineno, line in enumerate(f, start=1):
+            tok = line.split('#', 1)[0].split()
+            if not tok:
+                continue
+            arch = tok[1].upper() if len(tok) > 1 else None
+            if arch is not None and arch not in assembler.INST_DICT_M:
+                raise ValueError(f"unsupported architecture '{tok[1]}' in line {lineno}")
+            inputs.append((str(base / tok[0]), arch))
+    return inputs
 
 
 def read_asm_file(filename:str):
@@ -92,183 +221,572 @@ def read_asm_file(filename:str):
         print(f"[Error]: An error occurred while reading the file '{filename}': {e}", file=sys.stderr)
         sys.exit(1)
 
-def write_binary_output(filename:str, machine_code:list[int]):
+def write_binary_output(filename:str, machine_code:memoryview):
     """バイナリ形式で出力"""
     try:
         with open(filename, 'wb') as f:
-            f.write(bytes(machine_code))
+            f.write(machine_code)
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the binary file '{filename}': {e}", file=sys.stderr)
         return False
     
-def write_verilog_hex_output(filename:str, machine_code:list[int]):
+def write_verilog_hex(f:TextIO, machine_code:memoryview):
+    """verilogのHEX形式をストリームに書き込む"""
+    if len(machine_code):
+        f.write(machine_code.hex("\n").upper() + "\n")
+
+def write_verilog_hex_output(filename:str, machine_code:memoryview):
     """verilogのHEX形式で出力"""
     try:
         with open(filename, 'w', encoding='utf-8') as f:
-            for i in machine_code:
-                f.write(f"{i:02X}\n")
+            write_verilog_hex(f, machine_code)
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the HEX file '{filename}': {e}", file=sys.stderr)
         return False
 
 
-def write_intel_hex_output(filename:str, machine_code:list[int]):
+def write_intel_hex(f:TextIO, machine_code:memoryview):
+    """Intel HEX形式をストリームに書き込む"""
+    # Intel HEX形式のヘッダー
+    address = 0
+    for i in range(0, len(machine_code), 16):
+        chunk = machine_code[i:i+16]
+        data_len = len(chunk)
+        
+        # チェックサムの計算
+        checksum = data_len + (address >> 8) + (address & 0xFF) + sum(chunk)
+        checksum = (~checksum + 1) & 0xFF
+        
+        # Intel HEX行の生成
+        f.write(f":{data_len:02X}{address:04X}00{chunk.hex().upper()}{checksum:02X}\n")
+        address += data_len
+    
+    # EOF レコード
+    f.write(":00000001FF\n")
+
+def write_intel_hex_output(filename:str, machine_code:memoryview):
     """Intel HEX形式で出力"""
     try:
         with open(filename, 'w', encoding='utf-8') as f:
-            # Intel HEX形式のヘッダー
-            address = 0
-            for i in range(0, len(machine_code), 16):
-                chunk = machine_code[i:i+16]
-                data_len = len(chunk)
-                
-                # チェックサムの計算
-                checksum = data_len + (address >> 8) + (address & 0xFF)
-                for byte_val in chunk:
-                    checksum += byte_val
-                checksum = (~checksum + 1) & 0xFF
-                
-                # Intel HEX行の生成
-                hex_line = f":{data_len:02X}{address:04X}00"
-                for byte_val in chunk:
-                    hex_line += f"{byte_val:02X}"
-                hex_line += f"{checksum:02X}"
-                
-                f.write(hex_line + '\n')
-                address += data_len
-            
-            # EOF レコード
-            f.write(":00000001FF\n")
+            write_intel_hex(f, machine_code)
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the HEX file '{filename}': {e}", file=sys.stderr)
         return False
 
 
-def write_list_output(filename:str, lines:Sequence[tuple[str, int, str, int]], adr_list: dict[int, tuple[int, int]], ls:assembler.LinkState):
+class ListAnnotations(Protocol):
+    """Notes for a list file: timing.Analysis (static timing) or profiler.Profile (measured hotspots)"""
+    def report(self) -> list[str]: ...
+    def annotations(self) -> dict[int, str]: ...
+
+def write_list(f:TextIO, lines:Sequence[tuple[str, int, str, int]], adr_list:assembler.ProgramImage, ls:assembler.LinkState, analysis:Optional[ListAnnotations]=None):
+    """Write the list file contents to a text stream (see write_list_output)."""
+    f.write("HCX Assemble Results\n")
+    f.write("=" * 50 + "\n\n")
+    
+    f.write("Labels and Symbols:\n")
+    for label, address in ls.labels.items():
+        f.write(f"{label}: {address:04X}\n")
+    
+    notes = {}
+    if analysis is not None:
+        f.write("\n")
+        for line in analysis.report():
+            f.write(line + "\n")
+        f.write("\n")
+        notes = analysis.annotations()
+    
+    # Machine code and source code correspondence table
+    f.write("line  address  machine code  source code\n")
+    f.write("-" * 50 + "\n")
+    
+    for source_line, line_num, unprocessed_line, address_src in lines:
+        if address_src in adr_list and adr_list[address_src][1] == line_num and unprocessed_line and unprocessed_line.strip().split()[0].upper() in assembler.INST_TYPES:
+            byte_val, _ = adr_list[address_src]
+            note = notes.pop(address_src, None)
+            if note is not None:
+                f.write(f"{line_num:4d}  {address_src:04X}     {byte_val:02X}            {unprocessed_line}  ; {note}\n")
+            else:
+                f.write(f"{line_num:4d}  {address_src:04X}     {byte_val:02X}            {unprocessed_line}\n")
+        else:
+            f.write(f"{line_num:4d}  {address_src:04X}                   {unprocessed_line}\n")
+
+    bitstream = assembler.adrlist2bitstream(adr_list, 255)
+
+    f.write("\n" + "-" * 50 + "\n")
+    f.write(f"Generated machine code: {len(bitstream)} bytes\n\n")
+    
+    # Hex dump
+    f.write("Hex dump:\n")
+    for i in range(0, len(bitstream), 16):
+        hex_str = bitstream[i:i+16].hex(" ").upper()
+        f.write(f"{i:04X}: {hex_str:<47}\n")
+
+def write_list_output(filename:str, lines:Sequence[tuple[str, int, str, int]], adr_list:assembler.ProgramImage, ls:assembler.LinkState, analysis:Optional[ListAnnotations]=None):
     """
     Write output in text format with machine code and source code correspondence.
     Args:
         filename (str): Output text file name.
         lines (Sequence[tuple[str, int, str]]): List of tuple(line:str, lineno:int, unprocessed_line:str).
-        adr_list (dict[int, tuple[int, int]]): Dictionary mapping addresses to tuples of machine code and line numbers.
+        adr_list (assembler.ProgramImage): Program image mapping addresses to tuples of machine code and line numbers.
         ls (assembler.LinkState): Link state containing label information.
+        analysis (ListAnnotations): If given, a timing.Analysis annotates cycle counts and loop
+            timing, a profiler.Profile measured hotspots.
     Returns:
         bool: True if writing is successful, False otherwise.
     """
     try:
         with open(filename, 'w', encoding='utf-8') as f:
-            f.write("HCX Assemble Results\n")
-            f.write("=" * 50 + "\n\n")
-            
-            f.write("Labels and Symbols:\n")
-            for label, address in ls.labels.items():
-                f.write(f"{label}: {address:04X}\n")
-            
-            # Machine code and source code correspondence table
-            f.write("line  address  machine code  source code\n")
-            f.write("-" * 50 + "\n")
-            
-            for source_line, line_num, unprocessed_line, address_src in lines:
-                if address_src in adr_list and adr_list[address_src][1] == line_num and unprocessed_line and unprocessed_line.strip().split()[0].upper() in assembler.INST_TYPES:
-                    byte_val, _ = adr_list[address_src]
-                    f.write(f"{line_num:4d}  {address_src:04X}     {byte_val:02X}            {unprocessed_line}\n")
-                else:
-                    f.write(f"{line_num:4d}  {address_src:04X}                   {unprocessed_line}\n")
-
-            bitstream = assembler.adrlist2bitstream(adr_list, 255)
-
-            f.write("\n" + "-" * 50 + "\n")
-            f.write(f"Generated machine code: {len(bitstream)} bytes\n\n")
-            
-            # Hex dump
-            f.write("Hex dump:\n")
-            for i in range(0, len(bitstream), 16):
-                chunk = bitstream[i:i+16]
-                hex_str = " ".join(f"{byte_val:02X}" for byte_val in chunk)
-                f.write(f"{i:04X}: {hex_str:<47}\n")
-                
+            write_list(f, lines, adr_list, ls, analysis)
         return True
     except Exception as e:
         print(f"[Error]: An error occurred while writing the list file '{filename}': {e}", file=sys.stderr)
         return False
 
 
-def determine_output_filename(input_file:str, output_file:str, format_type:str):
+def determine_output_filename(input_file:str, output_file:str, format_type:str, multiple:bool=False):
     """出力ファイル名を決定"""
-    if output_file:
-        return output_file
-    
-    # 入力ファイル名から拡張子を除去
-    input_path = Path(input_file)
-    base_name = input_path.stem
-    
     # 形式に応じた拡張子を決定
     extensions = {
         'binary': '.bin',
         'hex': '.hex',
         'ihex': '.hex',
         'vhex': '.hex',
-        'text': '.lst'
+        'text': '.lst',
+        'list': '.lst'
     }
+
+    if output_file:
+        if not multiple:
+            return output_file
+        # 複数形式の場合は出力ファイル名の拡張子を形式ごとに置き換える
+        return str(Path(output_file).with_suffix(extensions[format_type]))
+    
+    # 入力ファイル名から拡張子を除去
+    input_path = Path(input_file)
+    base_name = input_path.stem
     
     return base_name + extensions[format_type]
 
 
+def write_output(format_type:str, filename:str, processed_lines:Sequence[tuple[str, int, str, int]], machine_code:assembler.ProgramImage, ls:assembler.LinkState, analysis:Optional[timing.Analysis]=None) -> bool:
+    """指定された形式で出力"""
+    bitstream = assembler.adrlist2bitstream(machine_code, 255)
+    if format_type == 'binary':
+        return write_binary_output(filename, bitstream)
+    elif format_type == 'ihex':
+        return write_intel_hex_output(filename, bitstream)
+    elif format_type == 'hex' or format_type == 'vhex':
+        return write_verilog_hex_output(filename, bitstream)
+    elif format_type == 'list' or format_type == 'text':
+        return write_list_output(filename, processed_lines, machine_code, ls, analysis)
+    return False
+
+
+def write_outputs(outputs:dict[str, str], processed_lines:Sequence[tuple[str, int, str, int]], machine_code:assembler.ProgramImage, ls:assembler.LinkState, timings:Optional[dict[str, float]]=None, analysis:Optional[timing.Analysis]=None) -> bool:
+    """
+    Write one assembly result in several formats.
+    Args:
+        outputs (dict[str, str]): Output format -> output file name.
+        timings (dict[str, float]): If given, receives the seconds spent per writer as "write:<format>".
+        analysis (timing.Analysis): If given, annotates the list output with static timing.
+    Returns:
+        bool: True if every output was written.
+    """
+    def timed_write(format_type:str, filename:str) -> bool:
+        start = time.perf_counter()
+        ok = write_output(format_type, filename, processed_lines, machine_code, ls, analysis)
+        if timings is not None:
+            timings[f"write:{format_type}"] = time.perf_counter() - start
+        return ok
+    if len(outputs) == 1:
+        ((format_type, filename),) = outputs.items()
+        return timed_write(format_type, filename)
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        futures = [executor.submit(timed_write, format_type, filename) for format_type, filename in outputs.items()]
+        return all([future.result() for future in futures])
+
+
+def assemble_source(lines:Sequence[str], arch:str, include_pathes:list[str], include_cache:Optional[assembler.IncludeCache]=None, stats:Optional[dict]=None, optimize:bool=False, savings:Optional[list]=None) -> tuple[list[tuple[str, int, str, int]], assembler.ProgramImage, assembler.LinkState]:
+    """
+    Preprocess and assemble lines as one independent job; stats, if given, receives Assembler.stats().
+    With optimize the peephole pass runs in between, and savings, if given, receives its optimizer.Saving list.
+    """
+    job = assembler.Assembler(arch, include_pathes, include_cache=include_cache)
+    job.preprocess(lines)
+    if optimize:
+        saved = optimizer.optimize(job)
+        if savings is not None:
+            savings.extend(saved)
+    machine_code = job.assemble()
+    if stats is not None:
+        stats.update(job.stats())
+    return job.processed, machine_code, job.ls
+
+
+def diagnose_source(lines:Sequence[str], arch:str, include_pathes:list[str], filename:Optional[str]=None, include_cache:Optional[assembler.IncludeCache]=None) -> list[assembler.Diagnostic]:
+    """Assemble lines in collect mode and return every error found"""
+    job = assembler.Assembler(arch, include_pathes, include_cache=include_cache, filename=filename, collect=True)
+    job.run(lines)
+    return job.diagnostics
+
+
+def print_diagnostics(mode:str, diagnostics:Sequence[assembler.Diagnostic], stats:Optional[dict]=None):
+    """Report diagnostics as text on stderr or as one JSON document on stdout (holding the --stats json report, if given)"""
+    if mode == 'json':
+        document: dict = {"ok": not diagnostics, "diagnostics": [d.to_dict() for d in diagnostics]}
+        if stats is not None:
+            document["stats"] = stats
+        print(json.dumps(document))
+        return
+    for d in diagnostics:
+        print(d, file=sys.stderr)
+    if diagnostics:
+        print(f"[Error] {len(diagnostics)} error(s).", file=sys.stderr)
+
+
+def print_stats(mode:str, report:dict, file:TextIO=sys.stdout):
+    """Report --stats as text or as one JSON document on file"""
+    if mode == 'json':
+        print(json.dumps(report), file=file)
+        return
+    print(f"[Stats] {report['input']} ({report['architecture']}{', build cache ' + report['cache'] if report['cache'] else ''})", file=file)
+    for stage, seconds in report["timings"].items():
+        print(f"  {stage:<22} {seconds * 1000:10.3f} ms", file=file)
+    for name, value in report["counters"].items():
+        print(f"  {name:<22} {value:10}", file=file)
+    print(f"  {'peak_memory':<22} {report['peak_memory'] / 1024:10.1f} KiB", file=file)
+
+
+def build_file(input_file:str, lines:Sequence[str], arch:str, include_pathes:list[str], cache:Optional[buildcache.BuildCache]=None, include_cache:Optional[assembler.IncludeCache]=None, stats:Optional[dict]=None, optimize:bool=False, savings:Optional[list]=None) -> tuple[list[tuple[str, int, str, int]], assembler.ProgramImage, assembler.LinkState]:
+    """Assemble a file, reusing the build cache entry when its sources are unchanged (savings stay empty then)"""
+    key = cache.key(input_file, arch, include_pathes, optimize) if cache is not None else None
+    if cache is not None and key is not None:
+        entry = cache.load(key)
+        if entry is not None:
+            if stats is not None:
+                stats.update(lines_in=len(lines), lines_out=len(entry[0]), unresolved_fixups=len(entry[2].unresolved), bytes=len(entry[1]))
+            return entry
+    result = assemble_source(lines, arch, include_pathes, include_cache, stats, optimize, savings)
+    if cache is not None and key is not None:
+        cache.store(key, *result)
+    return result
+
+
+# --serve sessions: session name -> result of the last source that assembled, least recently used first
+_sessions: dict[str, incremental.IncrementalAssembler] = {}
+MAX_SESSIONS = 16
+
+def assemble_session(session:str, lines:Sequence[str], arch:str, include_pathes:list[str]) -> tuple[list[tuple[str, int, str, int]], assembler.ProgramImage, assembler.LinkState]:
+    """Assemble the latest source of an editing session, reassembling only what changed since the last request"""
+    state = _sessions.pop(session, None)
+    if state is None or state.arch != arch or state.include_pathes != include_pathes:
+        state = incremental.IncrementalAssembler(lines, arch, include_pathes, shared_include_cache())
+    else:
+        state.update(lines)
+    _sessions[session] = state
+    while len(_sessions) > MAX_SESSIONS:
+        del _sessions[next(iter(_sessions))]
+    return state.processed, state.image, state.ls
+
+
+def handle_request(request:dict) -> dict:
+    """
+    Handle one --serve request.
+    Request:
+        {"id": any, "command": "assemble" | "ping", "source": str, "architecture": "HC4" | "HC4E",
+         "formats": ["ihex", "vhex", "list"], "include_paths": [str], "encoding": "hex" | "base64",
+         "session": str}
+    Requests with the same session are assembled incrementally against the previous one.
+    Response:
+        {"id": any, "ok": bool, "size": int, "image": str, "labels": {str: int},
+         "ihex": str, "vhex": str, "list": str, "error": str,
+         "diagnostics": [{"severity": str, "message": str, "file": str | None, "line": int, "column": int,
+                          "chain": [{"kind": "macro" | "include", "name": str, "file": str | None, "line": int}]}]}
+    On failure every error in the source is listed in diagnostics.
+    """
+    response: dict = {"id": request.get("id")}
+    command = request.get("command", "assemble")
+    if command == "ping":
+        response["ok"] = True
+        return response
+    if command != "assemble":
+        response.update(ok=False, error=f"[Error] Unknown command: {command}")
+        return response
+
+    arch = request.get("architecture", "HC4")
+    if arch not in assembler.INST_DICT_M:
+        response.update(ok=False, error=f"[Error] Unsupported architecture: {arch}")
+        return response
+    include_dir = Path(__file__).resolve().parent / 'include'
+    include_pathes = list(request.get("include_paths", [])) + [str(include_dir)]
+    lines: list[str] = []
+    try:
+        lines = str(request.get("source", "")).splitlines()
+        session = request.get("session")
+        if session is not None:
+            processed_lines, machine_code, ls = assemble_session(str(session), lines, arch, include_pathes)
+        else:
+            processed_lines, machine_code, ls = assemble_source(lines, arch, include_pathes, shared_include_cache())
+    except (KeyError, ValueError, FileNotFoundError) as e:
+        message = str(e.args[0]) if e.args else str(e)
+        try:
+            diagnostics = [d.to_dict() for d in diagnose_source(lines, arch, include_pathes, include_cache=shared_include_cache())]
+        except Exception:
+            diagnostics = []
+        response.update(ok=False, error=message, diagnostics=diagnostics)
+        return response
+
+    bitstream = assembler.adrlist2bitstream(machine_code, 255)
+    if request.get("encoding", "hex") == "base64":
+        image = base64.b64encode(bitstream).decode("ascii")
+    else:
+        image = bitstream.hex().upper()
+    response.update(ok=True, size=len(bitstream), image=image, labels=ls.labels, diagnostics=[])
+    for format_type in request.get("formats", []):
+        buf = io.StringIO()
+        if format_type == "ihex":
+            write_intel_hex(buf, bitstream)
+        elif format_type in ("hex", "vhex"):
+            write_verilog_hex(buf, bitstream)
+        elif format_type in ("list", "text"):
+            write_list(buf, processed_lines, machine_code, ls)
+        else:
+            continue
+        response[format_type] = buf.getvalue()
+    return response
+
+
+def serve(stdin:TextIO=sys.stdin, stdout:TextIO=sys.stdout):
+    """Resident mode: one JSON request per line on stdin, one JSON response per line on stdout"""
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as e:
+            response: dict = {"id": None, "ok": False, "error": f"[Error] Invalid request: {e}"}
+        else:
+            if request.get("command") == "exit":
+                stdout.write(json.dumps({"id": request.get("id"), "ok": True}) + "\n")
+                stdout.flush()
+                break
+            try:
+                response = handle_request(request)
+            except Exception as e:
+                # one bad request must not end the server and the sessions of the others
+                response = {"id": request.get("id"), "ok": False, "error": f"[Error] Internal error: {e!r}"}
+        stdout.write(json.dumps(response) + "\n")
+        stdout.flush()
+
+
+# Include files parsed by this process, shared by the jobs it runs (batch workers and --serve)
+_include_caches: dict[Optional[str], assembler.IncludeCache] = {}
+
+def shared_include_cache(cache_dir:Optional[str]=None) -> assembler.IncludeCache:
+    """Include cache of this process; kept on disk under cache_dir/includes when given"""
+    cache = _include_caches.get(cache_dir)
+    if cache is None:
+        cache = assembler.IncludeCache(os.path.join(cache_dir, 'includes') if cache_dir else None)
+        _include_caches[cache_dir] = cache
+    return cache
+
+def batch_job(input_file:str, outputs:dict[str, str], arch:str, include_path:list[str], cache_dir:Optional[str]=None, cache_size:int=64, diagnose:bool=False, optimize:bool=False, clock:Optional[float]=None) -> dict:
+    """
+    Assemble one file of a batch. Never raises; the outcome is reported in the result.
+    With diagnose, a file that fails is assembled again in collect mode to list all its errors.
+    With clock, list output is annotated with static timing like --clock on a single file.
+    Returns:
+        dict: {"input": str, "ok": bool, "message": str, "size": int, "seconds": float, "diagnostics": [Diagnostic]}
+    """
+    start = time.perf_counter()
+    result: dict = {"input": input_file, "ok": False, "message": "", "size": 0, "seconds": 0.0, "diagnostics": []}
+    lines: Optional[list[str]] = None
+    include_dir = Path(__file__).resolve().parent / 'include'
+    include_pathes = [os.path.dirname(input_file)] + include_path + [str(include_dir)]
+    try:
+        with open(input_file, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        cache = buildcache.BuildCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+        processed_lines, machine_code, ls = build_file(input_file, lines, arch, include_pathes, cache, shared_include_cache(cache_dir), optimize=optimize)
+        analysis = timing.analyze(machine_code, ls, arch, clock) if clock is not None else None
+        if write_outputs(outputs, processed_lines, machine_code, ls, None, analysis):
+            result.update(ok=True, size=len(machine_code), message=", ".join(outputs.values()))
+        else:
+            result["message"] = "failed to write output"
+    except (OSError, UnicodeDecodeError, KeyError, ValueError) as e:
+        result["message"] = str(e.args[0]) if isinstance(e, KeyError) and e.args else str(e)
+        if diagnose and lines is not None and isinstance(e, (KeyError, ValueError, FileNotFoundError)):
+            result["diagnostics"] = diagnose_source(lines, arch, include_pathes, input_file, shared_include_cache(cache_dir))
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def main_batch(args, inputs:list[str]) -> int:
+    """Assemble several files, in parallel with -j. Returns the exit status."""
+    formats = args.formats
+    plans: dict[str, dict[str, str]] = {}
+    for input_file in inputs:
+        outputs = {}
+        for f in formats:
+            name = determine_output_filename(input_file, "", f)
+            outputs[f] = os.path.join(args.output, name) if args.output else name
+        plans[input_file] = outputs
+    written = [name for outputs in plans.values() for name in outputs.values()]
+    if len(set(written)) != len(written):
+        raise ValueError("[Error] Several inputs or formats would write to the same output file.")
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    architectures = getattr(args, 'architectures', {})
+    diagnostics_mode = getattr(args, 'diagnostics', None)
+    diagnose = diagnostics_mode is not None
+    optimize = getattr(args, 'optimize', False)
+    clock = getattr(args, 'clock', None)
+    if jobs == 1:
+        results = [batch_job(i, plans[i], architectures.get(i, args.architecture), args.include_path, args.cache_dir, args.cache_size, diagnose, optimize, clock) for i in inputs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(inputs))) as executor:
+            futures = [executor.submit(batch_job, i, plans[i], architectures.get(i, args.architecture), args.include_path, args.cache_dir, args.cache_size, diagnose, optimize, clock) for i in inputs]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    # JSON diagnostics own stdout
+    quiet = args.quiet or diagnostics_mode == 'json'
+    for result in results:
+        if result["ok"]:
+            if not quiet:
+                print(f"[OK] {result['input']} -> {result['message']} ({result['size']} bytes, {result['seconds']:.3f}s)")
+        else:
+            failed += 1
+            if not result["diagnostics"]:
+                print(f"[Error] {result['input']}: {result['message']}", file=sys.stderr)
+    if diagnostics_mode is not None:
+        print_diagnostics(diagnostics_mode, [d for result in results for d in result["diagnostics"]])
+    if diagnostics_mode != 'json':
+        print(f"[Info] Batch: {len(results) - failed} succeeded, {failed} failed, {elapsed:.3f}s with {jobs} job(s).")
+    return 1 if failed else 0
+
+
 def main(args):
     """Main function of hcx series assembler"""
     
+    inputs = getattr(args, 'input_files', [args.input_file])
+    if len(inputs) > 1:
+        sys.exit(main_batch(args, inputs))
+    
     # Check if input file exists
     if not os.path.exists(args.input_file):
         raise FileNotFoundError(f"[Error] Input file '{args.input_file}' does not exist.")
     
-    # Determine output file name
-    output_filename = determine_output_filename(args.input_file, args.output, args.format)
+    # Determine output file names
+    formats = getattr(args, 'formats', [args.format])
+    outputs = {f: determine_output_filename(args.input_file, args.output, f, len(formats) > 1) for f in formats}
+    if len(set(outputs.values())) != len(outputs):
+        raise ValueError(f"[Error] Output formats {', '.join(formats)} would write to the same file. Write them separately.")
+    output_filename = ", ".join(outputs.values())
     
     if args.verbose:
         print(f"HCX Assembler")
         print(f"Input file: {args.input_file}")
         print(f"Output file: {output_filename}")
-        print(f"Output format: {args.format}")
+        print(f"Output format: {', '.join(formats)}")
         print()
     
+    stats_mode = getattr(args, 'stats', None)
+    stats: Optional[dict] = None
+    if stats_mode is not None:
+        stats = {}
+        tracemalloc.start()
+    started = time.perf_counter()
+
     # Read assembly file
     lines = read_asm_file(args.input_file)
+    read_seconds = time.perf_counter() - started
     # Write output file
     include_dir = Path(__file__).resolve().parent / 'include'
     default_include_pathes = [os.path.dirname(args.input_file)] + args.include_path + [str(include_dir)]
-    processed_lines = assembler.preprocess(lines, False, 0, default_include_pathes)
+    cache = buildcache.BuildCache(args.cache_dir, args.cache_size * 1024 * 1024) if getattr(args, 'cache_dir', None) else None
+    include_cache = assembler.IncludeCache(os.path.join(args.cache_dir, 'includes')) if getattr(args, 'cache_dir', None) else None
+    diagnostics_mode = getattr(args, 'diagnostics', None)
+    savings: list[optimizer.Saving] = []
+    try:
+        processed_lines, machine_code, ls = build_file(args.input_file, lines, args.architecture, default_include_pathes, cache, include_cache, stats, getattr(args, 'optimize', False), savings)
+    except (KeyError, ValueError, FileNotFoundError):
+        if diagnostics_mode is None:
+            raise
+        print_diagnostics(diagnostics_mode, diagnose_source(lines, args.architecture, default_include_pathes, args.input_file, include_cache))
+        sys.exit(1)
     if args.verbose:
+        if cache is not None:
+            print(f"[Info] Build cache {'hit' if cache.hits else 'miss'} ({args.cache_dir}).")
         print(f"[Info] Preprocessed {len(processed_lines)} lines.")
         # print(processed_lines)
-    ls = assembler.LinkState()
-    
-    machine_code = assembler.assemble(tuple((pl[0], pl[1]) for pl in processed_lines), ls, args.architecture)
+    bitstream = assembler.adrlist2bitstream(machine_code, 255)
 
-    success = False
-    if args.format == 'binary':
-        success = write_binary_output(output_filename, assembler.adrlist2bitstream(machine_code, 255))
-    elif args.format == 'ihex':
-        success = write_intel_hex_output(output_filename, assembler.adrlist2bitstream(machine_code, 255))
-    elif args.format == 'hex' or args.format == 'vhex':
-        success = write_verilog_hex_output(output_filename, assembler.adrlist2bitstream(machine_code, 255))
-    elif args.format == 'list' or args.format == 'text':
-        success = write_list_output(output_filename, processed_lines, machine_code, ls)
+    analysis = None
+    if getattr(args, 'clock', None) is not None:
+        analysis = timing.analyze(machine_code, ls, args.architecture, args.clock)
+    write_timings: dict[str, float] = {}
+    success = write_outputs(outputs, processed_lines, machine_code, ls, write_timings, analysis)
     
     if not success:
         sys.exit(1)
 
-    print(f"[Info] Assembled {len(processed_lines)} lines into {len(assembler.adrlist2bitstream(machine_code, 255))} bytes.")
-    if args.verbose:
-        print(f"[Info] Architecture: {args.architecture}")
-        print(f"[Info] Output format: {args.format}")
-        print(f"[Info] Defined labels: ")
-        for label, address in ls.labels.items():
-            print(f"       {label}: {address:04X}")
-    print(f"[OK] Done. Output written to '{output_filename}'.")
+    report: Optional[dict] = None
+    if stats is not None:
+        stage_timings = stats.pop("timings", {})
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report = {
+            "input": args.input_file,
+            "architecture": args.architecture,
+            "cache": ("hit" if cache.hits else "miss") if cache is not None else None,
+            "timings": {"read": read_seconds, **stage_timings, **write_timings, "total": time.perf_counter() - started},
+            "counters": stats,
+            "peak_memory": peak_memory,
+        }
+
+    if diagnostics_mode == 'json':
+        # one JSON document on stdout: the stats go into it, or to stderr as text
+        print_diagnostics(diagnostics_mode, [], report if stats_mode == 'json' else None)
+    # JSON reports own stdout
+    if diagnostics_mode != 'json' and stats_mode != 'json':
+        print(f"[Info] Assembled {len(processed_lines)} lines into {len(bitstream)} bytes.")
+        if savings:
+            print(f"[Info] -O saved {sum(s.bytes for s in savings)} bytes and {sum(s.cycles for s in savings)} cycles (each changed line run once).")
+            if args.verbose:
+                print(f"       line  bytes  cycles")
+                for lineno, saved_bytes, saved_cycles, reasons in optimizer.summarize(savings):
+                    print(f"       {lineno:4d}  {saved_bytes:5d}  {saved_cycles:6d}  {reasons}")
+        if args.verbose:
+            print(f"[Info] Architecture: {args.architecture}")
+            print(f"[Info] Output format: {', '.join(formats)}")
+            print(f"[Info] Defined labels: ")
+            for label, address in ls.labels.items():
+                print(f"       {label}: {address:04X}")
+        print(f"[OK] Done. Output written to '{output_filename}'.")
+    if report is not None and stats_mode is not None and not (stats_mode == 'json' and diagnostics_mode == 'json'):
+        print_stats(stats_mode, report, sys.stderr if diagnostics_mode == 'json' else sys.stdout)
 
 if __name__ == "__main__":
     args = parse_arguments()
-    main(args)
\ No newline at end of file
+    if args.serve:
+        serve()
+    elif args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        main(args)
\ No newline at end of file
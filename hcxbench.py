@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+HCX アセンブラ ベンチマーク - 合成した大規模プログラムで各段階の時間を計測
+
+使用方法:
+    python hcxbench.py run [--sizes 1k,10k,100k] [-a HC4] [--repeat 3] [--history bench_history.json]
+    python hcxbench.py compare --baseline baseline.json [--history bench_history.json] [--threshold 10]
+    python hcxbench.py generate --lines 10k -o bench_src
+
+コマンド:
+    run       : 合成プログラムを生成してアセンブルし、結果を履歴ファイル(JSON)に追記
+    compare   : 履歴の最新の結果を基準と比較し、遅くなった段階があれば終了コード 1
+    generate  : 合成プログラムをディレクトリに書き出す
+"""
+
+import argparse
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
+import assembler
+import hcxasm
+from bench import generator, runner
+
+
+def writers_for(formats:list[str]) -> runner.Writers:
+    """Writers of hcxasm that write into memory, so the write stage does not measure the disk"""
+    def ihex(image, processed, ls):
+        hcxasm.write_intel_hex(io.StringIO(), assembler.adrlist2bitstream(image, 255))
+    def vhex(image, processed, ls):
+        hcxasm.write_verilog_hex(io.StringIO(), assembler.adrlist2bitstream(image, 255))
+    def listing(image, processed, ls):
+        hcxasm.write_list(io.StringIO(), processed, image, ls)
+    available = {"ihex": ihex, "vhex": vhex, "list": listing}
+    return {f: available[f] for f in formats}
+
+
+def parse_arguments():
+    """コマンドライン引数の解析"""
+    parser = argparse.ArgumentParser(
+        description='HCx series assembler benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Mix (--mix): comma separated shares of statement kinds, the rest are plain instructions
+    labels, forward_refs, back_refs, defines, macros, comments (0.0 - 1.0), include_depth (int)
+
+Examples:
+    python hcxbench.py run --sizes 1k,10k,100k,1M -a HC4 -a HC4E
+    python hcxbench.py run --save-baseline bench/baseline.json
+    python hcxbench.py compare --baseline bench/baseline.json --threshold 15
+    python hcxbench.py generate --lines 50k --mix macros=0.3,include_depth=4 -o bench_src
+        """
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def add_program_options(p):
+        p.add_argument('-a', '--architecture', action='append', choices=['HC4', 'HC4E'],
+                       help='Target architecture, repeatable (default: HC4)')
+        p.add_argument('--mix', type=generator.Mix.parse, default=generator.Mix(),
+                       help='Statement mix, e.g. "labels=0.1,macros=0.2,include_depth=3"')
+        p.add_argument('--seed', type=int, default=0, help='Random seed of the generator (default: 0)')
+
+    p = sub.add_parser('run', help='Generate, assemble and time programs; append the results to the history')
+    p.add_argument('--sizes', default='1k,10k,100k',
+                   help='Comma separated program sizes in lines, k and M suffixes allowed (default: 1k,10k,100k)')
+    p.add_argument('--repeat', type=int, default=3, help='Rounds per case; the fastest round is kept (default: 3)')
+    p.add_argument('-f', '--format', default='ihex',
+                   help='Comma separated writers to time: ihex, vhex, list (default: ihex)')
+    p.add_argument('--history', default='bench_history.json', help='History file to append to (default: bench_history.json)')
+    p.add_argument('--save-baseline', metavar='FILE', help='Also store this run as the baseline in FILE')
+    add_program_options(p)
+
+    p = sub.add_parser('compare', help='Compare the latest run of the history with a baseline')
+    p.add_argument('--baseline', required=True, help='Baseline file (from run --save-baseline)')
+    p.add_argument('--history', default='bench_history.json', help='History file (default: bench_history.json)')
+    p.add_argument('--threshold', type=float, default=10.0, help='Allowed slowdown in percent (default: 10)')
+    p.add_argument('--min-ms', type=float, default=1.0, help='Ignore slowdowns smaller than this many ms (default: 1)')
+
+    p = sub.add_parser('generate', help='Write a synthetic program and its includes to a directory')
+    p.add_argument('--lines', default='10k', help='Program size in lines (default: 10k)')
+    p.add_argument('-o', '--output', required=True, help='Output directory')
+    add_program_options(p)
+
+    args = parser.parse_args()
+    if hasattr(args, 'architecture'):
+        args.architecture = args.architecture or ['HC4']
+    return args
+
+
+def main_run(args) -> int:
+    try:
+        sizes = [generator.parse_size(s) for s in args.sizes.split(',') if s.strip()]
+        writers = writers_for([f.strip() for f in args.format.split(',') if f.strip()])
+    except (ValueError, KeyError) as e:
+        print(f"[Error] Invalid --sizes or --format: {e}", file=sys.stderr)
+        return 2
+    if args.repeat < 1:
+        print(f"[Error] --repeat must be at least 1: {args.repeat}", file=sys.stderr)
+        return 2
+    entry = runner.run(sizes, args.architecture, args.mix, args.repeat, args.seed, writers,
+                       progress=lambda result: print(runner.format_result(result)))
+    runner.append_history(args.history, entry)
+    print(f"[Info] Results appended to '{args.history}'.")
+    if args.save_baseline:
+        runner.save_json(args.save_baseline, entry)
+        print(f"[Info] Baseline saved to '{args.save_baseline}'.")
+    return 0
+
+
+def main_compare(args) -> int:
+    baselines = runner.load_history(args.baseline)
+    runs = runner.load_history(args.history)
+    if not baselines or not runs:
+        print(f"[Error] Nothing to compare: '{args.baseline}' or '{args.history}' holds no run.", file=sys.stderr)
+        return 2
+    baseline, current = baselines[-1], runs[-1]
+    regressions = runner.compare(baseline, current, args.threshold / 100, args.min_ms / 1000)
+    print(f"[Info] Baseline {baseline.get('timestamp')} ({baseline.get('commit')}) vs {current.get('timestamp')} ({current.get('commit')})")
+    for r in regressions:
+        print(f"[Regression] {r['case']} {r['stage']}: {r['baseline'] * 1000:.1f} ms -> {r['current'] * 1000:.1f} ms (x{r['ratio']:.2f})")
+    if regressions:
+        print(f"[Error] {len(regressions)} stage(s) slower than {args.threshold:g}% over the baseline.", file=sys.stderr)
+        return 1
+    print("[OK] No regression.")
+    return 0
+
+
+def main_generate(args) -> int:
+    os.makedirs(args.output, exist_ok=True)
+    for arch in args.architecture:
+        files = generator.generate(generator.parse_size(args.lines), arch, args.mix, args.seed)
+        for name, text in files.items():
+            if len(args.architecture) > 1 and name == "main.asm":
+                name = f"main_{arch.lower()}.asm"
+            with open(os.path.join(args.output, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+    print(f"[OK] Program written to '{args.output}'. Assemble it with -L {os.path.join(os.path.dirname(os.path.abspath(__file__)), 'include')} if vasm.inc is not found.")
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.command == 'run':
+        sys.exit(main_run(args))
+    elif args.command == 'compare':
+        sys.exit(main_compare(args))
+    else:
+        sys.exit(main_generate(args))
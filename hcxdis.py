@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+HCX 逆アセンブラ - バイナリ / Verilog HEX / Intel HEX を注釈付きアセンブリに変換
+
+使用方法:
+    python hcxdis.py program.hex [-a HC4] [-f auto] [-o program.asm] [--verify]
+
+引数:
+    input               : 入力ファイル (大きなダンプもチャンク単位で読み込み)
+    -a, --architecture  : アーキテクチャ (HC4 または HC4E, デフォルト: HC4)
+    -f, --format        : 入力形式 (auto, binary, hex, vhex, ihex, デフォルト: auto)
+    -o, --output        : 出力ファイル (デフォルト: 標準出力)
+    --no-labels         : LI/LI/LI/JP の並びからラベルを復元しない
+    --verify            : 出力をアセンブルし直し、元と同じバイト列になるか確認
+"""
+
+import argparse
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
+import assembler
+import disassembler
+
+
+def parse_arguments():
+    """コマンドライン引数の解析"""
+    parser = argparse.ArgumentParser(
+        description='HCx(HC4/4e) series disassembler',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Input Formats:
+    binary     : Binary file (.bin)
+    ihex       : Intel HEX file (.hex)
+    hex, vhex  : Verilog HEX file (.hex)
+    auto       : Intel HEX if the file starts with ':', Verilog HEX if it is hex text, else binary
+
+Examples:
+    python hcxdis.py py/test_files/countlcd.hex -o countlcd_dis.asm --verify
+    python hcxdis.py py/test_files/dice4e.hex -a HC4E
+        """
+    )
+    parser.add_argument('input_file', help='Image to disassemble')
+    parser.add_argument('-a', '--architecture', choices=['HC4', 'HC4E'], default='HC4',
+                        help='Target architecture (default: HC4)')
+    parser.add_argument('-f', '--format', choices=['auto', 'binary', 'hex', 'vhex', 'ihex'], default='auto',
+                        help='Input format (default: auto)')
+    parser.add_argument('-o', '--output', help='Output assembly file (default: stdout)')
+    parser.add_argument('--no-labels', action='store_true',
+                        help='Do not recover labels from LI ... JP sequences')
+    parser.add_argument('--verify', action='store_true',
+                        help='Assemble the output again and check that it gives the same bytes')
+    return parser.parse_args()
+
+
+def verify(asm_file:str, input_file:str, fmt:str, arch:str) -> bool:
+    """True if asm_file assembles to the image in input_file"""
+    with open(asm_file, 'r', encoding='utf-8') as f:
+        image = assembler.Assembler(arch).run(f.read().splitlines())
+    return bytes(assembler.adrlist2bitstream(image, 255)) == bytes(disassembler.read_image(input_file, fmt))
+
+
+def main():
+    args = parse_arguments()
+    fmt = {'auto': None, 'hex': 'vhex'}.get(args.format, args.format)
+    # with stdout the counters go to stderr
+    info = sys.stderr if args.output is None else sys.stdout
+    try:
+        if args.output is None:
+            out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='\n', write_through=False)
+            counts = disassembler.disassemble(args.input_file, out, args.architecture, fmt, not args.no_labels)
+            out.flush()
+            out.detach()
+        else:
+            with open(args.output, 'w', encoding='utf-8', newline='\n') as out:
+                counts = disassembler.disassemble(args.input_file, out, args.architecture, fmt, not args.no_labels)
+        print(f"[Info] Disassembled {counts['bytes']} bytes into {counts['instructions']} instructions "
+              f"and {counts['labels']} labels ({counts['seconds']:.3f}s).", file=info)
+        if counts['undecodable']:
+            print(f"[Warning] {counts['undecodable']} bytes are not instructions and were written as comments; "
+                  f"the output does not assemble to the same image.", file=info)
+        if args.verify:
+            if args.output is None:
+                raise ValueError("[Error] --verify needs an output file (-o).")
+            if not verify(args.output, args.input_file, fmt or disassembler.detect_format(args.input_file), args.architecture):
+                print(f"[Error] '{args.output}' does not assemble to the bytes of '{args.input_file}'.", file=sys.stderr)
+                sys.exit(1)
+            print(f"[OK] '{args.output}' assembles to the same {counts['bytes']} bytes.", file=info)
+    except FileNotFoundError as e:
+        print(f"[Error] File not found: {e.filename}", file=sys.stderr)
+        sys.exit(1)
+    except (ValueError, KeyError, UnicodeDecodeError) as e:
+        print(e.args[0] if isinstance(e, (ValueError, KeyError)) and e.args else e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+HCX プロファイラ - 実行中の PC を集計し、どのソース行・ラベルがサイクルを消費しているかを表示
+
+使用方法:
+    python load4e.py trace --port COM3 -j | python hcxprof.py program.asm -a HC4E --trace -
+    python hcxprof.py program.asm -a HC4E --recording run.hct [-o program.lst]
+    python hcxprof.py program.asm --simulate 1000000 [-i 0xF0=1] [-u label]
+
+引数:
+    input               : プログラムのアセンブリソース (.asm)
+    -a, --architecture  : アーキテクチャ (HC4 または HC4E, デフォルト: HC4)
+    -L, --include       : .INCLUDE 検索パス (複数指定可)
+    --trace             : load4e.py trace -j の出力 (- で標準入力, 終わるまで読み続ける)
+    --recording         : load4e.py trace --record で記録したファイル (インデックスから集計)
+    --simulate          : シミュレータでこの命令数まで実行して集計
+    -i, --input         : --simulate の入力ポートの値 PORT=VALUE (複数指定可)
+    -u, --until         : --simulate でこのラベルまたはアドレスに到達したら停止 (複数指定可)
+    -n, --top           : 上位何行・何ラベルを表示するか (デフォルト: 10)
+    -o, --output        : 各命令に割合を注記したリストファイル (hcxasm.py -f list と同じ形式)
+    -j, --json          : JSON 形式で出力
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
+import hcxasm
+import profiler
+import tracefile
+
+
+def parse_arguments():
+    """コマンドライン引数の解析"""
+    parser = argparse.ArgumentParser(
+        description='HCx(HC4/4e) series hotspot profiler',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Sources of samples (one is required):
+    --trace FILE       : records of load4e.py trace -j, read until the end ('-' for stdin)
+    --recording FILE   : a recording of load4e.py trace --record, counted from its index
+    --simulate N       : run the program on the simulator for up to N instructions
+
+Examples:
+    python load4e.py trace --port COM3 -j | python hcxprof.py dice4e.asm -a HC4E --trace -
+    python hcxprof.py py/test_files/countlcd.asm --simulate 200000 -u main -o countlcd_prof.lst
+        """
+    )
+    parser.add_argument('input_file', help='Assembly source of the program that ran')
+    parser.add_argument('-a', '--architecture', choices=['HC4', 'HC4E'], default='HC4',
+                        help='Target architecture (default: HC4)')
+    parser.add_argument('-L', '--include', action='append', default=[],
+                        help='Include directory for .INCLUDE (repeatable)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', metavar='FILE', help="Output of load4e.py trace -j ('-' for stdin)")
+    source.add_argument('--recording', metavar='FILE', help='Recording of load4e.py trace --record')
+    source.add_argument('--simulate', type=int, metavar='N', help='Run on the simulator for up to N instructions')
+    parser.add_argument('-i', '--input', action='append', default=[], metavar='PORT=VALUE',
+                        help='With --simulate, value of an input port, e.g. 0xF0=1 on HC4 or 14=1 on HC4E (repeatable)')
+    parser.add_argument('-u', '--until', action='append', default=[],
+                        help='With --simulate, stop when this label or address is reached (repeatable)')
+    parser.add_argument('-n', '--top', type=int, default=10, help='Number of lines and labels to report (default: 10)')
+    parser.add_argument('-o', '--output', help='Write the listing annotated with the share of each instruction')
+    parser.add_argument('-j', '--json', action='store_true', help='Output in JSON format')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    reason = None
+    skipped = 0
+    profile = machine = None
+    try:
+        with open(args.input_file, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        include_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'include')
+        include_pathes = [os.path.dirname(os.path.abspath(args.input_file))] + args.include + [include_dir]
+        profile, machine = profiler.profile_source(lines, args.architecture, include_pathes, args.top)
+        if args.trace is not None:
+            if args.trace == '-':
+                skipped = profile.add_trace(sys.stdin)
+            else:
+                with open(args.trace, 'r', encoding='utf-8') as f:
+                    skipped = profile.add_trace(f)
+        elif args.recording is not None:
+            with tracefile.TraceReader(args.recording) as reader:
+                if reader.index is None:
+                    raise tracefile.TraceFileError(f"[Error] '{args.recording}' could not be indexed")
+                profile.add_counts(reader.index.histogram())
+        else:
+            for item in args.input:
+                port, sep, value = item.partition('=')
+                if not sep:
+                    raise ValueError(f"[Error] Invalid --input, expected PORT=VALUE: {item}")
+                machine.inputs[int(port, 0)] = int(value, 0)
+            reason = profile.add_run(machine, args.simulate, args.until or None)
+    except FileNotFoundError as e:
+        # the assembler reports a missing include in its message, without a filename
+        print(f"[Error] File not found: {e.filename}" if e.filename else e.args[0], file=sys.stderr)
+        sys.exit(1)
+    except (ValueError, KeyError, tracefile.TraceFileError) as e:
+        print(e.args[0] if e.args else e, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # report what was collected from a live trace so far
+        if profile is None:
+            sys.exit(1)
+
+    if args.output:
+        if not hcxasm.write_list_output(args.output, profile.processed, profile.image, profile.ls, profile):
+            sys.exit(1)
+    if args.json:
+        result = profile.to_json()
+        if reason is not None:
+            result["reason"] = reason
+        print(json.dumps(result))
+        return
+    if reason is not None and machine is not None:
+        print(f"[Info] Simulation stopped ({reason}) after {machine.instructions} instructions.")
+    if skipped:
+        print(f"[Warning] {skipped} lines of the trace were not records and were ignored.", file=sys.stderr)
+    for line in profile.report():
+        print(line)
+    if args.output:
+        print(f"[Info] Annotated listing written to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
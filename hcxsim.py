@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+HCX シミュレータ - 実機なしでプログラムを実行し、レジスタと I/O を表示
+
+使用方法:
+    python hcxsim.py program.asm [-a HC4] [-n 10000000] [-u label] [-i 0xF0=1] [-j]
+
+引数:
+    input               : 入力ファイル (.asm はアセンブルして実行, それ以外はバイナリとして読み込み)
+    -a, --architecture  : アーキテクチャ (HC4 または HC4E, デフォルト: HC4)
+    -L, --include       : .INCLUDE 検索パス (複数指定可)
+    -n, --max-instructions : 実行する最大命令数 (デフォルト: 10000000)
+    -u, --until         : このラベルまたはアドレスに到達したら停止 (複数指定可)
+    -i, --input         : 入力ポートの値 PORT=VALUE (複数指定可, HC4: 0xF0-0xF3, HC4E: 14)
+    --lanes             : N 台を NumPy で一斉に実行し、スカラー実行とのスループットを比較 (NumPy が必要)
+    -e, --engine        : 実行エンジン (block: 基本ブロックを Python 関数に変換, interp: 1命令ずつ解釈, デフォルト: block)
+    --io                : 出力ポートへの書き込みをすべて表示
+    -j, --json          : JSON 形式で出力
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
+import assembler
+import simulator
+import translator
+import batchsim
+
+ENGINES = {'block': translator.BlockMachine, 'interp': simulator.Machine}
+
+
+def parse_arguments():
+    """コマンドライン引数の解析"""
+    parser = argparse.ArgumentParser(
+        description='HCx(HC4/4e) series instruction-set simulator',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Stop reasons:
+    halt  : a jump to itself (the HALT macro of vasm.inc)
+    until : an --until label or address was reached
+    limit : --max-instructions were executed
+
+Examples:
+    python hcxsim.py py/test_files/countlcd.asm -u main --io
+    python hcxsim.py py/test_files/dice4e.asm -a HC4E -i 14=1 -n 500 -j
+        """
+    )
+    parser.add_argument('input_file', help='Program to run (.asm is assembled first, anything else is read as a binary image)')
+    parser.add_argument('-a', '--architecture', choices=['HC4', 'HC4E'], default='HC4',
+                        help='Target architecture (default: HC4)')
+    parser.add_argument('-L', '--include', action='append', default=[],
+                        help='Include directory for .INCLUDE (repeatable)')
+    parser.add_argument('-n', '--max-instructions', type=int, default=10000000,
+                        help='Maximum number of instructions to execute (default: 10000000)')
+    parser.add_argument('-u', '--until', action='append', default=[],
+                        help='Stop when this label or address is reached (repeatable)')
+    parser.add_argument('-i', '--input', action='append', default=[], metavar='PORT=VALUE',
+                        help='Value of an input port, e.g. 0xF0=1 on HC4 or 14=1 on HC4E (repeatable)')
+    parser.add_argument('-e', '--engine', choices=list(ENGINES), default='block',
+                        help='Execution engine: block translates basic blocks into Python functions, interp decodes one instruction at a time (default: block)')
+    parser.add_argument('--lanes', type=int, default=0, metavar='N',
+                        help='Also run N copies in lockstep with NumPy and report their throughput (requires NumPy)')
+    parser.add_argument('--io', action='store_true', help='Print every write to an output port')
+    parser.add_argument('-j', '--json', action='store_true', help='Output in JSON format')
+    return parser.parse_args()
+
+
+def load_machine(input_file:str, arch:str, include_pathes:list[str], engine:type=simulator.Machine) -> simulator.Machine:
+    if input_file.lower().endswith('.asm'):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        include_pathes = [os.path.dirname(os.path.abspath(input_file))] + include_pathes
+        return simulator.load_source(lines, arch, include_pathes, engine)
+    with open(input_file, 'rb') as f:
+        return engine(arch, f.read())
+
+
+def main():
+    args = parse_arguments()
+    try:
+        machine = load_machine(args.input_file, args.architecture, args.include, ENGINES[args.engine])
+        for item in args.input:
+            port, sep, value = item.partition('=')
+            if not sep:
+                raise ValueError(f"[Error] Invalid --input, expected PORT=VALUE: {item}")
+            machine.inputs[int(port, 0)] = int(value, 0)
+        started = time.perf_counter()
+        reason = machine.run(args.max_instructions, args.until or None)
+        elapsed = time.perf_counter() - started
+        batch = None
+        batch_elapsed = 0.0
+        if args.lanes > 0:
+            batch = batchsim.BatchMachine(args.architecture, bytes(machine.rom), args.lanes, machine.labels)
+            for port, value in machine.inputs.items():
+                batch.inputs[:, port] = value
+            started = time.perf_counter()
+            batch.run(args.max_instructions, args.until or None)
+            batch_elapsed = time.perf_counter() - started
+    except ImportError as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(1)
+    except FileNotFoundError as e:
+        print(f"[Error] File not found: {e.filename}", file=sys.stderr)
+        sys.exit(1)
+    except (ValueError, KeyError) as e:
+        print(e.args[0] if e.args else e, file=sys.stderr)
+        sys.exit(1)
+
+    rate = machine.instructions / elapsed if elapsed > 0 else 0.0
+    batch_rate = 0.0
+    if batch is not None:
+        batch_rate = int(batch.instructions.sum()) / batch_elapsed if batch_elapsed > 0 else 0.0
+    if args.json:
+        result = {"reason": reason, **machine.state(), "outputs": machine.outputs, "instructions_per_second": rate}
+        if batch is not None:
+            result["batch"] = {"lanes": args.lanes, "instructions_per_second": batch_rate}
+        if args.io:
+            result["io"] = machine.io_log
+        print(json.dumps(result))
+        return
+    print(f"[Info] Stopped ({reason}) after {machine.instructions} instructions, {machine.cycles} cycles "
+          f"({rate / 1e6:.2f} M instructions/s).")
+    if batch is not None:
+        print(f"[Info] {args.lanes} lanes in lockstep: {batch_rate / 1e6:.2f} M machine-instructions/s "
+              f"({batch_rate / rate if rate > 0 else 0.0:.1f}x the {args.engine} engine).")
+    if args.io:
+        for cycle, port, value in machine.io_log:
+            print(f"  {cycle:>10}: [0x{port:02X}] <= 0x{value:X}")
+    print("Registers:")
+    for i in range(16):
+        print(f"R{i}: {machine.regs[i]}", end='  ')
+    print()
+    stack = " ".join(f"{name}={value}" for name, value in zip("ABC", machine.stack))
+    print(f"PC: {machine.pc}, INST: {machine.rom[machine.pc]}, {stack}, C={int(machine.carry)} Z={int(machine.zero)}")
+
+
+if __name__ == "__main__":
+    main()
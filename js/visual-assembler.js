@@ -1125,6 +1125,7 @@ function initializeWorkspace() {
         // スクロールして常に最新のコードが見えるようにする
         outputDiv.scrollTop = outputDiv.scrollHeight;
       }
+      scheduleAssemblyCheck(code);
     } catch (error) {
       console.error('[ERROR] Code generation error:', error);
       var outputDiv = document.getElementById('output');
@@ -1134,6 +1135,33 @@ function initializeWorkspace() {
     }
   }
 
+  // 編集中のコードを常駐アセンブラで確認し、エラーが変わったときだけ出力タブに表示する
+  // (ウィンドウごとのセッションで、前回からの差分だけが再アセンブルされる)
+  var assemblyCheckTimer = null;
+  var lastAssemblyError = null;
+  function scheduleAssemblyCheck(code) {
+    if (typeof window.electronAPI === 'undefined' || !window.electronAPI.assembleSource) return;
+    clearTimeout(assemblyCheckTimer);
+    if (code.trim() === '') return;
+    assemblyCheckTimer = setTimeout(async function() {
+      var arch = (window.architecture === 'HC4E') ? 'HC4E' : 'HC4';
+      try {
+        var res = await window.electronAPI.assembleSource(code, arch, []);
+        var error = res.ok ? null : (res.error || 'アセンブルに失敗しました');
+        if (error !== lastAssemblyError && typeof addOutputMessage === 'function') {
+          if (error) {
+            addOutputMessage('アセンブルエラー: ' + error, 'error');
+          } else if (lastAssemblyError) {
+            addOutputMessage('アセンブル成功 (' + res.size + ' バイト)');
+          }
+        }
+        lastAssemblyError = error;
+      } catch (e) {
+        console.error('[ERROR] assemble check failed:', e);
+      }
+    }, 500);
+  }
+
   // 外部（保存処理等）から同一ロジックでコード取得できるよう公開
   window.getAssemblyCode = function() {
     try {
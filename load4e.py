@@ -1,28 +1,55 @@
 import serial
+import os
 import sys
 import argparse
 import time
 import json
-import threading
-import queue
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'py'))
+import disassembler
+import serialproto
+import simulator
+import tracefile
+import tracestream
 
 def arg_parse():
     parser = argparse.ArgumentParser(description="Load binary data to HC4e via serial port.")
-    parser.add_argument("command", help="Command to execute ('load', 'register' | 'reg', 'trace').")
-    parser.add_argument("--file", help="Path to the intelhex file to load.")
-    parser.add_argument("--port", required=True, help="Serial port to use (e.g., COM3 or /dev/ttyUSB0).")
+    parser.add_argument("command", help="Command to execute ('load', 'register' | 'reg', 'trace', 'replay').")
+    parser.add_argument("--file", help="Path to the image to load (Intel HEX, Verilog HEX or binary), or the recording to replay.")
+    parser.add_argument("--port", help="Serial port to use (e.g., COM3 or /dev/ttyUSB0); needed by all commands but replay.")
     parser.add_argument("--baudrate", type=int, default=115200, help="Baud rate for serial communication.")
     parser.add_argument("-j", "--json", action="store_true", help="Output in JSON format where applicable.")
+    parser.add_argument("--protocol", choices=["auto", "binary", "hex"], default="auto",
+                        help="Upload protocol: binary frames, the 'l' + Intel HEX text protocol, or binary when the device supports it (default: auto).")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Bytes per binary frame (default: 64, capped by the device).")
+    parser.add_argument("--window", type=int, default=8, help="Binary frames sent before waiting for an acknowledgement (default: 8, capped by the device).")
+    parser.add_argument("--rate", type=float, default=20.0, help="Trace batches written per second; each holds every record received since the last (default: 20).")
+    parser.add_argument("--full", action="store_true", help="Send the whole image even if only some pages changed since the last load.")
+    parser.add_argument("--state-dir", default=os.path.join(os.path.expanduser("~"), ".hcx", "load4e"),
+                        help="Where the page hashes of the last image loaded through each port are kept (default: ~/.hcx/load4e).")
+    parser.add_argument("--record", help="Also append the trace to this recording (packed records, indexed for replay).")
+    parser.add_argument("--pc", help="replay: only records at this address, or label with --source.")
+    parser.add_argument("--source", help="replay: assembly source whose labels --pc may name.")
+    parser.add_argument("-a", "--architecture", choices=["HC4", "HC4E"], default="HC4E", help="replay: architecture of --source (default: HC4E).")
+    parser.add_argument("--from", dest="start", type=float, help="replay: first time, in seconds from the start of the recording.")
+    parser.add_argument("--to", dest="end", type=float, help="replay: last time, in seconds from the start of the recording.")
+    parser.add_argument("--limit", type=int, help="replay: at most this many records.")
     return parser.parse_args()
 
 def main():
     args = arg_parse()
+    if args.command != "replay" and not args.port:
+        print("Error: --port is required.")
+        sys.exit(1)
     if args.command == "load":
         load(args)
     elif args.command == "register" or args.command == "reg":
         register(args)
     elif args.command == "trace":
         trace(args)
+    elif args.command == "replay":
+        replay(args)
     else:
         print(f"Unknown command: {args.command}")
         sys.exit(1)
@@ -31,29 +58,70 @@ def load(args):
     try:
         with open(args.file, "rb") as f:
             hex_data = f.read()
+        fmt = disassembler.detect_format(args.file)
+        image = bytes(disassembler.read_image(args.file, fmt))
     except FileNotFoundError:
         print(f"Error: File '{args.file}' not found.")
         sys.exit(1)
+    except (ValueError, UnicodeDecodeError) as e:
+        print(f"Error: Cannot read '{args.file}': {e}")
+        sys.exit(1)
+    if fmt != "ihex":
+        hex_data = serialproto.intel_hex(image)
     
+    record = serialproto.FlashRecord(args.state_dir)
+    previous = None if args.full else record.load(args.port)
     try:
         with serial.Serial(args.port, args.baudrate, timeout=1) as ser:
-            print(f"Loading data to HC4e via {args.port} at {args.baudrate} baud...")
-            ser.write(b'l\n')  # Command to initiate loading
-            time.sleep(0.5)  # Wait for device to be ready
-            ser.write(hex_data)
-            result = b""
-            while ser.in_waiting:
-                result += ser.read(ser.in_waiting)
-                time.sleep(0.1)
-            if b'[OK]' in result:
-                print("Data loaded successfully.")
-            else:
-                print("Error: Failed to load data.")
-                print(f"Device response: {result.decode(errors='ignore')}")
+            if not args.json:
+                print(f"Loading data to HC4e via {args.port} at {args.baudrate} baud...")
+            device = serialproto.handshake(ser) if args.protocol != "hex" else None
+            # a load that fails halfway leaves the device unknown
+            record.forget(args.port)
+            if device is not None:
+                stats = serialproto.upload(ser, image, args.chunk_size, args.window, device, previous)
+                stats["protocol"] = "binary"
+            elif args.protocol == "binary":
+                print("Error: The device does not support the binary protocol (use --protocol hex).")
                 sys.exit(1)
+            else:
+                stats = load_hex(ser, hex_data)
+                pages = (len(image) + serialproto.PAGE_SIZE - 1) // serialproto.PAGE_SIZE
+                stats.update(bytes=len(image), mode="full", pages=pages, pages_sent=pages,
+                             bytes_per_second=len(image) / stats["seconds"] if stats["seconds"] > 0 else 0.0)
+    except serialproto.UploadError as e:
+        print(f"Error: Failed to load data. {e.args[0]}")
+        sys.exit(1)
     except serial.SerialException as e:
         print(f"Serial communication error: {e}")
         sys.exit(1)
+    try:
+        record.store(args.port, image)
+    except OSError as e:
+        print(f"Warning: Cannot record the loaded image ({e}); the next load sends everything.", file=sys.stderr)
+    if args.json:
+        print(json.dumps({"ok": True, **stats}))
+    else:
+        print("Data loaded successfully.")
+        print(f"{stats['bytes']} bytes in {stats['seconds']:.3f} s ({stats['bytes_per_second']:.0f} bytes/s, "
+              f"{stats['protocol']} protocol, {stats['wire_bytes']} bytes sent, {stats['retries']} retries).")
+        print(f"{stats['pages_sent']} of {stats['pages']} pages of {serialproto.PAGE_SIZE} bytes sent ({stats['mode']}).")
+
+def load_hex(ser:serial.Serial, hex_data:bytes) -> dict:
+    """Text protocol of older firmware: 'l', then the Intel HEX file; waits for [OK]"""
+    started = time.perf_counter()
+    ser.write(b'l\n')  # Command to initiate loading
+    time.sleep(0.5)  # Wait for device to be ready
+    ser.write(hex_data)
+    result = b""
+    while True:
+        line = ser.readline()
+        result += line
+        if not line or b'[OK]' in line or b'[NG]' in line:
+            break
+    if b'[OK]' not in result:
+        raise serialproto.UploadError(f"Device response: {result.decode(errors='ignore')}")
+    return {"protocol": "hex", "frames": 1, "wire_bytes": len(hex_data) + 2, "retries": 0, "seconds": time.perf_counter() - started}
 
 def register(args):
     try:
@@ -75,55 +143,76 @@ def register(args):
         sys.exit(1)
 
 def trace(args):
+    if args.rate <= 0:
+        print("Error: --rate must be positive.")
+        sys.exit(1)
+    try:
+        record = tracefile.TraceWriter(args.record) if args.record else None
+    except tracefile.TraceFileError as e:
+        print(e.args[0])
+        sys.exit(1)
+    except OSError as e:
+        print(f"Error: Cannot record to '{args.record}': {e}")
+        sys.exit(1)
     try:
         with serial.Serial(args.port, args.baudrate, timeout=1) as ser:
             if not args.json:
-                print(f"Tracing execution on HC4e via {args.port} at {args.baudrate} baud...")
+                print(f"Tracing execution on HC4e via {args.port} at {args.baudrate} baud...", flush=True)
             ser.write(b't\n')  # Command to trace execution
             ser.readline()  # Discard the first line (header)
             ser.readline()  # Discard the second line (header)
-            # 士郎、僕はね、ノンブロッキングな標準入力が欲しかったんだよ
-            q = queue.Queue()
-            worker = threading.Thread(target=tracewk, args=(args.json, ser, q))
-            worker.start()
             try:
-                while worker.is_alive():
-                    com = input()
-                    if com:
-                        q.put(com)
-                    if com.strip().lower() == 'q':
-                        break
+                stats = asyncio.run(tracestream.stream(ser, sys.stdout.buffer, sys.stdin.buffer, args.json, args.rate, record))
+                if stats["skipped"]:
+                    print(f"Warning: {stats['skipped']} lines from the device were not trace records.", file=sys.stderr)
             except KeyboardInterrupt:
                 print("Trace interrupted by user.")
-                q.put('q')
-            worker.join()
+                ser.write(b'q\n')
+            ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
     except serial.SerialException as e:
         print(f"Serial communication error: {e}")
         sys.exit(1)
+    finally:
+        if record is not None:
+            record.close()
 
-def tracewk(jso:bool, ser:serial.Serial, q:queue.Queue):
+def replay(args):
+    if not args.file:
+        print("Error: --file is required.")
+        sys.exit(1)
     try:
-        while True:
-            res = ser.readline()
-            if not q.empty():
-                com = q.get()
-                ser.write(com.encode() + b'\n')
-                if com.strip().lower() == 'q':
-                    break
-            
-            if not res:
-                continue
-            regs = list(map(int, res.decode().strip().split(',')))
-            if jso:
-                print(json.dumps({"regs": regs[0:16], "pc": regs[16], "inst": regs[17]}))
-            else:
-                for i in range(16):
-                    print(f"R{i}: {regs[i]}", end='  ')
-                print()
-                print(f"PC: {regs[16]}, INST: {regs[17]}")
-        ser.write(b'\x03\n')  # Send Ctrl-C to stop tracing
-    except serial.SerialException as e:
-        print(f"Serial communication error during tracing: {e}")
+        pc = None
+        if args.pc is not None:
+            labels = {}
+            if args.source:
+                include_pathes = [os.path.dirname(os.path.abspath(args.source)), os.path.join(os.path.dirname(os.path.abspath(__file__)), "include")]
+                with open(args.source, "r", encoding="utf-8") as f:
+                    labels = simulator.load_source(f.read().splitlines(), args.architecture, include_pathes).labels
+            pc = simulator.Machine(args.architecture, labels=labels).label(args.pc)
+        with tracefile.TraceReader(args.file) as reader:
+            batch = []
+            for rec in reader.select(pc, args.start, args.end, args.limit):
+                if args.json:
+                    batch.append(json.dumps(rec, separators=(",", ":")))
+                    if len(batch) == 1000:
+                        print("[" + ",".join(batch) + "]")
+                        batch = []
+                else:
+                    print(f"#{rec['n']} t={rec['time']:.6f}s")
+                    for i in range(16):
+                        print(f"R{i}: {rec['regs'][i]}", end='  ')
+                    print()
+                    print(f"PC: {rec['pc']}, INST: {rec['inst']}")
+            if batch:
+                print("[" + ",".join(batch) + "]")
+    except FileNotFoundError as e:
+        # the assembler reports a missing include in its message, without a filename
+        print(f"Error: File '{e.filename}' not found." if e.filename else e.args[0])
+        sys.exit(1)
+    except (KeyError, ValueError, tracefile.TraceFileError) as e:
+        # the assembler, simulator and tracefile messages carry their own [Error] prefix
+        print(e.args[0] if e.args else e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
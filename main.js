@@ -17,6 +17,11 @@ let selectedComPort = null;
 let traceProcess = null;
 let traceTarget = null; // WebContents
 
+// 常駐アセンブラ（hcxasm.py --serve）管理
+let asmServer = null; // { proc, pending: Map<id, {resolve, reject}>, nextId, buffer }
+// 応答がこの時間内に返らなければ、サーバーが固まったとみなして再起動する
+const ASM_SERVER_TIMEOUT_MS = 30000;
+
 // 未保存状態の管理（webContents.id -> boolean）
 const windowDirtyState = new Map();
 
@@ -779,6 +784,107 @@ app.on('window-all-closed', () => {
   }
 });
 
+// --- 常駐アセンブラ（hcxasm.py --serve） ---
+function getHcxasmPath() {
+  return app.isPackaged
+    ? path.join(process.resourcesPath, 'app.asar.unpacked', 'hcxasm.py')
+    : path.join(__dirname, 'hcxasm.py');
+}
+
+function startAssemblerServer() {
+  if (asmServer) return asmServer;
+  const pythonCmd = resolvePythonCommand();
+  const hcxasmPath = getHcxasmPath();
+  if (!pythonCmd) throw new Error('Pythonランタイムが見つかりません。');
+  if (!fs.existsSync(hcxasmPath)) throw new Error('hcxasm.py が見つかりません。');
+
+  const proc = spawn(pythonCmd, [hcxasmPath, '--serve'], {
+    cwd: path.dirname(hcxasmPath),
+    windowsHide: true,
+    env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
+  });
+  const server = { proc, pending: new Map(), nextId: 1, buffer: '' };
+  proc.stdout.setEncoding('utf8');
+  proc.stdout.on('data', (chunk) => {
+    server.buffer += chunk;
+    let nl;
+    while ((nl = server.buffer.indexOf('\n')) >= 0) {
+      const line = server.buffer.slice(0, nl).trim();
+      server.buffer = server.buffer.slice(nl + 1);
+      if (!line) continue;
+      try {
+        const res = JSON.parse(line);
+        const waiter = server.pending.get(res.id);
+        if (waiter) {
+          server.pending.delete(res.id);
+          waiter.resolve(res);
+        }
+      } catch (e) {
+        console.error('アセンブラサーバーの応答を解析できません:', line);
+      }
+    }
+  });
+  proc.stderr.on('data', (data) => console.error('[hcxasm --serve]', data.toString()));
+  const fail = (err) => {
+    if (asmServer === server) asmServer = null;
+    for (const waiter of server.pending.values()) waiter.reject(err);
+    server.pending.clear();
+  };
+  proc.on('error', fail);
+  proc.on('close', (code) => fail(new Error(`アセンブラサーバーが終了しました (終了コード: ${code})`)));
+  asmServer = server;
+  return server;
+}
+
+function stopAssemblerServer() {
+  if (!asmServer) return;
+  const { proc } = asmServer;
+  asmServer = null;
+  try {
+    proc.stdin.end(JSON.stringify({ command: 'exit' }) + '\n');
+  } catch (_) {
+    proc.kill();
+  }
+}
+
+// 常駐アセンブラでアセンブル（一時ファイル不要）
+// session を指定すると、同じ session の前回のソースからの差分だけを再アセンブルする
+async function assembleWithServer(source, architecture, formats = [], session = undefined) {
+  if (pythonEnvPromise && pythonEnvStatus === 'preparing') {
+    await pythonEnvPromise;
+  }
+  const server = startAssemblerServer();
+  const id = server.nextId++;
+  const archArg = (architecture === 'HC4E') ? 'HC4E' : 'HC4';
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(() => {
+      if (!server.pending.delete(id)) return;
+      reject(new Error(`アセンブラサーバーが ${ASM_SERVER_TIMEOUT_MS / 1000} 秒以内に応答しませんでした。再起動します。`));
+      // 次のリクエストは新しいサーバーで処理する (残りの待機中リクエストは close で失敗する)
+      if (asmServer === server) asmServer = null;
+      server.proc.kill();
+    }, ASM_SERVER_TIMEOUT_MS);
+    server.pending.set(id, {
+      resolve: (res) => { clearTimeout(timer); resolve(res); },
+      reject: (err) => { clearTimeout(timer); reject(err); }
+    });
+    server.proc.stdin.write(JSON.stringify({ id, source, architecture: archArg, formats, session }) + '\n', 'utf8');
+  });
+}
+
+app.on('will-quit', () => {
+  stopAssemblerServer();
+});
+
+// ソースをアセンブル（常駐アセンブラ経由、ウィンドウごとのセッションで差分だけ再アセンブル）
+ipcMain.handle('assemble-source', async (event, assemblyCode, architecture, formats) => {
+  try {
+    return await assembleWithServer(assemblyCode, architecture, Array.isArray(formats) ? formats : [], `editor-${event.sender.id}`);
+  } catch (e) {
+    return { ok: false, error: e.message };
+  }
+});
+
 // デバイスへアップロード（クリーン版）
 ipcMain.handle('upload-to-device', async (event, assemblyCode, architecture) => {
   try {
@@ -806,42 +912,29 @@ ipcMain.handle('upload-to-device', async (event, assemblyCode, architecture) =>
       return [quote(cmd), ...args.map(quote)].join(' ');
     };
 
-    const asmPath = path.join(tmpDir, `va_${Date.now()}.asm`);
     const hexPath = path.join(tmpDir, `va_${Date.now()}.hex`);
-    fs.writeFileSync(asmPath, assemblyCode, 'utf8');
-
-    // 1) アセンブル（ihex）
-    const hcxasmPath = app.isPackaged
-      ? path.join(process.resourcesPath, 'app.asar.unpacked', 'hcxasm.py')
-      : path.join(__dirname, 'hcxasm.py');
-    if (!fs.existsSync(hcxasmPath)) {
-      try { fs.unlinkSync(asmPath); } catch (_) {}
-      return { success: false, error: 'hcxasm.py が見つかりません。' };
-    }
 
+    // 1) アセンブル（ihex, 常駐アセンブラ）
     const archArg = (architecture === 'HC4E') ? 'HC4E' : 'HC4';
-    const assembleArgs = [hcxasmPath, asmPath, '-o', hexPath, '-f', 'ihex', '-a', archArg, '-v'];
-    logs.push('Assembler command: ' + fmtCmd(pythonCmd, assembleArgs));
-    const asmProc = spawnSync(pythonCmd, assembleArgs, {
-      cwd: path.dirname(hcxasmPath),
-      windowsHide: true,
-      encoding: 'utf8',
-      env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
-    });
-    logs.push('Assembler exit code: ' + asmProc.status);
-    if (asmProc.stdout) logs.push('Assembler stdout:\n' + asmProc.stdout.trim());
-    if (asmProc.stderr) logs.push('Assembler stderr:\n' + asmProc.stderr.trim());
-    if (asmProc.status !== 0) {
-      try { fs.unlinkSync(asmPath); } catch (_) {}
-      return { success: false, error: `アセンブル失敗:\n${asmProc.stderr || asmProc.stdout || 'unknown error'}`, logs };
+    logs.push(`Assembler: hcxasm.py --serve (${archArg})`);
+    let asmRes;
+    try {
+      asmRes = await assembleWithServer(assemblyCode, archArg, ['ihex']);
+    } catch (e) {
+      return { success: false, error: `アセンブラを起動できません:\n${e.message}`, logs };
     }
+    if (!asmRes.ok) {
+      logs.push('Assembler error:\n' + asmRes.error);
+      return { success: false, error: `アセンブル失敗:\n${asmRes.error || 'unknown error'}`, logs };
+    }
+    logs.push(`Assembler: ${asmRes.size} bytes`);
+    fs.writeFileSync(hexPath, asmRes.ihex, 'utf8');
 
     // 2) アップロード（load4e.py）
     const loaderPath = app.isPackaged
       ? path.join(process.resourcesPath, 'app.asar.unpacked', 'load4e.py')
       : path.join(__dirname, 'load4e.py');
     if (!fs.existsSync(loaderPath)) {
-      try { fs.unlinkSync(asmPath); } catch (_) {}
       try { fs.unlinkSync(hexPath); } catch (_) {}
       return { success: false, error: 'load4e.py が見つかりません。' };
     }
@@ -859,7 +952,6 @@ ipcMain.handle('upload-to-device', async (event, assemblyCode, architecture) =>
     if (loadProc.stderr) logs.push('Loader stderr:\n' + loadProc.stderr.trim());
 
     // 後始末
-    try { fs.unlinkSync(asmPath); } catch (_) {}
     try { fs.unlinkSync(hexPath); } catch (_) {}
 
     if (loadProc.status !== 0) {
@@ -990,9 +1082,11 @@ ipcMain.handle('start-trace', async (event) => {
       for (const line of lines) {
         if (!line.trim()) continue;
         try {
+          // load4e.py は一定間隔ごとにレコードの配列をまとめて出力する。表示は最新の状態だけでよい
           const obj = JSON.parse(line);
-          if (traceTarget && !traceTarget.isDestroyed()) {
-            traceTarget.send('trace-update', obj);
+          const latest = Array.isArray(obj) ? obj[obj.length - 1] : obj;
+          if (latest && traceTarget && !traceTarget.isDestroyed()) {
+            traceTarget.send('trace-update', latest);
           }
         } catch (e) {
           if (traceTarget && !traceTarget.isDestroyed()) {
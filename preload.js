@@ -7,6 +7,7 @@ contextBridge.exposeInMainWorld('electronAPI', {
   showLabelDialog: (defaultValue) => ipcRenderer.invoke('show-label-dialog', defaultValue),
   exportAssembledBinary: (assemblyCode, architecture) => ipcRenderer.invoke('export-assembled-binary', assemblyCode, architecture),
   uploadToDevice: (assemblyCode, architecture) => ipcRenderer.invoke('upload-to-device', assemblyCode, architecture),
+  assembleSource: (assemblyCode, architecture, formats) => ipcRenderer.invoke('assemble-source', assemblyCode, architecture, formats),
   fetchRegisters: () => ipcRenderer.invoke('fetch-registers'),
   startTrace: () => ipcRenderer.invoke('start-trace'),
   stopTrace: () => ipcRenderer.invoke('stop-trace'),
@@ -1,7 +1,19 @@
+import os
 import re
-from typing import Optional
+import pickle
+import hashlib
+import tempfile
+import time
+import itertools
+import linecache
+from array import array
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Union
 from typing import Sequence
 import testfuncs
+import lexer
+from lexer import Token, opkind
 from enum import Enum, auto
 from pathlib import Path
 
@@ -19,6 +31,7 @@ DIRECTIVES = {
     ".ENDM"    : 3,
     ".INCLUDE" : 4,
     ".INC"     : 4,
+    ".ONCE"    : 5,
     ".EQU"     : 101,
 }
 
@@ -68,17 +81,73 @@ class LinkState:
             return (addr >> (int(sliced[1]) * 4)) & 0x0F
         return None
 
+class ProgramImage(Mapping):
+    """
+    Assembled program image.\n
+    Machine code lives in a bytearray and line numbers in an array('I'), one entry per address.
+    It reads like the former dict[int, tuple[int, int]] (address -> (code, lineno)).
+    """
+    def __init__(self):
+        self.code = bytearray()
+        self.linenos = array('I')
+
+    def __repr__(self) -> str:
+        return f"ProgramImage({len(self.code)} bytes)"
+
+    def __getitem__(self, address:int) -> tuple[int, int]:
+        if not 0 <= address < len(self.code):
+            raise KeyError(address)
+        return (self.code[address], self.linenos[address])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self.code)))
+
+    def __len__(self) -> int:
+        return len(self.code)
+
+    def __contains__(self, address) -> bool:
+        return isinstance(address, int) and 0 <= address < len(self.code)
+
+    def append(self, code:int, lineno:int):
+        self.code.append(code)
+        self.linenos.append(lineno)
+
+    def view(self) -> memoryview:
+        """Zero-copy, read-only view of the machine code"""
+        return memoryview(self.code).toreadonly()
+
+__version__ = "2.0.1"
+
+def resolve_include(include_filename:str, include_pathes:Sequence[str]) -> str:
+    """Path of an .INCLUDE file: first hit in include_pathes, else the name as written"""
+    for path in include_pathes:
+        potential_path = Path(path) / include_filename
+        if potential_path.exists():
+            return str(potential_path)
+    return include_filename
+
+# Source of Defines.generation values, unique across every Defines instance
+_GENERATIONS = itertools.count()
+
 class Defines:
     def __init__(self, initial_defs:Optional[dict[str, str]]=None):
         self.defines: list[dict[str, str]] = [{}]
         if initial_defs is not None:
             self.defines[0] = initial_defs
         self.level = 0
+        # number of define names replaced by substitute
+        self.substitutions = 0
+        # Changes whenever the set of visible defines changes
+        self.generation = next(_GENERATIONS)
+        # Substitution engine per scope level, built lazily and dropped on add_def/new_scope/end_scope
+        self._engines: list[Optional[tuple[Optional[re.Pattern[str]], dict[str, str]]]] = [None]
     
     def add_def(self, key:str, value:str):
         if key in self.defines[self.level]:
             raise ValueError(f"[Error] Duplicate define: {key}")
         self.defines[self.level][key] = value
+        self._engines[self.level] = None
+        self.generation = next(_GENERATIONS)
     
     def get_def(self, key:str) -> Optional[str]:
         for level in reversed(range(self.level + 1)):
@@ -90,230 +159,616 @@ class Defines:
         self.level += 1
         if len(self.defines) <= self.level:
             self.defines.append({})
+            self._engines.append(None)
+        self._engines[self.level] = None
     
     def end_scope(self):
         if self.level == 0:
             raise ValueError("[Error] No scope to end.")
-        self.defines.pop()
+        if self.defines.pop():
+            self.generation = next(_GENERATIONS)
+        self._engines.pop()
         self.level -= 1
 
     def items(self):
-        result = {}
-        for level in reversed(range(self.level + 1)):
-            result.update(self.defines[level])
-        return result.items()
+        return self._engine()[1].items()
+
+    def substitute(self, line:str) -> str:
+        """
+        Replace every define in line in a single scan.\n
+        Values referring to other defines are already expanded in the engine table.
+        """
+        pattern, table = self._engine()
+        if pattern is None:
+            return line
+        line, count = pattern.subn(lambda m: table[m.group(0)], line)
+        self.substitutions += count
+        return line
+
+    def _engine(self) -> tuple[Optional[re.Pattern[str]], dict[str, str]]:
+        level = self.level
+        # An empty scope sees exactly what its parent sees
+        while level > 0 and not self.defines[level]:
+            level -= 1
+        engine = self._engines[level]
+        if engine is None:
+            engine = self._build_engine(level)
+            self._engines[level] = engine
+        return engine
+
+    def _build_engine(self, level:int) -> tuple[Optional[re.Pattern[str]], dict[str, str]]:
+        merged: dict[str, str] = {}
+        for scope in self.defines[:level + 1]:
+            merged.update(scope)
+        if not merged:
+            return (None, {})
+        keys = sorted(merged, key=len, reverse=True)
+        pattern = re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keys) + r")\b")
+
+        table: dict[str, str] = {}
+        active: set[str] = set()
+        def resolve(key:str) -> str:
+            if key in table:
+                return table[key]
+            if key in active:
+                # self reference: keep the name as is
+                return key
+            active.add(key)
+            value = pattern.sub(lambda m: resolve(m.group(0)), merged[key])
+            active.discard(key)
+            table[key] = value
+            return value
+        for key in merged:
+            resolve(key)
+        return (pattern, table)
+
+class MacroTemplate:
+    """
+    Macro body parsed once at .MACRO time.\n
+    Each body line is split into literal parts and parameter slots, so an expansion
+    only has to join the arguments in without any regex work.
+    """
+    def __init__(self, name:str, lines:list[str], params:list[str]):
+        self.name = name
+        self.lines = lines
+        self.params = params
+        # True if the body defines something, in which case it is expanded in its own scope
+        self.has_defs = False
+        slot_of = {p: i for i, p in enumerate(params)}
+        pattern = re.compile(r"\b(" + "|".join(re.escape(p) for p in params) + r")\b") if params else None
+        # (literal parts, slots, unprocessed line, raw) per body line
+        self.body: list[tuple[list[str], list[int], str, bool]] = []
+        for line in lines:
+            unprocessed = line.strip()
+            clean = lexer.strip_comment(unprocessed)
+            tok = clean.split()
+            directive = DIRECTIVES.get(tok[0].upper()) if tok else None
+            if directive == 3:
+                break
+            if directive is not None:
+                # directive lines are handed over as written
+                self.has_defs = self.has_defs or directive == 1
+                self.body.append(([clean], [], unprocessed, True))
+                continue
+            parts = pattern.split(clean) if pattern is not None else [clean]
+            self.body.append((parts[0::2], [slot_of[p] for p in parts[1::2]], unprocessed, False))
+        # (Defines.generation, literal parts with defines applied) per body line.
+        # Stored as one tuple so that concurrent expansions never see a torn entry.
+        self._resolved: list[tuple[int, list[str]]] = [(-1, [])] * len(self.body)
+
+    def expand(self, args:Sequence[str], defines:Defines, lineno:int) -> Iterator[tuple[str, int, str, bool]]:
+        """
+        Yield (line, lineno, unprocessed_line, substituted) for each body line.\n
+        Literal parts are resolved against defines once per define generation.
+        """
+        args = [defines.substitute(a) for a in args]
+        for index, (literals, slots, unprocessed, raw) in enumerate(self.body):
+            if raw:
+                yield (literals[0], lineno, unprocessed, False)
+                continue
+            generation, resolved = self._resolved[index]
+            if generation != defines.generation:
+                resolved = [defines.substitute(lit) for lit in literals]
+                self._resolved[index] = (defines.generation, resolved)
+            line = resolved[0]
+            for slot, literal in zip(slots, resolved[1:]):
+                line += args[slot] + literal
+            yield (line, lineno, unprocessed, True)
 
 class Macros:
     def __init__(self, initial_macros:Optional[dict[str, tuple[list[str], list[str]]]]=None):
-        self.macros: dict[str, tuple[list[str], list[str]]] = initial_macros if initial_macros is not None else {}
+        self.macros: dict[str, MacroTemplate] = {}
+        if initial_macros is not None:
+            for name, (lines, params) in initial_macros.items():
+                self.add_macro(name, lines, params)
     
     def add_macro(self, name:str, lines:list[str], params:list[str]):
         if name in self.macros:
             raise ValueError(f"[Error] Duplicate macro definition: {name}")
-        self.macros[name] = (lines, params)
+        self.macros[name] = MacroTemplate(name, lines, params)
     
-    def get_macro(self, name:str) -> Optional[tuple[list[str], list[str]]]:
+    def get_macro(self, name:str) -> Optional[MacroTemplate]:
         return self.macros.get(name, None)
 
-def assemble(code:Sequence[tuple[str, int]], ls:LinkState, arch:str) -> dict[int, tuple[int, int]]:
+JMP_FLAGS = {"C" : 0x02, "NC" : 0x03, "Z" : 0x04, "NZ" : 0x05, }
+
+def emit(code:Sequence[Union[Token, tuple[str, int]]], ls:LinkState, arch:str, machine_code:ProgramImage, base:int=0, on_error:Optional[Callable[[Exception, Token], None]]=None):
     """
-    Assemble HC4 assembly code into machine code.\n
-    Input: list of tuples (line:str, lineno:int)\n
-    Output: list of tuples (machine_code:int, lineno:int)
+    Encode code onto the end of machine_code without resolving label references.\n
+    Labels and label references are recorded in ls at base + their offset in machine_code.
+    With on_error, a line that fails is handed to it instead of raising and assembles to 0.
     """
     global INST_DICT_M
     global INST_TYPES
-    JMP_FLAGS = {"C" : 0x02, "NC" : 0x03, "Z" : 0x04, "NZ" : 0x05, }
 
     INST_DICT = INST_DICT_M.get(arch)
     if INST_DICT is None:
         raise KeyError(f"[Error] Unsupported architecture: {arch}")
-    
-    # (address : (code, linenum))
-    machine_code: dict[int, tuple[int, int]] = {}
-    
-    address = 0
-    for line, lineno in code:
-        if line.strip() == "":
-            continue
-        tok = line.strip().split(" ")
-
-        if tok[0].upper().endswith(":"):
-            label = tok[0].upper()[:-1]
-            tok.pop(0)
-            ls.add_label(label, len(machine_code))
-            if len(tok) == 0:
-                continue
+    # mnemonic -> (opcode, insttype)
+    table = {name: (opcode, INST_TYPES.get(name)) for name, opcode in INST_DICT.items()}
 
-        opcode = INST_DICT.get(tok[0].upper())
-        if opcode is None:
-            raise KeyError(f"[Error] Invalid instruction: {tok[0]} in line {lineno}")
-
-        # assemble lines
-        match INST_TYPES.get(tok[0].upper()):
-            case None:
-                raise KeyError(f"[Error] Oops! : {tok[0]} is found in INST_DICT but not in INST_TYPES")
-            case insttype.INHERENT:
-                machine_code[address] = ((opcode, lineno))
-                address += 1
-            case insttype.REGISTER:
-                oprand = int(re.findall(r"[rR]([0-9]*)", tok[1])[0])
-                if oprand > 15:
-                    raise ValueError(f"Too big register designator : {oprand} in line {lineno}")
-                machine_code[address] = ((opcode + oprand, lineno))
-                address += 1
-            case insttype.IMMEDIATE:
-                label = re.findall(r"#([A-Za-z_][A-Za-z0-9_]*:[0-3])", tok[1])
-                if label:
-                    ls.add_unresolved(label[0], len(machine_code))
-                    machine_code[address] = ((opcode, lineno))
-                    address += 1
+    address = base + len(machine_code)
+    for tok in lexer.as_tokens(code):
+        lineno = tok.lineno
+        try:
+            if tok.label is not None:
+                ls.add_label(tok.label, address)
+                if tok.mnemonic is None:
                     continue
-                try:
-                    # print(tok[1])
-                    # print(re.findall(r"#((0x|0b)?[0-9a-fA-F]+)", tok[1])[0][0])
-                    oprand = int(re.findall(r"#((0x|0b)?[0-9a-fA-F]+)", tok[1])[0][0], 0)
-                except ValueError:
-                    raise ValueError(f"Invalid immediate value : {tok[1]} in line {lineno}")
-                if oprand > 15:
-                    raise ValueError(f"Too big immediate value : {oprand} in line {lineno}")
-                if oprand < 0:
-                    raise ValueError(f"Negative immediate value : {oprand} in line {lineno}")
-                machine_code[address] = ((opcode + oprand, lineno))
-                address += 1
-            case insttype.JUMP:
-                if len(tok) == 1:
-                    machine_code[address] = ((opcode, lineno))
-                    address += 1
-                else:
-                    flag = tok[1].upper()
-                    if flag not in JMP_FLAGS:
-                        raise ValueError(f"Invalid jump flag : {flag} in line {lineno}")
-                    machine_code[address] = ((opcode + JMP_FLAGS[flag], lineno))
-                    address += 1
-
-    # print(ls)
 
+            entry = table.get(tok.mnemonic)  # type: ignore[arg-type]
+            if entry is None:
+                raise KeyError(f"[Error] Invalid instruction: {tok.mnemonic} in line {lineno}")
+            opcode, itype = entry
+
+            # assemble lines
+            match itype:
+                case None:
+                    raise KeyError(f"[Error] Oops! : {tok.mnemonic} is found in INST_DICT but not in INST_TYPES")
+                case insttype.INHERENT:
+                    machine_code.append(opcode, lineno)
+                case insttype.REGISTER:
+                    if tok.kind is not opkind.REGISTER:
+                        raise ValueError(f"Invalid register operand : {tok.operand} in line {lineno}")
+                    oprand = tok.value
+                    assert oprand is not None
+                    if oprand > 15:
+                        raise ValueError(f"Too big register designator : {oprand} in line {lineno}")
+                    machine_code.append(opcode + oprand, lineno)
+                case insttype.IMMEDIATE:
+                    if tok.kind is opkind.LABEL:
+                        assert tok.operand is not None
+                        ls.add_unresolved(tok.operand, address)
+                        machine_code.append(opcode, lineno)
+                        address += 1
+                        continue
+                    if tok.kind is not opkind.IMMEDIATE:
+                        raise ValueError(f"Invalid immediate value : {tok.operand} in line {lineno}")
+                    oprand = tok.value
+                    assert oprand is not None
+                    if oprand > 15:
+                        raise ValueError(f"Too big immediate value : {oprand} in line {lineno}")
+                    if oprand < 0:
+                        raise ValueError(f"Negative immediate value : {oprand} in line {lineno}")
+                    machine_code.append(opcode + oprand, lineno)
+                case insttype.JUMP:
+                    if tok.operand is None:
+                        machine_code.append(opcode, lineno)
+                    else:
+                        flag = tok.operand.upper()
+                        if flag not in JMP_FLAGS:
+                            raise ValueError(f"Invalid jump flag : {flag} in line {lineno}")
+                        machine_code.append(opcode + JMP_FLAGS[flag], lineno)
+        except (KeyError, ValueError) as e:
+            if on_error is None:
+                raise
+            on_error(e, tok)
+            # keep the addresses the preprocessor counted
+            if tok.mnemonic not in INST_TYPES:
+                continue
+            machine_code.append(0, lineno)
+        address += 1
+
+def link(ls:LinkState, machine_code:ProgramImage, on_error:Optional[Callable[[Exception, int], None]]=None):
+    """
+    Patch every label reference in ls.unresolved into machine_code.\n
+    With on_error, undefined labels are handed to it with their address instead of raising.
+    """
     for addr, label in ls.unresolved.items():
         value = ls.parse_label(label)
         if value is None:
-            raise KeyError(f"[Error] Undefined label: {label}")
-        machine_code[addr] = (machine_code[addr][0] + value, machine_code[addr][1])
+            e = KeyError(f"[Error] Undefined label: {label}")
+            if on_error is None:
+                raise e
+            on_error(e, addr)
+            continue
+        machine_code.code[addr] += value
+
+def assemble(code:Sequence[Union[Token, tuple[str, int]]], ls:LinkState, arch:str) -> ProgramImage:
+    """
+    Assemble HC4 assembly code into machine code.\n
+    Input: list of Token, or of tuples (line:str, lineno:int) which are lexed on the fly\n
+    Output: ProgramImage (address -> (machine_code:int, lineno:int))
+    """
+    machine_code = ProgramImage()
+    emit(code, ls, arch, machine_code)
+    link(ls, machine_code)
     return machine_code
 
-address = 0
+def _source_lines(lines:Sequence[str], lineno_start:int, fixed_lineno:bool) -> Iterator[tuple[str, int, str, bool]]:
+    for i, line in enumerate(lines, start=1):
+        unprocessed_line = line.strip()
+        yield (lexer.strip_comment(unprocessed_line), lineno_start if fixed_lineno else lineno_start + i, unprocessed_line, False)
 
-def preprocess(lines:Sequence[str], child:bool, lineno_start:int, include_pathes:list[str], defines:Defines=Defines(), macros:Macros=Macros()) -> list[tuple[str, int, str, int]]:
+class IncludeCache:
     """
-    preprocessor for assembly code: remove comments and empty lines
-    Input: list of lines (str)
-    Output: list of tuples (line:str, lineno:int, unprocessed_line:str, address:int)
+    Include files parsed into preprocessor input, shared by the jobs of one process.\n
+    Entries are checked against the file's mtime and size; with a directory they are
+    also kept on disk, so later runs skip reading and parsing unchanged headers.
     """
-    global DIRECTIVES
-    global INST_TYPES
-    global address
-    # (line:str, lineno:int, unprocessed_line:str, address:int)
-    processed: list[tuple[str, int, str, int]] = []
-    i = 0
-    lineno = lineno_start
-    # print(address)
-    while i < len(lines):
-        i += 1
-        line = lines[i - 1].strip()
-        if not child:
-            lineno = i
-        # remove comments
-        unprocessed_line = line
-        line = re.sub(r";.*$", "", line)
-        tok = line.strip().split(" ")
-        directive = DIRECTIVES.get(tok[0].upper(), None)
-        if directive == 1:  # .DEF or .DEFINE
-            if len(tok) < 3:
-                raise ValueError(f"[Error] Invalid .DEF or .DEFINE directive at line {lineno}")
-            defines.add_def(tok[1], " ".join(tok[2:]))
-            processed.append(("", lineno, unprocessed_line, address))
-            continue
-        elif directive == 2:  # .MACRO
-            if child:
-                raise ValueError(f"[Error] Nested macros are not supported (line {lineno})")
-            if len(tok) < 2:
-                raise ValueError(f"[Error] Invalid .MACRO directive at line {lineno}")
-            macro_name = tok[1].upper()
-            params = tok[2:] if len(tok) > 2 else []
-            macro_lines: list[str] = []
-            processed.append(("", lineno, unprocessed_line, address))
-            for macro_lineno, macro_line in enumerate(lines[i:], start=i + 1):
-                macro_line_clean = re.sub(r";.*$", "", macro_line)
-                macro_line = macro_line.strip()
-                macro_lines.append(macro_line)
-                processed.append(("", macro_lineno, macro_line, address))
-                if macro_line_clean.strip().upper().startswith((".ENDMACRO", ".ENDM")):
-                    break
+    def __init__(self, directory:Optional[str]=None):
+        self.directory = Path(directory) if directory else None
+        # path -> ((mtime_ns, size), parsed lines)
+        self.files: dict[str, tuple[tuple[int, int], list[tuple[str, int, str, bool]]]] = {}
+        # number of files read from their source
+        self.reads = 0
+
+    def __repr__(self) -> str:
+        return f"IncludeCache(files={len(self.files)}, reads={self.reads})"
+
+    def get(self, path:str) -> list[tuple[str, int, str, bool]]:
+        """Parsed lines (line, lineno, unprocessed_line, False) of path. Raises FileNotFoundError."""
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self.files.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        items = self._load(path, stamp)
+        if items is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                items = list(_source_lines(f.readlines(), 0, False))
+            self.reads += 1
+            self._store(path, stamp, items)
+        self.files[path] = (stamp, items)
+        return items
+
+    def _disk_path(self, path:str) -> Path:
+        assert self.directory is not None
+        return self.directory / (hashlib.sha256(os.path.abspath(path).encode()).hexdigest() + ".pickle")
+
+    def _load(self, path:str, stamp:tuple[int, int]) -> Optional[list[tuple[str, int, str, bool]]]:
+        if self.directory is None:
+            return None
+        try:
+            with open(self._disk_path(path), 'rb') as f:
+                saved_stamp, items = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        return items if saved_stamp == stamp else None
+
+    def _store(self, path:str, stamp:tuple[int, int], items:list[tuple[str, int, str, bool]]):
+        if self.directory is None:
+            return
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((stamp, items), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._disk_path(path))
+        except OSError:
+            pass  # the on-disk copy is only an optimization
+
+class Diagnostic:
+    """
+    One error found while assembling.\n
+    file   : source file, None for an unnamed top-level input\n
+    line   : line number in file; for macro expansions the line of the invocation\n
+    column : 1-based column of the offending text\n
+    chain  : where the line came from, innermost first: (kind "macro" | "include", name, file, line)
+    """
+    def __init__(self, message:str, file:Optional[str], line:int, column:int=1, chain:Sequence[tuple[str, str, Optional[str], int]]=(), severity:str="error"):
+        self.severity = severity
+        self.message = message
+        self.file = file
+        self.line = line
+        self.column = column
+        self.chain = list(chain)
+
+    def __repr__(self) -> str:
+        return f"Diagnostic({self.severity}, {self.file}:{self.line}:{self.column}, {self.message!r}, chain={self.chain})"
+
+    def __str__(self) -> str:
+        text = f"[{self.severity.capitalize()}] {self.file or '<input>'}:{self.line}:{self.column}: {self.message}"
+        for kind, name, file, line in self.chain:
+            text += f"\n    in {kind} {name} at {file or '<input>'}:{line}"
+        return text
+
+    def to_dict(self) -> dict:
+        return {
+            "severity": self.severity,
+            "message": self.message,
+            "file": self.file,
+            "line": self.line,
+            "column": self.column,
+            "chain": [{"kind": kind, "name": name, "file": file, "line": line} for kind, name, file, line in self.chain],
+        }
+
+def _message(e:Exception) -> str:
+    """Exception text without the [Error] prefix"""
+    text = str(e.args[0]) if e.args else str(e)
+    return text[len("[Error] "):] if text.startswith("[Error] ") else text
+
+class Assembler:
+    """
+    One assembly job.\n
+    Owns the running address, defines, macros, LinkState and results, so jobs share no state
+    and separate jobs can run on different threads at the same time.
+    With collect=True errors do not stop the job; they are gathered in diagnostics instead.
+    """
+    def __init__(self, arch:str="HC4", include_pathes:Optional[list[str]]=None, defines:Optional[Defines]=None, macros:Optional[Macros]=None, include_cache:Optional[IncludeCache]=None, filename:Optional[str]=None, collect:bool=False):
+        self.arch = arch
+        # name of the top-level source, for diagnostics
+        self.filename = filename
+        self.collect = collect
+        self.diagnostics: list[Diagnostic] = []
+        # (lineno_start, lines) of each preprocess call, to find columns in the original text
+        self._sources: list[tuple[int, Sequence[str]]] = []
+        # processed index -> (file, chain) of tokens from include files and macros, when collecting
+        self._origins: dict[int, tuple[Optional[str], list[tuple[str, str, Optional[str], int]]]] = {}
+        self.include_pathes: list[str] = list(include_pathes) if include_pathes is not None else []
+        # parsed include files; may be shared by the jobs of one process
+        self.include_cache = include_cache if include_cache is not None else IncludeCache()
+        # .INCLUDE operand -> resolved path, for this job
+        self.include_files: dict[str, str] = {}
+        # files that declared .ONCE
+        self.once_files: set[str] = set()
+        self.defines = defines if defines is not None else Defines()
+        self.macros = macros if macros is not None else Macros()
+        self.ls = LinkState()
+        self.address = 0
+        # (line:str, lineno:int, unprocessed_line:str, address:int)
+        self.processed: list[tuple[str, int, str, int]] = []
+        # Token of every non-empty processed line
+        self.tokens: list[Token] = []
+        self.image: Optional[ProgramImage] = None
+        # counters and seconds spent per stage, see stats()
+        self.lines_in = 0
+        self.macro_expansions = 0
+        self.includes = 0
+        self._include_reads = self.include_cache.reads
+        self.timings: dict[str, float] = {"preprocess": 0.0, "assemble": 0.0, "link": 0.0}
+
+    def __repr__(self) -> str:
+        return f"Assembler(arch={self.arch}, address={self.address}, lines={len(self.processed)})"
+
+    def preprocess(self, lines:Sequence[str], child:bool=False, lineno_start:int=0) -> list[tuple[str, int, str, int]]:
+        """
+        preprocessor for assembly code: remove comments and empty lines
+        Input: list of lines (str)
+        Output: list of tuples (line:str, lineno:int, unprocessed_line:str, address:int), accumulated over calls
+        """
+        # (line:str, lineno:int, unprocessed_line:str, address:int)
+        processed = self.processed
+        started = time.perf_counter()
+        self.lines_in += len(lines)
+        if self.collect:
+            self._sources.append((lineno_start, lines))
+        # Included files and macro expansions are pushed here instead of recursing.
+        # (source, macro being expanded or None, file being read or None, line that pushed it)
+        stack: list[tuple[Iterator[tuple[str, int, str, bool]], Optional[MacroTemplate], Optional[str], int]] = [
+            (_source_lines(lines, lineno_start, child), None, None, 0)
+        ]
+        while stack:
+            source, _, filename, _ = stack[-1]
+            item = next(source, None)
+            if item is None:
+                _, expanded_macro, _, _ = stack.pop()
+                if expanded_macro is not None and expanded_macro.has_defs:
+                    self.defines.end_scope()
+                continue
+            line, lineno, unprocessed_line, substituted = item
+            try:
+                tok = line.split()
+                directive = DIRECTIVES.get(tok[0].upper(), None) if tok else None
+                if directive == 1:  # .DEF or .DEFINE
+                    if len(tok) < 3:
+                        raise ValueError(f"[Error] Invalid .DEF or .DEFINE directive at line {lineno}")
+                    self.defines.add_def(tok[1], " ".join(tok[2:]))
+                    processed.append(("", lineno, unprocessed_line, self.address))
+                    continue
+                elif directive == 2:  # .MACRO
+                    if child or any(m is not None for _, m, _, _ in stack):
+                        raise ValueError(f"[Error] Nested macro definitions are not supported (line {lineno})")
+                    if len(tok) < 2:
+                        raise ValueError(f"[Error] Invalid .MACRO directive at line {lineno}")
+                    macro_name = tok[1].upper()
+                    params = tok[2:] if len(tok) > 2 else []
+                    macro_lines: list[str] = []
+                    processed.append(("", lineno, unprocessed_line, self.address))
+                    for macro_line_clean, macro_lineno, macro_line, _ in source:
+                        macro_lines.append(macro_line)
+                        processed.append(("", macro_lineno, macro_line, self.address))
+                        macro_tok = macro_line_clean.split()
+                        if macro_tok and DIRECTIVES.get(macro_tok[0].upper()) == 3:
+                            break
+                    else:
+                        raise ValueError(f"[Error] Missing .ENDMACRO directive for macro {macro_name}")
+                    self.macros.add_macro(macro_name, macro_lines, params)
+                    continue
+                elif directive == 3:  # .ENDMACRO or .ENDM
+                    raise ValueError(f"[Error] .ENDMACRO without .MACRO at line {lineno}")
+                elif directive == 4:  # .INCLUDE or .INC
+                    processed.append(("", lineno, line, self.address))
+                    if len(tok) < 2:
+                        raise ValueError(f"[Error] Invalid .INCLUDE or .INC directive at line {lineno}")
+                    include_name = tok[1].strip('"')
+                    include_filename = self.include_files.get(include_name)
+                    if include_filename is None:
+                        include_filename = os.path.abspath(resolve_include(include_name, self.include_pathes))
+                        self.include_files[include_name] = include_filename
+                    if include_filename in self.once_files:
+                        continue
+                    try:
+                        include_items = self.include_cache.get(include_filename)
+                    except FileNotFoundError:
+                        raise FileNotFoundError(f"[Error] Included file not found: {include_name} (line {lineno})")
+                    self.includes += 1
+                    self.lines_in += len(include_items)
+                    stack.append((iter(include_items), None, include_filename, lineno))
+                    continue
+                elif directive == 5:  # .ONCE
+                    processed.append(("", lineno, unprocessed_line, self.address))
+                    if filename is not None:
+                        self.once_files.add(filename)
+                    continue
+
+                # replace defines
+                if not substituted:
+                    line = self.defines.substitute(line)
+                    tok = line.split()
+
+                macro = self.macros.get_macro(tok[0].upper()) if tok else None
+                if macro is not None:
+                    macro_args = tok[1:]
+                    processed.append(("", lineno, "; " + unprocessed_line + " [MACRO]", self.address))
+                    if len(macro_args) != len(macro.params):
+                        raise ValueError(f"[Error] Macro {macro.name} expects {len(macro.params)} arguments, got {len(macro_args)} (line {lineno})")
+                    if any(m is macro for _, m, _, _ in stack):
+                        raise ValueError(f"[Error] Recursive macro invocation: {macro.name} (line {lineno})")
+                    if macro.has_defs:
+                        self.defines.new_scope()
+                    self.macro_expansions += 1
+                    stack.append((macro.expand(macro_args, self.defines, lineno), macro, None, lineno))
+                    continue
+            except (KeyError, ValueError, FileNotFoundError) as e:
+                if not self.collect:
+                    raise
+                self._report(e, lineno, None, *self._origin(stack))
+                continue
+
+            token = lexer.lex_line(line, lineno, len(processed))
+            if self.collect and len(stack) > 1 and token is not None:
+                self._origins[len(processed)] = self._origin(stack)
+            processed.append((line, lineno, unprocessed_line, self.address))
+            if token is None:
+                continue
+            self.tokens.append(token)
+            if token.mnemonic in INST_TYPES:
+                self.address += 1
+
+        self.timings["preprocess"] += time.perf_counter() - started
+        return processed
+
+    def _origin(self, stack:Sequence[tuple[Iterator, Optional[MacroTemplate], Optional[str], int]]) -> tuple[Optional[str], list[tuple[str, str, Optional[str], int]]]:
+        """(file, chain) of the line being read from the top of stack"""
+        files = [self.filename]
+        for _, _, filename, _ in stack[1:]:
+            files.append(filename if filename is not None else files[-1])
+        chain: list[tuple[str, str, Optional[str], int]] = []
+        for i in range(len(stack) - 1, 0, -1):
+            _, macro, filename, origin = stack[i]
+            if macro is not None:
+                chain.append(("macro", macro.name, files[i - 1], origin))
             else:
-                raise ValueError(f"[Error] Missing .ENDMACRO directive for macro {macro_name}")
-            macros.add_macro(macro_name, macro_lines, params)
-            i = macro_lineno
-            continue
-        elif directive == 3 and child:  # .ENDMACRO or .ENDM
-            return processed
-        elif directive == 4:  # .INCLUDE or .INC
-            processed.append(("", lineno, line, address))
-            if len(tok) < 2:
-                raise ValueError(f"[Error] Invalid .INCLUDE or .INC directive at line {lineno}")
-            include_filename = tok[1].strip('"')
-            for path in include_pathes:
-                potential_path = Path(path) / include_filename
-                if potential_path.exists():
-                    include_filename = str(potential_path)
+                chain.append(("include", os.path.basename(filename or ""), files[i - 1], origin))
+        return (files[-1], chain)
+
+    def _column(self, file:Optional[str], lineno:int, chain:Sequence[tuple[str, str, Optional[str], int]], text:Optional[str]) -> int:
+        """1-based column of text (or of the first word) in the original source line"""
+        source_line = ""
+        if file is not None and (chain or file != self.filename):
+            linecache.checkcache(file)
+            source_line = linecache.getline(file, lineno)
+        else:
+            for start, lines in self._sources:
+                if start < lineno <= start + len(lines):
+                    source_line = lines[lineno - start - 1]
                     break
-            try:
-                with open(include_filename, 'r', encoding='utf-8') as f:
-                    include_lines = f.readlines()
-                res = preprocess(include_lines, child, 0, include_pathes, defines, macros)
-                processed.extend(res)
-            except FileNotFoundError:
-                raise FileNotFoundError(f"[Error] Included file not found: {include_filename} (line {lineno})")
-            continue
-        
-        line = line.replace("\t", " ").strip()
-        for def_key, def_value in defines.items():
-            line = re.sub(rf"\b{re.escape(def_key)}\b", def_value, line)
-        # replace defines
-
-        if tok and macros.get_macro(tok[0].upper()) is not None and not child:
-            macro_name = tok[0].upper()
-            macro_args = tok[1:] if len(tok) > 1 else []
-            macro_def = macros.get_macro(macro_name)
-            if macro_def is None:
-                raise KeyError(f"[Error] Macro {macro_name} not found (line {lineno})")
-            macro_lines, params = macro_def
-            processed.append(("", lineno, "; " + unprocessed_line + " [MACRO]", address))
-            if len(macro_args) != len(params):
-                raise ValueError(f"[Error] Macro {macro_name} expects {len(params)} arguments, got {len(macro_args)} (line {lineno})")
-            defines.new_scope()
-            for p, a in zip(params, macro_args):
-                defines.add_def(p, a)
-            res = preprocess(macro_lines, True, i, include_pathes, defines, macros)
-            processed.extend(res)
-            defines.end_scope()
-            continue
+        source_line = source_line.split(";", 1)[0].rstrip("\r\n")
+        if text:
+            index = source_line.upper().find(text.upper())
+            if index >= 0:
+                return index + 1
+        return len(source_line) - len(source_line.lstrip()) + 1
+
+    def _report(self, e:Exception, lineno:int, text:Optional[str], file:Optional[str], chain:list[tuple[str, str, Optional[str], int]]):
+        self.diagnostics.append(Diagnostic(_message(e), file, lineno, self._column(file, lineno, chain, text), chain))
+
+    def _report_token(self, e:Exception, tok:Token):
+        file, chain = self._origins.get(tok.index, (self.filename, []))
+        if tok.label is not None and "Duplicate label" in str(e):
+            text = tok.label
+        elif isinstance(e, KeyError) or tok.operand is None:
+            text = tok.mnemonic
+        else:
+            text = tok.operand
+        self._report(e, tok.lineno, text, file, chain)
 
+    def assemble(self) -> ProgramImage:
+        """Assemble everything preprocessed so far"""
+        started = time.perf_counter()
+        image = ProgramImage()
+        emit(self.tokens, self.ls, self.arch, image, on_error=self._report_token if self.collect else None)
+        emitted = time.perf_counter()
+        # label reference address -> Token
+        sites: dict[int, Token] = {}
+        def report_fixup(e:Exception, addr:int):
+            if not sites:
+                sites.update(enumerate(t for t in self.tokens if t.mnemonic in INST_TYPES))
+            tok = sites[addr]
+            file, chain = self._origins.get(tok.index, (self.filename, []))
+            self._report(e, tok.lineno, (tok.operand or "").split(":")[0], file, chain)
+        link(self.ls, image, on_error=report_fixup if self.collect else None)
+        self.timings["assemble"] += emitted - started
+        self.timings["link"] += time.perf_counter() - emitted
+        self.image = image
+        return image
 
-        processed.append((line, lineno, unprocessed_line, address))
-        if tok[0].upper() in INST_TYPES:
-            address += 1
+    def stats(self) -> dict:
+        """Counters of this job and the seconds spent in each stage"""
+        return {
+            "lines_in": self.lines_in,
+            "lines_out": len(self.processed),
+            "macro_expansions": self.macro_expansions,
+            "define_substitutions": self.defines.substitutions,
+            "includes": self.includes,
+            "include_reads": self.include_cache.reads - self._include_reads,
+            "unresolved_fixups": len(self.ls.unresolved),
+            "bytes": len(self.image) if self.image is not None else 0,
+            "timings": dict(self.timings),
+        }
 
+    def run(self, lines:Sequence[str]) -> ProgramImage:
+        self.preprocess(lines)
+        return self.assemble()
+
+def preprocess(lines:Sequence[str], child:bool, lineno_start:int, include_pathes:list[str], defines:Optional[Defines]=None, macros:Optional[Macros]=None, tokens:Optional[list[Token]]=None) -> list[tuple[str, int, str, int]]:
+    """
+    preprocessor for assembly code: remove comments and empty lines
+    Input: list of lines (str)
+    Output: list of tuples (line:str, lineno:int, unprocessed_line:str, address:int)
+    Runs as a fresh Assembler job; defines and macros are only shared if passed in.
+    If tokens is given, the Token of every non-empty output line is appended to it, ready for assemble.
+    """
+    job = Assembler(include_pathes=include_pathes, defines=defines, macros=macros)
+    processed = job.preprocess(lines, child, lineno_start)
+    if tokens is not None:
+        tokens.extend(job.tokens)
     return processed
 
-def adrlist2bitstream(adrlist:dict[int, tuple[int, int]], filler:int=255) -> list[int]:
-    t1 = [code for addr, (code, lineno) in adrlist.items()]
-    if len(t1) == 0:
-        return []
-    max_addr = max(adrlist.keys())
-    bitstream = [filler] * (max_addr + 1)
+def adrlist2bitstream(adrlist:Mapping, filler:int=255) -> memoryview:
+    """
+    Flat machine code from address 0 up to the highest used address.\n
+    A ProgramImage is returned as a zero-copy view; gaps of other mappings are set to filler.
+    """
+    if isinstance(adrlist, ProgramImage):
+        return adrlist.view()
+    if len(adrlist) == 0:
+        return memoryview(b"")
+    bitstream = bytearray([filler]) * (max(adrlist.keys()) + 1)
     for addr, (code, lineno) in adrlist.items():
         bitstream[addr] = code
-    return bitstream
+    return memoryview(bitstream).toreadonly()
 
 def self_test():
     testfuncs.expect({0:(0x00, 1), 1:(0x1A, 2), 2:(0x2F, 3), 3:(0xA5, 4), 4:(0xE3, 5), 5:(0xE0, 6)}, assemble, [
@@ -350,9 +805,84 @@ def self_test():
     )
     print(processed)
     testfuncs.expect({0:(0x91, 6), 1:(0x92, 6), 2:(0x31, 6), 3:(0xE0, 7)}, assemble, processed, LinkState(), "HC4")
+    processed = tuple((pl[0], pl[1]) for pl in preprocess(
+        """.MACRO MOV dst src
+        LD src
+        SA dst
+        .ENDM
+        .MACRO SWAP a b tmp
+        MOV tmp a
+        MOV a b
+        MOV b tmp
+        .ENDM
+        SWAP r1 r2 r3
+        """.splitlines(), False, 0, [], Defines(), Macros())
+    )
+    testfuncs.expect({0:(0x91, 10), 1:(0x73, 10), 2:(0x92, 10), 3:(0x71, 10), 4:(0x93, 10), 5:(0x72, 10)}, assemble, processed, LinkState(), "HC4")
+    testfuncs.expect_raises(ValueError, preprocess, [".MACRO LOOP", "LOOP", ".ENDM", "LOOP"], False, 0, [], Defines(), Macros())
+    defs = Defines({"OUTA": "r14", "SRC": "OUTA"})
+    testfuncs.expect("LD r14", defs.substitute, "LD SRC")
+    defs.new_scope()
+    defs.add_def("SRC", "r3")
+    testfuncs.expect("LD r3 ; OUTA_X", defs.substitute, "LD SRC ; OUTA_X")
+    defs.end_scope()
+    testfuncs.expect("SA r14", defs.substitute, "SA SRC")
+    image = assemble([("LI #3", 1), ("JP", 2)], LinkState(), "HC4")
+    testfuncs.expect(b"\xA3\xE0", lambda m: bytes(adrlist2bitstream(m)), image)
+    testfuncs.expect(b"\x90\xFF\xE0", lambda m: bytes(adrlist2bitstream(m)), {0:(0x90, 1), 2:(0xE0, 2)})
+    # a header with .ONCE is read and expanded only once
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "regs.inc"), 'w', encoding='utf-8') as f:
+            f.write(".ONCE\n.DEF ACC r1\n")
+        with open(os.path.join(tmp, "sub.inc"), 'w', encoding='utf-8') as f:
+            f.write('.INC "regs.inc"\nLD ACC\n')
+        cache = IncludeCache(os.path.join(tmp, "cache"))
+        source = ['.INC "regs.inc"', '.INC "sub.inc"', '.INC "sub.inc"', 'SA ACC']
+        testfuncs.expect({0:(0x91, 2), 1:(0x91, 2), 2:(0x71, 4)}, lambda: Assembler("HC4", [tmp], include_cache=cache).run(source))
+        testfuncs.expect(2, lambda: cache.reads)
+        # a second process finds the parsed headers on disk
+        cache = IncludeCache(os.path.join(tmp, "cache"))
+        testfuncs.expect({0:(0x91, 2), 1:(0x91, 2), 2:(0x71, 4)}, lambda: Assembler("HC4", [tmp], include_cache=cache).run(source))
+        testfuncs.expect(0, lambda: cache.reads)
+    # jobs share nothing, so they can run side by side
+    sources = [[".DEF REG r%d" % i, "LOOP:", "LD REG", "LI #LOOP:0", "JP"] for i in range(8)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        images = list(executor.map(lambda src: bytes(Assembler("HC4").run(src).code), sources))
+    testfuncs.expect([bytes([0x90 + i, 0xA0, 0xE0]) for i in range(8)], lambda: images)
     testfuncs.expect_raises(KeyError, assemble, [("XX r1", 1)], LinkState(), "HC4")
     testfuncs.expect_raises(ValueError, assemble, [("SC r16", 1)], LinkState(), "HC4")
     testfuncs.expect_raises(ValueError, assemble, [("LI #16", 1)], LinkState(), "HC4")
+    # counters
+    job = Assembler("HC4")
+    job.run([".DEF ACC r1", ".MACRO M", "LD ACC", ".ENDM", "M", "M", "LI #X:0", "X: SA ACC"])
+    testfuncs.expect((8, 10, 2, 2, 1, 4), lambda st: (st["lines_in"], st["lines_out"], st["macro_expansions"], st["define_substitutions"], st["unresolved_fixups"], st["bytes"]), job.stats())
+    # collect mode reports every error with its position and origin
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "bad.inc"), 'w', encoding='utf-8') as f:
+            f.write("NP\n  LD r99\n")
+        source = [
+            ".MACRO PUT x",
+            "LI x",
+            ".ENDM",
+            "  SC r16 ; too big",
+            '.INC "bad.inc"',
+            "XX r1",
+            "PUT #20",
+            "LI #NOWHERE:0",
+            "NP",
+        ]
+        job = Assembler("HC4", [tmp], collect=True)
+        image = job.run(source)
+        testfuncs.expect([
+            (None, 4, 6, []),
+            (os.path.join(tmp, "bad.inc"), 2, 6, [("include", "bad.inc", None, 5)]),
+            (None, 6, 1, []),
+            (None, 7, 5, [("macro", "PUT", None, 7)]),
+            (None, 8, 5, []),
+        ], lambda: [(d.file, d.line, d.column, d.chain) for d in job.diagnostics])
+        testfuncs.expect("Undefined label: NOWHERE:0", lambda: job.diagnostics[-1].message)
+        # instructions in error still take their address
+        testfuncs.expect(6, len, image)
 
     print("[OK] assembler.py : All tests passed.")
 
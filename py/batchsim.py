@@ -0,0 +1,315 @@
+import random
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable, Optional, Sequence, Union
+import testfuncs
+import simulator
+from simulator import Machine, ARCHS, IO_PORTS, _IO_INPUTS, _KINDS, _OP_CYCLES
+from simulator import (_INVALID, _LI, _LD, _AD, _SA, _JP, _JPC, _JPNC, _JPZ, _JPNZ,
+                       _XR, _OR, _AN, _SU, _SC, _SM, _LM)
+if TYPE_CHECKING:
+    import numpy as np
+else:
+    # optional: BatchMachine raises ImportError without it
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+# Stop reasons of a lane; None while it is still running
+REASONS = (None, "halt", "until", "limit", "error")
+_HALT, _UNTIL, _LIMIT, _ERROR = 1, 2, 3, 4
+
+class BatchMachine:
+    """
+    Many independent HC4 or HC4E machines stepped in lockstep with NumPy.\n
+    Lane i has its own registers, A/B/C stack, flags, PC, [AB] memory and I/O ports, held as row i
+    of NumPy arrays. Every step fetches one instruction per running lane and executes all opcode
+    kinds at once on masks, so lanes may diverge freely; lanes that stopped are masked out.\n
+    code is one program shared by all lanes (lanes gives their number) or one program per lane.
+    Inputs are read from inputs[lane, port]; on_step(machine) may update them before every step.
+    Writes to output ports go to outputs[lane, port] (-1 if never written) and io_log.
+    """
+    def __init__(self, arch:str="HC4", code:Union[bytes, Sequence[bytes]]=b"", lanes:Optional[int]=None, labels:Optional[dict[str, int]]=None):
+        if np is None:
+            raise ImportError("[Error] Batched simulation requires NumPy: python -m pip install numpy")
+        if arch not in ARCHS:
+            raise ValueError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        pc_bits, self.stack_depth = ARCHS[arch]
+        self.rom_size = 1 << pc_bits
+        if isinstance(code, (bytes, bytearray)):
+            if lanes is None:
+                raise ValueError("[Error] lanes is required when all lanes share one program")
+            self.lanes = lanes
+            self.rom = np.full(self.rom_size, 0xFF, dtype=np.uint8)
+            programs = [code]
+        else:
+            programs = list(code)
+            if lanes is not None and lanes != len(programs):
+                raise ValueError(f"[Error] {len(programs)} programs given for {lanes} lanes")
+            self.lanes = len(programs)
+            self.rom = np.full((self.lanes, self.rom_size), 0xFF, dtype=np.uint8)
+        for lane, program in enumerate(programs):
+            if len(program) > self.rom_size:
+                raise ValueError(f"[Error] Program of {len(program)} bytes does not fit in {self.rom_size} bytes")
+            row = self.rom if self.rom.ndim == 1 else self.rom[lane]
+            row[:len(program)] = np.frombuffer(bytes(program), dtype=np.uint8)
+        self.labels: dict[str, int] = dict(labels) if labels is not None else {}
+        self.inputs = np.zeros((self.lanes, 256), dtype=np.int64)
+        self.outputs = np.full((self.lanes, 256), -1, dtype=np.int64)
+        # one (lanes, cycles, ports, values) tuple of arrays per step that wrote to an output port
+        self.io_log: list[tuple] = []
+        # lane -> message of the invalid instruction it stopped at
+        self.errors: dict[int, str] = {}
+        self._kinds = np.frombuffer(_KINDS[arch], dtype=np.uint8)
+        self._op_cycles = np.frombuffer(_OP_CYCLES[arch], dtype=np.uint8).astype(np.int64)
+        self.reset()
+
+    label = Machine.label
+
+    def __repr__(self) -> str:
+        return f"BatchMachine(arch={self.arch}, lanes={self.lanes}, instructions={int(self.instructions.sum())})"
+
+    def reset(self):
+        """Power-on state of every lane; program memory and I/O settings are kept"""
+        n = self.lanes
+        self.regs = np.zeros((n, 16), dtype=np.int64)
+        self.mem = np.zeros((n, 256), dtype=np.int64)
+        self.a = np.zeros(n, dtype=np.int64)
+        self.b = np.zeros(n, dtype=np.int64)
+        self.c = np.zeros(n, dtype=np.int64)
+        self.carry = np.zeros(n, dtype=bool)
+        self.zero = np.zeros(n, dtype=bool)
+        self.pc = np.zeros(n, dtype=np.int64)
+        self.instructions = np.zeros(n, dtype=np.int64)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.halted = np.zeros(n, dtype=bool)
+
+    def state(self, lane:int) -> dict:
+        """Register dump of one lane, with the keys of Machine.state()"""
+        pc = int(self.pc[lane])
+        rom = self.rom if self.rom.ndim == 1 else self.rom[lane]
+        stack = (int(self.a[lane]), int(self.b[lane]), int(self.c[lane]))[:self.stack_depth]
+        return {
+            "regs": [int(r) for r in self.regs[lane]], "pc": pc, "inst": int(rom[pc]),
+            "stack": list(stack), "carry": bool(self.carry[lane]), "zero": bool(self.zero[lane]),
+            "instructions": int(self.instructions[lane]), "cycles": int(self.cycles[lane]),
+        }
+
+    def lane_io(self, lane:int) -> list[tuple[int, int, int]]:
+        """Output writes of one lane as (cycle, port, value), like Machine.io_log"""
+        log = []
+        for lanes, cycles, ports, values in self.io_log:
+            for i in np.flatnonzero(lanes == lane):
+                log.append((int(cycles[i]), int(ports[i]), int(values[i])))
+        return log
+
+    def lane_outputs(self, lane:int) -> dict[int, int]:
+        """Last value written to each output port of one lane, like Machine.outputs"""
+        return {port: int(v) for port, v in enumerate(self.outputs[lane]) if v >= 0}
+
+    def run(self, max_instructions:Optional[int]=None, until:Union[None, str, int, Iterable[Union[str, int]]]=None,
+            on_step:Optional[Callable[["BatchMachine"], None]]=None) -> list[Optional[str]]:
+        """
+        Step all lanes until each one stopped, with the stop reasons of Machine.run() plus
+        "error" for an invalid instruction (its message is kept in errors). Returns the reason of every lane.
+        """
+        label = self.label
+        if until is None:
+            targets = []
+        elif isinstance(until, (str, int)):
+            targets = [label(until)]
+        else:
+            targets = [label(u) for u in until]
+        mask = self.rom_size - 1
+        stop = np.zeros(self.rom_size, dtype=bool)
+        for address in targets:
+            stop[address & mask] = True
+        n0 = self.instructions.copy()
+        end = n0 + max_instructions if max_instructions is not None else None
+        reasons = np.zeros(self.lanes, dtype=np.int64)
+        idx = np.arange(self.lanes)
+        self.errors = {}
+        while idx.size:
+            if on_step is not None:
+                on_step(self)
+            n = self.instructions[idx]
+            running = np.ones(idx.size, dtype=bool)
+            if end is not None:
+                running = n < end[idx]
+                reasons[idx[~running]] = _LIMIT
+            if targets:
+                arrived = running & stop[self.pc[idx]] & (n != n0[idx])
+                reasons[idx[arrived]] = _UNTIL
+                running &= ~arrived
+            idx = self._step(idx[running], reasons)
+        return [REASONS[r] for r in reasons]
+
+    def _step(self, idx:"np.ndarray", reasons:"np.ndarray") -> "np.ndarray":
+        """Execute one instruction on the lanes idx; returns the lanes that keep running"""
+        mask = self.rom_size - 1
+        pc = self.pc[idx]
+        op = self.rom[pc] if self.rom.ndim == 1 else self.rom[idx, pc]
+        k = self._kinds[op]
+        invalid = k == _INVALID
+        if invalid.any():
+            for lane, address, code in zip(idx[invalid], pc[invalid], op[invalid]):
+                self.errors[int(lane)] = f"[Error] Invalid instruction 0x{code:02X} at 0x{address:03X}"
+                reasons[lane] = _ERROR
+            valid = ~invalid
+            idx, pc, op, k = idx[valid], pc[valid], op[valid], k[valid]
+        x = (op & 15).astype(np.int64)
+        a, b, c = self.a[idx], self.b[idx], self.c[idx]
+        carry, zero = self.carry[idx], self.zero[idx]
+        cycles = self.cycles[idx]
+        address = (b << 4) | a
+        if self.arch == "HC4":
+            ports = IO_PORTS[self.arch]
+            mem_io = (address >= ports.start) & (address < ports.stop)
+            reg_io = np.zeros(idx.size, dtype=bool)
+            in_reg = reg_io
+        else:
+            mem_io = np.zeros(idx.size, dtype=bool)
+            reg_io = x >= IO_PORTS[self.arch].start
+            in_reg = x == _IO_INPUTS[self.arch].start
+
+        # LI, LD, LM push a value onto the stack
+        is_ld, is_lm = k == _LD, k == _LM
+        loaded = np.where(in_reg, self.inputs[idx, x], self.regs[idx, x])
+        fetched = np.where(mem_io, self.inputs[idx, address], self.mem[idx, address])
+        value = np.where(is_ld, loaded, np.where(is_lm, fetched, x))
+        push = (k == _LI) | is_ld | is_lm
+
+        # AD, SA, XR, OR, AN, SU, SC store into a register and set the flags
+        added, subtracted = a + b, a - b
+        is_ad, is_su = k == _AD, k == _SU
+        result = np.select([is_ad, k == _SA, k == _XR, k == _OR, k == _AN, is_su, k == _SC],
+                           [added & 15, a, a ^ b, a | b, a & b, subtracted & 15, c])
+        store = is_ad | (k == _SA) | ((k >= _XR) & (k <= _SC))
+        self.regs[idx[store], x[store]] = result[store]
+        # SM sets Z from the value it stores
+        is_sm = k == _SM
+        zero = np.where(store, result == 0, np.where(is_sm, c == 0, zero))
+        # SU's carry is a borrow, like on the interpreter
+        carry = np.where(is_ad, added > 15, np.where(is_su, subtracted < 0, carry))
+
+        to_mem = is_sm & ~mem_io
+        self.mem[idx[to_mem], address[to_mem]] = c[to_mem]
+        reg_write, mem_write = store & reg_io, is_sm & mem_io
+        if reg_write.any() or mem_write.any():
+            written = reg_write | mem_write
+            port = np.where(reg_write, x, address)[written]
+            v = np.where(reg_write, result, c)[written]
+            lanes = idx[written]
+            self.outputs[lanes, port] = v
+            self.io_log.append((lanes, cycles[written], port, v))
+
+        jump = (k >= _JP) & (k <= _JPNZ)
+        taken = jump & ((k == _JP) | ((k == _JPC) & carry) | ((k == _JPNC) & ~carry) | ((k == _JPZ) & zero) | ((k == _JPNZ) & ~zero))
+        target = ((c << 8) | (b << 4) | a) & mask
+        halt = taken & (target == pc)
+
+        self.a[idx] = np.where(push, value, a)
+        self.b[idx] = np.where(push, a, b)
+        self.c[idx] = np.where(push, b, c)
+        self.carry[idx] = carry
+        self.zero[idx] = zero
+        self.pc[idx] = np.where(taken, target, (pc + 1) & mask)
+        self.instructions[idx] += 1
+        self.cycles[idx] = cycles + self._op_cycles[op]
+        if halt.any():
+            self.halted[idx[halt]] = True
+            reasons[idx[halt]] = _HALT
+            return idx[~halt]
+        return idx
+
+def load_source(lines:Sequence[str], lanes:int, arch:str="HC4", include_pathes:Optional[list[str]]=None) -> BatchMachine:
+    """Assemble lines and load the result into lanes machines of a new BatchMachine"""
+    m = simulator.load_source(lines, arch, include_pathes)
+    return BatchMachine(arch, bytes(m.rom), lanes, m.labels)
+
+def _compare(scalar:Machine, batch:BatchMachine, lane:int) -> bool:
+    mem = [int(v) for v in batch.mem[lane]]
+    return ((scalar.state(), list(scalar.mem), scalar.io_log, scalar.outputs, scalar.halted)
+            == (batch.state(lane), mem, batch.lane_io(lane), batch.lane_outputs(lane), bool(batch.halted[lane])))
+
+def self_test():
+    if np is None:
+        print("[Info] batchsim.py : NumPy is not installed, skipped.")
+        return
+    lines = ["LI #9", "LI #8", "AD r1", "LI #3", "SU r2", "SC r3", "LI #7", "LI #5", "LI #0xA", "SM",
+             "LI #5", "LI #0xA", "LM", "SA r4", "XR r5", "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"]
+    m = load_source(lines, 3)
+    testfuncs.expect(["halt"] * 3, m.run, 1000)
+    testfuncs.expect(([0, 1, 11, 9, 7, 13], True, False, 7, 19, 18), lambda: (m.state(2)["regs"][:6], bool(m.carry[2]), bool(m.zero[2]), int(m.mem[2, 0x5A]), int(m.instructions[2]), int(m.pc[2])))
+    m.reset()
+    testfuncs.expect(["until"] * 3, m.run, None, 13)
+    testfuncs.expect(["error", "limit"], lambda: BatchMachine("HC4", [b"\xe1", b"\xe1" * 4096]).run(10000))
+    testfuncs.expect_raises(ValueError, BatchMachine, "HC4", b"")
+    # SC [AB] sets Z from the stored value: the first JP Z is taken, the second is not
+    m = load_source(["LI #1", "SA r1", "LI #0", "LI #2", "LI #1", "SM", "LI #SKIP:2", "LI #SKIP:1", "LI #SKIP:0", "JP Z", "LI #5", "SA r2",
+                     "SKIP:", "LI #3", "LI #2", "LI #1", "SM", "LI #END:2", "LI #END:1", "LI #END:0", "JP Z", "LI #6", "SA r3",
+                     "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"], 2)
+    testfuncs.expect((["halt"] * 2, [1, 0, 6], 3), lambda: (m.run(1000), m.state(1)["regs"][1:4], int(m.mem[1, 0x21])))
+
+    # random programs, one per lane, behave exactly like on the scalar simulator
+    rng = random.Random(3)
+    for arch in ("HC4", "HC4E"):
+        valid = [op for op, entry in enumerate(simulator.DECODE[arch]) if entry is not None and entry[0] != "JP"]
+        programs = []
+        for _ in range(300):
+            code = bytearray(rng.choice(valid) for _ in range(48))
+            for _ in range(4):
+                i, target = rng.randrange(44), rng.randrange(48)
+                code[i:i + 4] = bytes([0xA0, 0xA0 | (target >> 4), 0xA0 | (target & 15), rng.choice([0xE0, 0xE2, 0xE3, 0xE4, 0xE5])])
+            programs.append(bytes(code))
+        limit, until = rng.randrange(1, 3000), rng.randrange(48)
+        batch = BatchMachine(arch, programs)
+        batch.inputs[:, [0xF0, 0xF3, 14]] = [3, 1, 5]
+        reasons = batch.run(limit, until)
+        for lane, code in enumerate(programs):
+            scalar = Machine(arch, code)
+            scalar.inputs = {0xF0: 3, 0xF3: 1, 14: 5}
+            try:
+                reason = scalar.run(limit, until)
+            except ValueError as e:
+                reason = "error" if batch.errors.get(lane) == str(e) else str(e)
+            if reason != reasons[lane] or not _compare(scalar, batch, lane):
+                raise AssertionError(f"[FAIL] Lane {lane} differs from the scalar simulator on {code.hex()} ({arch}, {limit}, {until}): {reason}, {reasons[lane]}")
+    print("[OK] Random programs match the scalar simulator.")
+
+    # dice4e.asm with INA pressed from a different cycle on every lane
+    root = Path(__file__).resolve().parent
+    include = [str(root.parent / "include")]
+    with open(root / "test_files" / "dice4e.asm", 'r', encoding='utf-8') as f:
+        dice = f.read().splitlines()
+    lanes = 64
+    pressed = np.arange(lanes) * 3
+    m = load_source(dice, lanes, "HC4E", include)
+    def press(machine:BatchMachine):
+        machine.inputs[:, 14] = machine.cycles >= pressed
+    testfuncs.expect({"limit"}, lambda: set(m.run(400, None, press)))
+    for lane in (0, 1, 17, 63):
+        scalar = simulator.load_source(dice, "HC4E", include)
+        scalar.on_io_read = lambda port, at=int(pressed[lane]): int(scalar.cycles >= at)
+        scalar.run(400)
+        testfuncs.expect(True, _compare, scalar, m, lane)
+
+    with open(root / "test_files" / "countlcd.asm", 'r', encoding='utf-8') as f:
+        countlcd = f.read().splitlines()
+    scalar = simulator.load_source(countlcd, "HC4", include)
+    started = time.perf_counter()
+    scalar.run(5000)
+    scalar_rate = scalar.instructions / (time.perf_counter() - started)
+    m = load_source(countlcd, 4096, "HC4", include)
+    started = time.perf_counter()
+    m.run(5000)
+    batch_rate = m.instructions.sum() / (time.perf_counter() - started)
+    testfuncs.expect(True, _compare, scalar, m, 4095)
+    print(f"[Info] batchsim.py : {batch_rate / 1e6:.2f} M machine-instructions/s on 4096 lanes, "
+          f"{scalar_rate / 1e6:.2f} M on the scalar simulator ({batch_rate / scalar_rate:.1f}x)")
+    print("[OK] batchsim.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,184 @@
+import os
+import random
+import tempfile
+from pathlib import Path
+from typing import Optional
+import testfuncs
+import assembler
+
+class Mix:
+    """
+    Share of each kind of statement in a generated program.\n
+    labels       : label definitions\n
+    forward_refs : jumps and LI #label:n to labels defined further down\n
+    back_refs    : the same to labels already defined\n
+    defines      : instructions using a .DEF alias from the generated includes\n
+    macros       : calls of the vasm.inc macros\n
+    comments     : comment and empty lines\n
+    include_depth: number of nested generated include files\n
+    The rest are plain instructions.
+    """
+    FIELDS = ("labels", "forward_refs", "back_refs", "defines", "macros", "comments")
+
+    def __init__(self, labels:float=0.05, forward_refs:float=0.05, back_refs:float=0.05, defines:float=0.10, macros:float=0.10, comments:float=0.05, include_depth:int=2):
+        self.labels = labels
+        self.forward_refs = forward_refs
+        self.back_refs = back_refs
+        self.defines = defines
+        self.macros = macros
+        self.comments = comments
+        self.include_depth = include_depth
+        if sum(self.weights()) > 1.0:
+            raise ValueError(f"[Error] Statement shares add up to more than 1: {self.to_dict()}")
+
+    def __repr__(self) -> str:
+        return f"Mix({', '.join(f'{k}={v}' for k, v in self.to_dict().items())})"
+
+    def weights(self) -> list[float]:
+        return [getattr(self, k) for k in Mix.FIELDS]
+
+    def to_dict(self) -> dict:
+        return {**{k: getattr(self, k) for k in Mix.FIELDS}, "include_depth": self.include_depth}
+
+    @staticmethod
+    def parse(text:str) -> "Mix":
+        """Mix from "labels=0.1,macros=0.2,include_depth=3"; unnamed shares keep their default"""
+        values: dict = {}
+        for item in text.split(","):
+            if not item.strip():
+                continue
+            key, sep, value = item.partition("=")
+            key = key.strip()
+            if not sep or key not in Mix.FIELDS + ("include_depth",):
+                raise ValueError(f"[Error] Invalid mix entry: {item}")
+            values[key] = int(value) if key == "include_depth" else float(value)
+        return Mix(**values)
+
+def parse_size(text:str) -> int:
+    """Line count such as 1000, 10k or 1M"""
+    text = text.strip().lower()
+    scale = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale != 1 else text) * scale)
+
+# generated include files define these aliases, two per level
+def _alias(level:int, i:int) -> str:
+    return f"R{level}_{i}"
+
+def generate(lines:int, arch:str="HC4", mix:Optional[Mix]=None, seed:int=0) -> dict[str, str]:
+    """
+    Synthetic program of about lines source lines.\n
+    Returns file name -> text: "main.asm" and the nested includes "bench<n>.inc".
+    The include path must also contain the directory of vasm.inc.
+    """
+    mix = mix if mix is not None else Mix()
+    rng = random.Random(seed)
+    files: dict[str, str] = {}
+    aliases: list[str] = []
+    for level in range(mix.include_depth):
+        text = [".ONCE"]
+        if level + 1 < mix.include_depth:
+            text.append(f'.INC "bench{level + 1}.inc"')
+        for i in range(2):
+            text.append(f".DEF {_alias(level, i)} r{(level * 2 + i) % 14}")
+            aliases.append(_alias(level, i))
+        files[f"bench{level}.inc"] = "\n".join(text) + "\n"
+
+    inst = assembler.INST_DICT_M[arch]
+    register_ops = [m for m in ("SC", "SU", "AD", "XR", "OR", "AN", "SA", "LD") if m in inst]
+    inherent_ops = [m for m in ("SM", "LM", "NP") if m in inst]
+    macros = ["ADD", "ADDI", "MOV", "MOVI", "GOTO", "GOTO_IF", "NAND", "NANDI"]
+
+    out = ['.INC "vasm.inc"']
+    if mix.include_depth:
+        out.append('.INC "bench0.inc"')
+    labels: list[str] = []
+    pending: list[str] = []
+    label_id = 0
+
+    def new_label() -> str:
+        nonlocal label_id
+        label_id += 1
+        return f"L{label_id}"
+
+    def reg() -> str:
+        return f"r{rng.randrange(14)}"
+
+    def imm() -> str:
+        return f"#{rng.randrange(16)}"
+
+    def target() -> str:
+        # forward references pile up in pending until a label statement defines them
+        if rng.random() < mix.forward_refs / max(mix.forward_refs + mix.back_refs, 1e-9) or not labels:
+            name = new_label()
+            pending.append(name)
+            return name
+        return rng.choice(labels)
+
+    kinds = list(Mix.FIELDS) + ["plain"]
+    weights = mix.weights() + [max(0.0, 1.0 - sum(mix.weights()))]
+    while len(out) < lines - len(pending):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "labels":
+            name = pending.pop(0) if pending else new_label()
+            labels.append(name)
+            out.append(f"{name}:")
+        elif kind in ("forward_refs", "back_refs"):
+            name = target()
+            if rng.random() < 0.5:
+                out.append(f"LI #{name}:{rng.randrange(2)}")
+            else:
+                out += [f"LI #{name}:1", f"LI #{name}:0", rng.choice(["JP", "JP NZ", "JP C"])]
+        elif kind == "defines" and aliases:
+            out.append(f"{rng.choice(register_ops)} {rng.choice(aliases)}")
+        elif kind == "macros":
+            macro = rng.choice(macros)
+            if macro in ("GOTO", "GOTO_IF"):
+                args = ([rng.choice(["Z", "NZ", "C", "NC"])] if macro == "GOTO_IF" else []) + [target()]
+            elif macro in ("ADDI", "NANDI"):
+                args = [reg(), reg(), imm()]
+            elif macro == "MOVI":
+                args = [reg(), imm()]
+            elif macro == "MOV":
+                args = [reg(), reg()]
+            else:
+                args = [reg(), reg(), reg()]
+            out.append(f"    {macro} {' '.join(args)}")
+        elif kind == "comments":
+            out.append(rng.choice(["", "; generated comment", "    ; indented comment"]))
+        elif rng.random() < 0.7:
+            out.append(f"    {rng.choice(register_ops)} {reg()}")
+        elif rng.random() < 0.5:
+            out.append(f"    LI {imm()}")
+        else:
+            out.append(f"    {rng.choice(inherent_ops)}")
+    out += [f"{name}:" for name in pending]
+    out.append("    NP")
+    files["main.asm"] = "\n".join(out) + "\n"
+    return files
+
+def self_test():
+    testfuncs.expect(10000, parse_size, "10k")
+    testfuncs.expect(1000000, parse_size, "1M")
+    testfuncs.expect(250, parse_size, "250")
+    testfuncs.expect({"labels": 0.2, "forward_refs": 0.05, "back_refs": 0.05, "defines": 0.1, "macros": 0.1, "comments": 0.05, "include_depth": 3},
+                     lambda: Mix.parse("labels=0.2, include_depth=3").to_dict())
+    testfuncs.expect_raises(ValueError, Mix.parse, "labels=0.9,macros=0.9")
+    testfuncs.expect_raises(ValueError, Mix.parse, "bogus=1")
+    include_dir = str(Path(__file__).resolve().parent.parent.parent / "include")
+    for arch in ("HC4", "HC4E"):
+        files = generate(2000, arch, Mix(include_depth=3), seed=1)
+        testfuncs.expect(True, lambda: generate(2000, arch, Mix(include_depth=3), seed=1) == files)
+        testfuncs.expect(["bench0.inc", "bench1.inc", "bench2.inc", "main.asm"], lambda: sorted(files))
+        testfuncs.expect(True, lambda: 1990 <= len(files["main.asm"].splitlines()) <= 2010)
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in files.items():
+                with open(os.path.join(tmp, name), 'w', encoding='utf-8') as f:
+                    f.write(text)
+            job = assembler.Assembler(arch, [tmp, include_dir])
+            image = job.run(files["main.asm"].splitlines())
+            stats = job.stats()
+            testfuncs.expect(True, lambda: len(image) > 1000 and stats["macro_expansions"] > 100 and stats["unresolved_fixups"] > 100)
+    print("[OK] bench/generator.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
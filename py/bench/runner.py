@@ -0,0 +1,196 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+import testfuncs
+import assembler
+from bench import generator
+
+STAGES = ("read", "preprocess", "assemble", "link", "write", "total")
+INCLUDE_DIR = str(Path(__file__).resolve().parent.parent.parent / "include")
+
+# output format -> writer of an assembled program (image, processed lines, link state)
+Writers = dict[str, Callable[[assembler.ProgramImage, list[tuple[str, int, str, int]], assembler.LinkState], None]]
+
+def run_case(lines:int, arch:str="HC4", mix:Optional[generator.Mix]=None, repeat:int=3, seed:int=0, writers:Optional[Writers]=None) -> dict:
+    """
+    Generate a program of about lines lines and assemble it repeat times in this process.\n
+    Every stage is timed on each round; the result keeps the fastest and the median round.
+    Each round starts with a fresh include cache, so the includes are read every time.
+    """
+    if repeat < 1:
+        raise ValueError(f"[Error] repeat must be at least 1, not {repeat}")
+    mix = mix if mix is not None else generator.Mix()
+    writers = writers if writers is not None else {}
+    files = generator.generate(lines, arch, mix, seed)
+    rounds: list[dict[str, float]] = []
+    source_lines = 0
+    stats: dict = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, text in files.items():
+            with open(os.path.join(tmp, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+        main_file = os.path.join(tmp, "main.asm")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            with open(main_file, 'r', encoding='utf-8') as f:
+                source = f.read().splitlines()
+            read = time.perf_counter() - started
+            job = assembler.Assembler(arch, [tmp, INCLUDE_DIR])
+            image = job.run(source)
+            written = time.perf_counter()
+            for write in writers.values():
+                write(image, job.processed, job.ls)
+            seconds = {"read": read, **job.timings, "write": time.perf_counter() - written}
+            seconds["total"] = time.perf_counter() - started
+            rounds.append(seconds)
+            source_lines = len(source)
+            stats = job.stats()
+    del stats["timings"]
+    best = {stage: min(r[stage] for r in rounds) for stage in STAGES}
+    return {
+        "case": case_name(lines, arch),
+        "lines": source_lines,
+        "arch": arch,
+        "mix": mix.to_dict(),
+        "seed": seed,
+        "repeat": repeat,
+        "writers": list(writers),
+        "seconds": best,
+        "median": {stage: statistics.median(r[stage] for r in rounds) for stage in STAGES},
+        "lines_per_second": source_lines / best["total"] if best["total"] > 0 else 0.0,
+        "counters": stats,
+    }
+
+def case_name(lines:int, arch:str) -> str:
+    """Key matching the same case across runs, e.g. "HC4/10k" """
+    if lines >= 1000000 and lines % 1000000 == 0:
+        size = f"{lines // 1000000}M"
+    elif lines >= 1000 and lines % 1000 == 0:
+        size = f"{lines // 1000}k"
+    else:
+        size = str(lines)
+    return f"{arch}/{size}"
+
+def _commit() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).resolve().parent, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+def run(sizes:Sequence[int], archs:Sequence[str]=("HC4",), mix:Optional[generator.Mix]=None, repeat:int=3, seed:int=0, writers:Optional[Writers]=None, progress:Optional[Callable[[dict], None]]=None) -> dict:
+    """Run every size for every architecture. Returns one history entry."""
+    results = []
+    for arch in archs:
+        for lines in sizes:
+            result = run_case(lines, arch, mix, repeat, seed, writers)
+            # name the case by the requested size, not the generated line count
+            result["case"] = case_name(lines, arch)
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _commit(),
+        "version": assembler.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+def load_history(path:str) -> list[dict]:
+    """Runs stored in a history file; an absent file is an empty history"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return []
+    if isinstance(data, dict) and "results" in data:
+        # a single run, as written by --save-baseline
+        return [data]
+    if not isinstance(data, dict) or not isinstance(data.get("runs"), list):
+        raise ValueError(f"[Error] Not a benchmark history file: {path}")
+    return data["runs"]
+
+def append_history(path:str, entry:dict):
+    runs = load_history(path)
+    runs.append(entry)
+    save_json(path, {"runs": runs})
+
+def save_json(path:str, data:dict):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def compare(baseline:dict, current:dict, threshold:float=0.10, min_seconds:float=0.001) -> list[dict]:
+    """
+    Stages of current that are slower than in baseline.\n
+    A stage regresses when it takes more than (1 + threshold) times its baseline time and
+    at least min_seconds longer, so timer noise on tiny stages is not reported.
+    Cases are matched by name; cases found in only one of the runs are ignored.
+    """
+    base_cases = {r["case"]: r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = base_cases.get(result["case"])
+        if base is None:
+            continue
+        for stage in STAGES:
+            before = base["seconds"].get(stage)
+            after = result["seconds"].get(stage)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + threshold) and after - before >= min_seconds:
+                regressions.append({
+                    "case": result["case"],
+                    "stage": stage,
+                    "baseline": before,
+                    "current": after,
+                    "ratio": after / before if before > 0 else float("inf"),
+                })
+    return regressions
+
+def format_result(result:dict) -> str:
+    seconds = result["seconds"]
+    stages = "  ".join(f"{stage} {seconds[stage] * 1000:.1f}" for stage in STAGES)
+    return f"{result['case']:<12} {result['lines']:>8} lines  {result['lines_per_second']:>10.0f} lines/s  [ms] {stages}"
+
+def self_test():
+    entry = run([300], ("HC4", "HC4E"), repeat=2, writers={"count": lambda image, processed, ls: None})
+    testfuncs.expect(["HC4/300", "HC4E/300"], lambda: [r["case"] for r in entry["results"]])
+    testfuncs.expect(True, lambda: all(set(r["seconds"]) == set(STAGES) and r["seconds"]["total"] > 0 for r in entry["results"]))
+    testfuncs.expect("1M", lambda: case_name(1000000, "HC4")[4:])
+    testfuncs.expect_raises(ValueError, run_case, 300, repeat=0)
+    slower = json.loads(json.dumps(entry))
+    slower["results"][0]["seconds"]["preprocess"] = entry["results"][0]["seconds"]["preprocess"] * 2 + 0.01
+    testfuncs.expect([("HC4/300", "preprocess")], lambda: [(r["case"], r["stage"]) for r in compare(entry, slower)])
+    testfuncs.expect([], compare, entry, entry)
+    with tempfile.TemporaryDirectory() as tmp:
+        history = os.path.join(tmp, "history.json")
+        append_history(history, entry)
+        append_history(history, slower)
+        testfuncs.expect(2, lambda: len(load_history(history)))
+        baseline = os.path.join(tmp, "baseline.json")
+        save_json(baseline, entry)
+        testfuncs.expect(1, lambda: len(load_history(baseline)))
+    print("[OK] bench/runner.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,168 @@
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Optional, Sequence
+import testfuncs
+import assembler
+import lexer
+import optimizer
+
+# Bump when the layout of a cache entry changes
+CACHE_FORMAT = 1
+
+@functools.lru_cache(maxsize=None)
+def _assembler_digest() -> str:
+    """Hash of the assembler sources, so a modified assembler never reuses old entries"""
+    h = hashlib.sha256()
+    for module in (assembler, lexer, optimizer):
+        with open(module.__file__, 'rb') as f:  # type: ignore[arg-type]
+            h.update(f.read())
+    return h.hexdigest()
+
+class BuildCache:
+    """
+    Content-addressed cache of assembly results.\n
+    The key covers the input file, every file it pulls in through .INCLUDE/.INC, the architecture
+    and the assembler version. An entry holds the preprocessed lines, image and labels, so a hit
+    skips preprocess and assemble. Entries are evicted least recently used first once the
+    directory grows past max_bytes.
+    """
+    def __init__(self, directory:str, max_bytes:int=64 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._version = f"{CACHE_FORMAT}:{assembler.__version__}:{_assembler_digest()}"
+
+    def __repr__(self) -> str:
+        return f"BuildCache({str(self.directory)!r}, hits={self.hits}, misses={self.misses})"
+
+    def key(self, input_file:str, arch:str, include_pathes:Sequence[str], optimize:bool=False) -> Optional[str]:
+        """
+        Cache key of a build, or None if a source cannot be read (the assembler reports that).
+        """
+        h = hashlib.sha256()
+        h.update(self._version.encode())
+        h.update(b"\0" + arch.encode() + b"\0")
+        if optimize:
+            h.update(b"-O\0")
+        seen: set[str] = set()
+        pending = [input_file]
+        while pending:
+            filename = pending.pop()
+            if filename in seen:
+                continue
+            seen.add(filename)
+            try:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            h.update(os.path.abspath(filename).encode() + b"\0")
+            h.update(hashlib.sha256(data).digest())
+            for line in data.decode('utf-8', errors='replace').splitlines():
+                tok = lexer.strip_comment(line).split()
+                if len(tok) >= 2 and assembler.DIRECTIVES.get(tok[0].upper()) == 4:
+                    pending.append(assembler.resolve_include(tok[1].strip('"'), include_pathes))
+        return h.hexdigest()
+
+    def _path(self, key:str) -> Path:
+        return self.directory / key[:2] / f"{key}.pickle"
+
+    def load(self, key:str) -> Optional[tuple[list[tuple[str, int, str, int]], assembler.ProgramImage, assembler.LinkState]]:
+        """Returns (processed lines, image, link state) or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path)  # mark as recently used
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+        image = assembler.ProgramImage()
+        image.code = bytearray(entry["code"])
+        image.linenos = array('I', entry["linenos"])
+        ls = assembler.LinkState()
+        ls.labels = entry["labels"]
+        ls.unresolved = entry["unresolved"]
+        self.hits += 1
+        return (entry["processed"], image, ls)
+
+    def store(self, key:str, processed:list[tuple[str, int, str, int]], image:assembler.ProgramImage, ls:assembler.LinkState):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {
+            "processed": processed,
+            "code": bytes(image.code),
+            "linenos": image.linenos.tobytes(),
+            "labels": ls.labels,
+            "unresolved": ls.unresolved,
+        }
+        # write then rename, so concurrent builds never read a partial entry
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for path in self.directory.glob("*/*.pickle"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
+def self_test():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "main.asm"
+        inc = Path(tmp) / "regs.inc"
+        inc.write_text(".DEF ACC r1\n", encoding='utf-8')
+        src.write_text('.INC "regs.inc"\nSTART:\nLD ACC\nLI #START:0\nJP\n', encoding='utf-8')
+        cache = BuildCache(str(Path(tmp) / "cache"))
+        key = cache.key(str(src), "HC4", [tmp])
+        assert key is not None
+        testfuncs.expect(False, lambda: cache.key(str(src), "HC4", [tmp], True) == key)
+        testfuncs.expect(None, cache.load, key)
+        job = assembler.Assembler("HC4", [tmp])
+        image = job.run(src.read_text(encoding='utf-8').splitlines())
+        cache.store(key, job.processed, image, job.ls)
+        entry = cache.load(key)
+        assert entry is not None
+        testfuncs.expect((job.processed, bytes(image.code), {"START": 0}), lambda: (entry[0], bytes(entry[1].code), entry[2].labels))
+        # editing an included file changes the key
+        inc.write_text(".DEF ACC r2\n", encoding='utf-8')
+        testfuncs.expect(False, lambda: cache.key(str(src), "HC4", [tmp]) == key)
+        testfuncs.expect(False, lambda: cache.key(str(src), "HC4E", [tmp]) == key)
+        # a tiny cache keeps nothing
+        cache.max_bytes = 0
+        cache.evict()
+        testfuncs.expect(None, cache.load, key)
+    print("[OK] buildcache.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
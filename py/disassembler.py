@@ -0,0 +1,270 @@
+import re
+import time
+from typing import Iterator, Optional, Protocol
+import testfuncs
+from assembler import INST_DICT_M
+from simulator import ARCHS, DECODE
+
+FORMATS = ("binary", "vhex", "ihex")
+# bytes read, or decoded from text, before a run is handed on
+CHUNK_SIZE = 1 << 16
+
+def _text_table(arch:str) -> list[Optional[str]]:
+    """256-entry table opcode -> instruction as the assembler reads it, None for reserved opcodes"""
+    return [None if e is None else (f"{e[0]} {e[1]}" if e[1] is not None else e[0]) for e in DECODE[arch]]
+
+TEXT = {arch: _text_table(arch) for arch in INST_DICT_M}
+
+class Writer(Protocol):
+    """What disassemble writes to: a text file, io.StringIO or anything else with write"""
+    def write(self, text:str, /) -> int: ...
+
+def detect_format(filename:str) -> str:
+    """"ihex" if the file starts with ':', "vhex" if it is all hex digits, else "binary\""""
+    with open(filename, 'rb') as f:
+        head = f.read(4096)
+    if head.lstrip().startswith(b":"):
+        return "ihex"
+    if head.strip() and re.fullmatch(rb"(\s|[0-9A-Fa-f]+|@[0-9A-Fa-f]+|//[^\n]*)*", head):
+        return "vhex"
+    return "binary"
+
+def read_chunks(filename:str, fmt:Optional[str]=None, chunk_size:int=CHUNK_SIZE) -> Iterator[tuple[int, bytes]]:
+    """
+    Stream an image file as (address, data) runs of at most chunk_size bytes, in file order.\n
+    fmt is "binary", "vhex" ($readmemh text: one byte per word, @address, // comments) or "ihex"
+    (record types 00, 01, 02 and 04); None detects it. Only one run is held in memory at a time.
+    """
+    fmt = fmt or detect_format(filename)
+    if fmt == "binary":
+        with open(filename, 'rb') as f:
+            address = 0
+            while data := f.read(chunk_size):
+                yield address, data
+                address += len(data)
+        return
+    if fmt not in FORMATS:
+        raise ValueError(f"[Error] Unsupported image format: {fmt}")
+    run = bytearray()
+    start = 0
+    with open(filename, 'r', encoding='ascii') as f:
+        if fmt == "vhex":
+            for lineno, line in enumerate(f, start=1):
+                for word in line.split("//", 1)[0].split():
+                    if word.startswith("@"):
+                        if run:
+                            yield start, bytes(run)
+                            run.clear()
+                        start = int(word[1:], 16)
+                        continue
+                    try:
+                        value = int(word, 16)
+                    except ValueError:
+                        raise ValueError(f"[Error] Invalid hex value '{word}' in line {lineno}")
+                    if value > 0xFF:
+                        raise ValueError(f"[Error] Word '{word}' in line {lineno} is wider than a byte")
+                    run.append(value)
+                    if len(run) >= chunk_size:
+                        yield start, bytes(run)
+                        start += len(run)
+                        run.clear()
+        else:
+            base = 0
+            for lineno, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = bytes.fromhex(line[1:]) if line.startswith(":") else b""
+                except ValueError:
+                    record = b""
+                if len(record) < 5 or len(record) != record[0] + 5:
+                    raise ValueError(f"[Error] Invalid Intel HEX record in line {lineno}")
+                if sum(record) & 0xFF:
+                    raise ValueError(f"[Error] Checksum mismatch in line {lineno}")
+                rectype = record[3]
+                data = record[4:-1]
+                if rectype == 0x00:
+                    address = base + (record[1] << 8 | record[2])
+                    if address != start + len(run) or len(run) >= chunk_size:
+                        if run:
+                            yield start, bytes(run)
+                            run.clear()
+                        start = address
+                    run += data
+                elif rectype == 0x01:
+                    break
+                elif rectype == 0x02:
+                    base = int.from_bytes(data, 'big') << 4
+                elif rectype == 0x04:
+                    base = int.from_bytes(data, 'big') << 16
+    if run:
+        yield start, bytes(run)
+
+def read_image(filename:str, fmt:Optional[str]=None, filler:int=255) -> bytearray:
+    """Whole image of a file, gaps filled with filler (as adrlist2bitstream does)"""
+    image = bytearray()
+    for address, data in read_chunks(filename, fmt):
+        if address > len(image):
+            image += bytes([filler]) * (address - len(image))
+        image[address:address + len(data)] = data
+    return image
+
+def find_jumps(chunks:Iterator[tuple[int, bytes]], arch:str="HC4") -> tuple[dict[int, int], list[tuple[int, int]]]:
+    """
+    (JP address -> target, [(start, end) of each run]) of a stream.\n
+    A target is recovered where as many LI as the PC has nibbles lead straight up to a JP, which is
+    how the assembler and vasm.inc write jumps and calls to labels.
+    """
+    nibbles = ARCHS[arch][0] // 4
+    li = INST_DICT_M[arch]["LI"]
+    jumps = bytes(op for op, e in enumerate(DECODE[arch]) if e is not None and e[0] == "JP")
+    pattern = re.compile(b"[%s-%s]{%d}[%s]" % (re.escape(bytes([li])), re.escape(bytes([li | 15])), nibbles, re.escape(jumps)))
+    targets: dict[int, int] = {}
+    runs: list[tuple[int, int]] = []
+    # the last nibbles bytes of the previous chunk, when it ends where this one starts
+    tail = b""
+    for address, data in chunks:
+        if runs and runs[-1][1] == address:
+            runs[-1] = (runs[-1][0], address + len(data))
+        else:
+            runs.append((address, address + len(data)))
+            tail = b""
+        window = tail + data
+        for m in pattern.finditer(window):
+            target = 0
+            for op in m.group()[:nibbles]:
+                target = target << 4 | (op & 15)
+            targets[address - len(tail) + m.end() - 1] = target
+        tail = window[-nibbles:]
+    return targets, runs
+
+def disassemble(filename:str, out:Writer, arch:str="HC4", fmt:Optional[str]=None, labels:bool=True) -> dict:
+    """
+    Write a file as annotated assembly that assembles back to the same bytes.\n
+    The file is read twice, once to recover labels and once to write, a chunk at a time, so
+    its size is not limited by memory. Bytes that are not instructions (erased 0xFF, gaps) become
+    comments and are counted in "undecodable"; an image with none round-trips byte for byte.
+    Returns counters: bytes, instructions, labels, undecodable, seconds.
+    """
+    if arch not in TEXT:
+        raise ValueError(f"[Error] Unsupported architecture: {arch}")
+    started = time.perf_counter()
+    fmt = fmt or detect_format(filename)
+    table = TEXT[arch]
+    nibbles = ARCHS[arch][0] // 4
+    # LI address -> label reference, JP address -> label
+    references: dict[int, str] = {}
+    jump_notes: dict[int, str] = {}
+    names: dict[int, str] = {}
+    if labels:
+        targets, runs = find_jumps(read_chunks(filename, fmt), arch)
+        for jp, target in targets.items():
+            if not any(start <= target < end for start, end in runs):
+                continue
+            name = names.setdefault(target, f"L_{target:0{nibbles}X}")
+            for k in range(nibbles):
+                references[jp - nibbles + k] = f"LI #{name}:{nibbles - 1 - k}"
+            jump_notes[jp] = "halt" if target == jp else f"-> {name}"
+    out.write(f"; Disassembled from {filename} ({fmt}, {arch})\n")
+    counts = {"bytes": 0, "instructions": 0, "labels": len(names), "undecodable": 0, "seconds": 0.0}
+    expected = 0
+    for address, data in read_chunks(filename, fmt):
+        if address < expected:
+            raise ValueError(f"[Error] Data at 0x{address:04X} overlaps or precedes earlier data")
+        lines = []
+        if address > expected:
+            lines.append(f"    ; 0x{expected:04X}-0x{address - 1:04X}: not in the file\n")
+            counts["undecodable"] += address - expected
+        for a, op in enumerate(data, start=address):
+            name = names.get(a)
+            if name is not None:
+                lines.append(f"{name}:\n")
+            text = table[op]
+            if text is None:
+                lines.append(f"    ; {a:04X}: {op:02X} is not an instruction\n")
+                counts["undecodable"] += 1
+                counts["instructions"] -= 1
+                continue
+            text = references.get(a, text)
+            note = jump_notes.get(a)
+            if note is not None:
+                lines.append(f"    {text:<16}; {a:04X}: {op:02X}  {note}\n")
+            else:
+                lines.append(f"    {text:<16}; {a:04X}: {op:02X}\n")
+        out.write("".join(lines))
+        expected = address + len(data)
+        counts["bytes"] += len(data)
+        counts["instructions"] += len(data)
+    counts["seconds"] = time.perf_counter() - started
+    return counts
+
+class _Sink:
+    """Text stream that only counts what is written to it"""
+    def __init__(self):
+        self.chars = 0
+        self.largest = 0
+
+    def write(self, text:str) -> int:
+        self.chars += len(text)
+        self.largest = max(self.largest, len(text))
+        return len(text)
+
+def self_test():
+    import io
+    import random
+    import tempfile
+    from pathlib import Path
+    import assembler
+    testfuncs.expect(("LI #5", "JP Z", "NP", None, None), lambda: (TEXT["HC4"][0xA5], TEXT["HC4"][0xE4], TEXT["HC4"][0xE1], TEXT["HC4"][0xFF], TEXT["HC4E"][0x00]))
+
+    root = Path(__file__).resolve().parent
+    def round_trip(filename:str, arch:str) -> tuple[bool, dict, dict[str, int]]:
+        out = io.StringIO()
+        counts = disassemble(filename, out, arch)
+        job = assembler.Assembler(arch)
+        image = job.run(out.getvalue().splitlines())
+        return bytes(assembler.adrlist2bitstream(image, 255)) == bytes(read_image(filename)), counts, job.ls.labels
+    for name, arch, fmt in (("countlcd.hex", "HC4", "ihex"), ("dice4e.hex", "HC4E", "ihex"), ("alltest.hex", "HC4", "ihex"),
+                            ("macrotest.hex", "HC4", "vhex"), ("inctest.hex", "HC4E", "vhex")):
+        filename = str(root / "test_files" / name)
+        testfuncs.expect(fmt, detect_format, filename)
+        same, counts, _ = round_trip(filename, arch)
+        testfuncs.expect((True, 0), lambda: (same, counts["undecodable"]))
+    # every recovered label is a label of the source
+    with open(root / "test_files" / "countlcd.asm", 'r', encoding='utf-8') as f:
+        source = assembler.Assembler("HC4", [str(root.parent / "include")])
+        source.run(f.read().splitlines())
+    _, counts, labels = round_trip(str(root / "test_files" / "countlcd.hex"), "HC4")
+    testfuncs.expect(True, lambda: set(labels.values()) <= set(source.ls.labels.values()) and counts["labels"] == len(labels) > 10)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Intel HEX with an extended linear address, a gap and a bad checksum
+        hexfile = Path(tmp) / "gap.hex"
+        hexfile.write_text(":03000000A1A1E0DB\n:02001000A3E06B\n:020000040001F9\n:01000000E11E\n:00000001FF\n", encoding='ascii')
+        testfuncs.expect([(0, b"\xa1\xa1\xe0"), (0x10, b"\xa3\xe0"), (0x10000, b"\xe1")], lambda: list(read_chunks(str(hexfile))))
+        out = io.StringIO()
+        counts = disassemble(str(hexfile), out, "HC4E")
+        testfuncs.expect((6, 0x10000 - 5, 1), lambda: (counts["instructions"], counts["undecodable"], counts["labels"]))
+        testfuncs.expect(True, lambda: "    LI #L_11:1      ; 0000: A1\n" in out.getvalue() and "not in the file" in out.getvalue())
+        hexfile.write_text(":03000000A1A1E0DC\n", encoding='ascii')
+        testfuncs.expect_raises(ValueError, lambda: list(read_chunks(str(hexfile))))
+
+        # a multi-megabyte dump is streamed: nothing larger than a chunk is held
+        rng = random.Random(1)
+        valid = bytes(op for op in range(256) if TEXT["HC4"][op] is not None)
+        dump = bytearray(rng.choice(valid) for _ in range(1 << 20))
+        for address in range(0, len(dump) - 4, 997):
+            target = rng.randrange(1 << 12)
+            dump[address:address + 4] = bytes([0xA0 | target >> 8, 0xA0 | (target >> 4) & 15, 0xA0 | target & 15, 0xE0])
+        binfile = Path(tmp) / "dump.bin"
+        binfile.write_bytes(bytes(dump) * 2)
+        sink = _Sink()
+        counts = disassemble(str(binfile), sink, "HC4")
+        testfuncs.expect((2 << 20, 0), lambda: (counts["instructions"], counts["undecodable"]))
+        testfuncs.expect(True, lambda: sink.largest * 16 < sink.chars)
+        print(f"[Info] disassembler.py : {counts['bytes'] / counts['seconds'] / 1e6:.2f} MB/s, {sink.chars >> 20} MiB of text")
+    print("[OK] disassembler.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,290 @@
+import os
+import select
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Sequence
+import testfuncs
+import serialproto
+import simulator
+
+try:
+    import pty
+    import tty
+except ImportError:  # not POSIX
+    pty = tty = None  # type: ignore[assignment]
+
+class FakeDevice:
+    """
+    HC4E board with its loader firmware on a pseudo-terminal, for testing load4e.py without hardware.\n
+    Open port with pyserial like a real board. The firmware is modelled by the simulator:
+        l\\n + Intel HEX : load the program, "[OK]" or "[NG] ..." (the text protocol)
+        b\\n             : binary protocol of serialproto (refused when binary=False, like older firmware)
+        rc\\n            : a header line, then "r0,...,r15,pc,inst"
+        t\\n             : two header lines, then one register line per instruction executed,
+                          trace_hz lines per second (slower if the host does not keep up),
+                          until "q" or Ctrl-C arrives
+    damage makes the binary receiver treat those frames as corrupted.
+    """
+    def __init__(self, binary:bool=True, damage:Sequence[int]=(), trace_hz:float=1000.0, code:bytes=b""):
+        if pty is None or tty is None:
+            raise ImportError("[Error] FakeDevice needs a POSIX pseudo-terminal")
+        self.binary = binary
+        self.damage = damage
+        self.trace_hz = trace_hz
+        self.machine = simulator.Machine("HC4E", code)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        # commands received, for the tests
+        self.commands: list[str] = []
+        self.loads = 0
+        self._receiver: Optional[serialproto.Receiver] = None
+        self._hex: Optional[list[bytes]] = None
+        self._tracing = False
+        self._buffer = bytearray()
+        # trace lines not sent yet; the trace waits for them like firmware waiting on its UART
+        self._outbox = bytearray()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __repr__(self) -> str:
+        return f"FakeDevice({self.port}, loads={self.loads})"
+
+    def __enter__(self) -> "FakeDevice":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _send(self, data:bytes):
+        view = memoryview(data)
+        while view and not self._stop.is_set():
+            try:
+                n = os.write(self.master, view)
+            except BlockingIOError:
+                select.select([], [self.master], [], 0.05)
+                continue
+            view = view[n:]
+
+    def _drain(self):
+        """Write what the line takes of the trace output, without waiting"""
+        try:
+            n = os.write(self.master, self._outbox)
+        except BlockingIOError:
+            return
+        del self._outbox[:n]
+
+    def _registers(self) -> bytes:
+        m = self.machine
+        return (",".join(str(v) for v in m.regs + [m.pc, m.rom[m.pc]]) + "\n").encode()
+
+    def _run(self):
+        next_sample = time.perf_counter()
+        while not self._stop.is_set():
+            wait = max(0.0, next_sample - time.perf_counter()) if self._tracing and not self._outbox else 0.05
+            readable, writable, _ = select.select([self.master], [self.master] if self._outbox else [], [], min(wait, 0.05))
+            if writable:
+                self._drain()
+            if readable:
+                try:
+                    data = os.read(self.master, 4096)
+                except (BlockingIOError, OSError):
+                    data = b""
+                self._receive(data)
+            if self._tracing and not self._outbox:
+                now = time.perf_counter()
+                lines = []
+                while next_sample <= now and len(lines) < 1000:
+                    try:
+                        self.machine.step()
+                    except ValueError as e:  # invalid instruction
+                        lines.append(f"{e}\n".encode())
+                        self._tracing = False
+                        break
+                    lines.append(self._registers())
+                    next_sample += 1.0 / self.trace_hz
+                if lines:
+                    self._outbox += b"".join(lines)
+                    self._drain()
+                next_sample = max(next_sample, now - 0.1)
+
+    def _receive(self, data:bytes):
+        if self._receiver is not None:
+            self._send(self._receiver.feed(data))
+            if self._receiver.result is not None:
+                if self._receiver.result.startswith(b"[OK]"):
+                    self.machine.load(bytes(self._receiver.image))
+                    self.machine.reset()
+                    self.loads += 1
+                self._send(self._receiver.result)
+                self._receiver = None
+            return
+        self._buffer += data
+        while b"\n" in self._buffer:
+            line, _, rest = bytes(self._buffer).partition(b"\n")
+            self._buffer = bytearray(rest)
+            self._line(line.strip())
+            if self._receiver is not None:
+                # frames that came with the handshake
+                data, self._buffer = bytes(self._buffer), bytearray()
+                self._receive(data)
+                return
+
+    def _line(self, line:bytes):
+        if self._hex is not None:
+            self._hex.append(line)
+            if line.startswith(b":00000001"):
+                self._load_hex(self._hex)
+                self._hex = None
+            return
+        command = line.decode(errors='replace')
+        self.commands.append(command)
+        if self._tracing:
+            if command.lower() in ("q", "\x03"):
+                self._tracing = False
+            return
+        if command == "l":
+            self._hex = []
+            self._send(b"Ready\n")
+        elif command == "b" and self.binary:
+            self._receiver = serialproto.Receiver(len(self.machine.rom), damage=self.damage, program=bytes(self.machine.rom))
+            self._send(self._receiver.ready())
+        elif command == "rc":
+            self._send(b"r0,r1,r2,r3,r4,r5,r6,r7,r8,r9,r10,r11,r12,r13,r14,r15,pc,inst\n" + self._registers())
+        elif command == "t":
+            self._tracing = True
+            self._send(b"Trace start (q: quit)\nr0,r1,r2,r3,r4,r5,r6,r7,r8,r9,r10,r11,r12,r13,r14,r15,pc,inst\n")
+        elif command:
+            self._send(f"Unknown command: {command}\n".encode())
+
+    def _load_hex(self, records:list[bytes]):
+        image = bytearray(b"\xff") * len(self.machine.rom)
+        for record in records:
+            try:
+                data = bytes.fromhex(record[1:].decode())
+            except ValueError:
+                data = b""
+            if not record.startswith(b":") or len(data) < 5 or sum(data) & 0xFF:
+                self._send(b"[NG] checksum\n")
+                return
+            if data[3] == 0:
+                address = data[1] << 8 | data[2]
+                image[address:address + data[0]] = data[4:-1]
+        self.machine.load(bytes(image))
+        self.machine.reset()
+        self.loads += 1
+        self._send(b"[OK]\n")
+
+def self_test():
+    import json
+    import subprocess
+    import sys
+    import tempfile
+    try:
+        import serial  # noqa: F401  (load4e.py needs pyserial)
+    except ImportError:
+        print("[Info] fakedevice.py : pyserial is not installed, skipped")
+        return
+    if pty is None:
+        print("[Info] fakedevice.py : no pseudo-terminals on this platform, skipped")
+        return
+    root = Path(__file__).resolve().parent.parent
+    hexfile = root / "py" / "test_files" / "dice4e.hex"
+    image = bytes.fromhex("".join(line[9:-2] for line in hexfile.read_text().split() if line[7:9] == "00"))
+    with tempfile.TemporaryDirectory() as state:
+        def load4e(*args:str) -> dict:
+            result = subprocess.run([sys.executable, "load4e.py", *args, "--state-dir", state, "-j"], capture_output=True, text=True, cwd=root, timeout=60)
+            if result.returncode != 0:
+                raise AssertionError(f"[FAIL] load4e.py {' '.join(args)}: {result.stdout}{result.stderr}")
+            return json.loads(result.stdout.splitlines()[-1])
+
+        # binary protocol, clean and with frames damaged on the line
+        for damage, retried in (((), False), ((1, 2), True)):
+            with FakeDevice(damage=damage) as device:
+                stats = load4e("load", "--file", str(hexfile), "--port", device.port, "--chunk-size", "8", "--window", "2")
+                testfuncs.expect(("binary", 22, 4, retried, True), lambda: (stats["protocol"], stats["bytes"], stats["frames"], stats["retries"] > 0, bytes(device.machine.rom[:22]) == image))
+        # older firmware without binary mode: the text protocol is used instead
+        with FakeDevice(binary=False) as device:
+            stats = load4e("load", "--file", str(hexfile), "--port", device.port)
+            testfuncs.expect(("hex", 1, True), lambda: (stats["protocol"], device.loads, bytes(device.machine.rom[:22]) == image))
+            testfuncs.expect(["b", "l"], lambda: device.commands)
+            regs = load4e("register", "--port", device.port)
+            testfuncs.expect((0, 0xE1), lambda: (regs["pc"], regs["inst"]))
+        with FakeDevice(binary=False) as device:
+            result = subprocess.run([sys.executable, "load4e.py", "load", "--file", str(hexfile), "--port", device.port, "--protocol", "binary", "--state-dir", state],
+                                    capture_output=True, text=True, cwd=root, timeout=60)
+            testfuncs.expect((1, 0), lambda: (result.returncode, device.loads))
+        # differential upload: after one edit only its page goes out; a stale record costs a full upload, never a wrong program
+        edited = Path(state) / "edited.bin"
+        edited.write_bytes(image[:20] + b"\x00" + image[21:])
+        with FakeDevice() as device:
+            stats = load4e("load", "--file", str(hexfile), "--port", device.port)
+            testfuncs.expect(("full", 2), lambda: (stats["mode"], stats["pages_sent"]))
+            stats = load4e("load", "--file", str(edited), "--port", device.port)
+            testfuncs.expect(("diff", 1, True), lambda: (stats["mode"], stats["pages_sent"], bytes(device.machine.rom[:22]) == edited.read_bytes()))
+            device.machine.rom[0] ^= 1
+            stats = load4e("load", "--file", str(hexfile), "--port", device.port)
+            testfuncs.expect(("diff, then full", 3, True), lambda: (stats["mode"], device.loads, bytes(device.machine.rom[:22]) == image))
+            stats = load4e("load", "--file", str(hexfile), "--port", device.port)
+            testfuncs.expect(("diff", 0, 1), lambda: (stats["mode"], stats["pages_sent"], stats["frames"]))
+        # trace: every instruction arrives, in batches, and q stops the stream at once
+        with FakeDevice(code=image, trace_hz=20000) as device:
+            recording = str(Path(state) / "trace.hct")
+            process = subprocess.Popen([sys.executable, "load4e.py", "trace", "--port", device.port, "-j", "--rate", "50", "--record", recording],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root)
+            time.sleep(1.0)
+            assert process.stdin is not None
+            process.stdin.write(b"q\n")
+            process.stdin.flush()
+            stopping = time.perf_counter()
+            output, errors = process.communicate(timeout=60)
+            stopped = time.perf_counter() - stopping
+            batches = [json.loads(line) for line in output.splitlines()]
+            records = [record for batch in batches for record in batch]
+            machine = simulator.Machine("HC4E", image)
+            expected = []
+            for _ in records:
+                machine.step()
+                expected.append((machine.regs[:], machine.pc))
+            testfuncs.expect((b"", True, True, True), lambda: (errors, len(records) > 1000, len(batches) < len(records) // 10,
+                                                          [(r["regs"], r["pc"]) for r in records] == expected))
+            testfuncs.expect((True, ["t", "q", "\x03"]), lambda: (stopped < 0.5, device.commands))
+        # the recording holds the same records; replay finds those at a label through the index
+        source = str(root / "py" / "test_files" / "dice4e.asm")
+        read = simulator.load_source(Path(source).read_text().splitlines(), "HC4E").labels["READ"]
+        result = subprocess.run([sys.executable, "load4e.py", "replay", "--file", recording, "--pc", "read", "--source", source, "-j"],
+                                capture_output=True, text=True, cwd=root, timeout=60)
+        replayed = [record for line in result.stdout.splitlines() for record in json.loads(line)]
+        at_read = [n for n, record in enumerate(records) if record["pc"] == read]
+        testfuncs.expect((True, True), lambda: (len(at_read) > 0, [record["n"] for record in replayed] == at_read))
+        testfuncs.expect(True, lambda: all({k: record[k] for k in ("regs", "pc", "inst")} == records[record["n"]] for record in replayed))
+        # labels of a source that includes from the repository's include/ directory
+        result = subprocess.run([sys.executable, "load4e.py", "replay", "--file", recording, "--pc", "end", "--source", str(root / "py" / "test_files" / "inctest.asm"), "-a", "HC4E", "-j"],
+                                capture_output=True, text=True, cwd=root, timeout=60)
+        testfuncs.expect((0, ""), lambda: (result.returncode, result.stderr))
+        # hcxprof.py counts the same samples from the live trace and from the recording's index
+        profiles = [json.loads(subprocess.run([sys.executable, "hcxprof.py", source, "-a", "HC4E", "-j", *args], input=output.decode(),
+                                              capture_output=True, text=True, cwd=root, timeout=60).stdout)
+                    for args in (["--trace", "-"], ["--recording", recording])]
+        testfuncs.expect((len(records), True, "READ"), lambda: (profiles[0]["samples"], profiles[0] == profiles[1], profiles[0]["labels"][0]["label"]))
+        # sources that include from the repository's include/ directory
+        result = subprocess.run([sys.executable, "hcxprof.py", str(root / "py" / "test_files" / "inctest.asm"), "-a", "HC4E", "--simulate", "1000", "-j"],
+                                capture_output=True, text=True, cwd=root, timeout=60)
+        testfuncs.expect((0, 1000), lambda: (result.returncode, json.loads(result.stdout)["samples"]))
+    print("[OK] fakedevice.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
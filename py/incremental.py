@@ -0,0 +1,318 @@
+import itertools
+import os
+import random
+from typing import Optional, Sequence
+import testfuncs
+import assembler
+import lexer
+from assembler import Assembler, IncludeCache, LinkState, ProgramImage, DIRECTIVES, INST_TYPES
+
+def _is_directive(line:str) -> bool:
+    tok = lexer.strip_comment(line).split()
+    return bool(tok) and tok[0].upper() in DIRECTIVES
+
+def _directive_end(lines:Sequence[str]) -> int:
+    """Index just past the last directive line; a .MACRO block ends at its .ENDM"""
+    end = 0
+    for i, line in enumerate(lines):
+        if _is_directive(line):
+            end = i + 1
+    return end
+
+def _expands_directives(macro:assembler.MacroTemplate) -> bool:
+    """True if an expansion of macro includes files, which breaks the per-line bookkeeping"""
+    for literals, _, _, raw in macro.body:
+        if raw and DIRECTIVES.get(literals[0].split()[0].upper()) != 1:
+            return True
+    return False
+
+def _line_counts(processed:Sequence[tuple[str, int, str, int]], tokens:Sequence[lexer.Token], first:int, n:int) -> tuple[list[int], list[int], list[int]]:
+    """Processed lines, tokens and bytes produced by each of the n source lines numbered from first + 1"""
+    entries = [0] * n
+    token_counts = [0] * n
+    byte_counts = [0] * n
+    for pl in processed:
+        entries[pl[1] - first - 1] += 1
+    for tok in tokens:
+        i = tok.lineno - first - 1
+        token_counts[i] += 1
+        if tok.mnemonic in INST_TYPES:
+            byte_counts[i] += 1
+    return (entries, token_counts, byte_counts)
+
+class IncrementalAssembler:
+    """
+    Assembly result that can be updated in place while the source is edited.\n
+    Lines after the last directive (.DEF, .MACRO, .INCLUDE, ...) are tracked one by one. Editing
+    them only lexes and expands the edited lines, shifts what follows and re-patches the label
+    references whose target moved. Any other edit, or a change to an included file, falls back
+    to a full rebuild.
+    """
+    def __init__(self, lines:Sequence[str], arch:str="HC4", include_pathes:Optional[list[str]]=None, include_cache:Optional[IncludeCache]=None):
+        self.arch = arch
+        self.include_pathes: list[str] = list(include_pathes) if include_pathes is not None else []
+        self.include_cache = include_cache if include_cache is not None else IncludeCache()
+        self.full_builds = 0
+        self.incremental_builds = 0
+        self._build(list(lines))
+
+    def __repr__(self) -> str:
+        return f"IncrementalAssembler(arch={self.arch}, lines={len(self.lines)}, full_builds={self.full_builds}, incremental_builds={self.incremental_builds})"
+
+    @property
+    def processed(self) -> list[tuple[str, int, str, int]]:
+        return self.job.processed
+
+    @property
+    def tokens(self) -> list[lexer.Token]:
+        return self.job.tokens
+
+    @property
+    def image(self) -> ProgramImage:
+        assert self.job.image is not None
+        return self.job.image
+
+    @property
+    def ls(self) -> LinkState:
+        return self.job.ls
+
+    def _build(self, lines:list[str]):
+        head = _directive_end(lines)
+        job = Assembler(self.arch, self.include_pathes, include_cache=self.include_cache)
+        job.preprocess(lines[:head])
+        base = (len(job.processed), len(job.tokens), job.address)
+        job.preprocess(lines[head:], lineno_start=head)
+        job.assemble()
+        counts = _line_counts(job.processed[base[0]:], job.tokens[base[1]:], head, len(lines) - head)
+        # only replace the previous result once the build succeeded
+        self.job = job
+        self.lines = lines
+        # first line tracked one by one
+        self.head = head
+        # processed lines, tokens and bytes in front of the tracked lines
+        self._base = base
+        self._entries, self._token_counts, self._byte_counts = counts
+        self._incremental = not any(_expands_directives(m) for m in job.macros.macros.values())
+        self._include_stamps = self._stamp_includes()
+        self.full_builds += 1
+
+    def _stamp_includes(self) -> dict[str, tuple[int, int]]:
+        stamps = {}
+        for filename in self.job.include_files.values():
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            stamps[filename] = (st.st_mtime_ns, st.st_size)
+        return stamps
+
+    def edit(self, start:int, end:int, new_lines:Sequence[str]) -> bool:
+        """
+        Replace lines[start:end] (0-based) with new_lines and update the result.\n
+        Returns True if the edit was applied incrementally, False if it took a full rebuild.
+        On an error the previous result is kept.
+        """
+        if not 0 <= start <= end <= len(self.lines):
+            raise IndexError(f"[Error] Invalid edit range: {start}-{end} of {len(self.lines)} lines")
+        new_lines = list(new_lines)
+        if (start < self.head or not self._incremental or any(_is_directive(line) for line in new_lines)
+                or self._stamp_includes() != self._include_stamps):
+            self._build(self.lines[:start] + new_lines + self.lines[end:])
+            return False
+        self._splice(start, end, new_lines)
+        self.incremental_builds += 1
+        return True
+
+    def update(self, lines:Sequence[str]) -> bool:
+        """Take the whole new source and edit the lines between the common prefix and suffix"""
+        old = self.lines
+        limit = min(len(old), len(lines))
+        start = 0
+        while start < limit and old[start] == lines[start]:
+            start += 1
+        tail = 0
+        while tail < limit - start and old[-1 - tail] == lines[-1 - tail]:
+            tail += 1
+        return self.edit(start, len(old) - tail, lines[start:len(lines) - tail])
+
+    def _splice(self, start:int, end:int, new_lines:list[str]):
+        job = self.job
+        image = self.image
+        old_ls = job.ls
+        i0, i1 = start - self.head, end - self.head
+        pk, tk, ak = self._base
+        p0 = pk + sum(self._entries[:i0])
+        p1 = p0 + sum(self._entries[i0:i1])
+        t0 = tk + sum(self._token_counts[:i0])
+        t1 = t0 + sum(self._token_counts[i0:i1])
+        a0 = ak + sum(self._byte_counts[:i0])
+        a1 = a0 + sum(self._byte_counts[i0:i1])
+
+        # Preprocess and encode the new lines on their own. No directives are involved, so the
+        # defines and macros of the job are exactly the ones in effect at the edit.
+        sub = Assembler(self.arch, self.include_pathes, defines=job.defines, macros=job.macros, include_cache=job.include_cache)
+        sub.address = a0
+        level = job.defines.level
+        try:
+            sub.preprocess(new_lines, lineno_start=start)
+        finally:
+            while job.defines.level > level:
+                job.defines.end_scope()
+        sub_ls = LinkState()
+        sub_image = ProgramImage()
+        assembler.emit(sub.tokens, sub_ls, self.arch, sub_image, a0)
+        a2 = a0 + len(sub_image)
+        delta = a2 - a1
+
+        # new label table
+        removed = {tok.label for tok in itertools.islice(job.tokens, t0, t1) if tok.label is not None}
+        for name in sub_ls.labels:
+            if name in old_ls.labels and name not in removed:
+                raise ValueError(f"[Error] Duplicate label definition: {name}")
+        # labels right behind the edit share its end address up to the next instruction
+        following: set[str] = set()
+        for tok in itertools.islice(job.tokens, t1, None):
+            if tok.label is not None:
+                following.add(tok.label)
+            if tok.mnemonic is not None:
+                break
+        ls = LinkState()
+        moved = removed - sub_ls.labels.keys()
+        for name, addr in old_ls.labels.items():
+            if name in removed:
+                continue
+            if delta and (addr > a1 or (addr == a1 and name in following)):
+                addr += delta
+                moved.add(name)
+            ls.labels[name] = addr
+        for name, addr in sub_ls.labels.items():
+            if old_ls.labels.get(name) != addr:
+                moved.add(name)
+            ls.labels[name] = addr
+
+        # label references, in address order
+        for addr, label in old_ls.unresolved.items():
+            if addr < a0:
+                ls.unresolved[addr] = label
+        ls.unresolved.update(sub_ls.unresolved)
+        for addr, label in old_ls.unresolved.items():
+            if addr >= a1:
+                ls.unresolved[addr + delta] = label
+
+        # resolve new references and those whose target moved before touching anything
+        patches: list[tuple[int, int]] = []
+        for addr, label in ls.unresolved.items():
+            if a0 <= addr < a2 or label.split(":")[0].upper() in moved:
+                value = ls.parse_label(label)
+                if value is None:
+                    raise KeyError(f"[Error] Undefined label: {label}")
+                patches.append((addr, value))
+
+        for addr, value in patches:
+            if a0 <= addr < a2:
+                sub_image.code[addr - a0] += value
+        image.code[a0:a1] = sub_image.code
+        image.linenos[a0:a1] = sub_image.linenos
+        for addr, value in patches:
+            if not a0 <= addr < a2:
+                # label references are LI, whose opcode has a zero low nibble
+                image.code[addr] = (image.code[addr] & 0xF0) | value
+
+        dl = len(new_lines) - (end - start)
+        dp = len(sub.processed) - (p1 - p0)
+        if dl:
+            linenos = image.linenos
+            for addr in range(a2, len(linenos)):
+                linenos[addr] += dl
+        job.processed[p0:p1] = sub.processed
+        if dl or delta:
+            q = p0 + len(sub.processed)
+            job.processed[q:] = [(line, lineno + dl, unprocessed, addr + delta) for line, lineno, unprocessed, addr in itertools.islice(job.processed, q, None)]
+        for tok in sub.tokens:
+            tok.index += p0
+        job.tokens[t0:t1] = sub.tokens
+        if dl or dp:
+            for tok in itertools.islice(job.tokens, t0 + len(sub.tokens), None):
+                tok.lineno += dl
+                tok.index += dp
+
+        entries, token_counts, byte_counts = _line_counts(sub.processed, sub.tokens, start, len(new_lines))
+        self._entries[i0:i1] = entries
+        self._token_counts[i0:i1] = token_counts
+        self._byte_counts[i0:i1] = byte_counts
+        self.lines[start:end] = new_lines
+        job.address += delta
+        job.ls = ls
+
+def _expect_same(inc:IncrementalAssembler):
+    full = IncrementalAssembler(inc.lines, inc.arch, inc.include_pathes)
+    testfuncs.expect(
+        (bytes(full.image.code), list(full.image.linenos), full.ls.labels, full.ls.unresolved, full.processed, full.tokens),
+        lambda: (bytes(inc.image.code), list(inc.image.linenos), inc.ls.labels, inc.ls.unresolved, inc.processed, inc.tokens))
+
+def self_test():
+    header = [
+        ".DEF ACC r1",
+        ".MACRO PUSH2 x y",
+        "LI x",
+        "LI y",
+        ".ENDM",
+        ".MACRO GOTO target",
+        ".DEF TMP r2",
+        "LD TMP",
+        "LI #target:2",
+        "LI #target:1",
+        "LI #target:0",
+        "JP",
+        ".ENDM",
+    ]
+    body = ["START:", "LD ACC", "LOOP:", "PUSH2 #1 #2", "LI #LOOP:0", "GOTO LOOP", "END:", "GOTO END"]
+    inc = IncrementalAssembler(header + body)
+    _expect_same(inc)
+    n = len(header)
+    # same size, label moves, lines inserted and removed
+    testfuncs.expect(True, inc.edit, n + 1, n + 2, ["LD r2"])
+    _expect_same(inc)
+    testfuncs.expect(True, inc.edit, n + 1, n + 1, ["NP", "NP", "X: NP ; comment", ""])
+    _expect_same(inc)
+    testfuncs.expect(True, inc.edit, n + 3, n + 6, [])
+    _expect_same(inc)
+    testfuncs.expect(True, inc.edit, n + 2, n + 2, ["PUSH2 #3 #4"])
+    _expect_same(inc)
+    # errors keep the previous result
+    lines = list(inc.lines)
+    testfuncs.expect_raises(ValueError, inc.edit, n, n, ["LOOP: NP"])
+    loop = lines.index("LOOP:")
+    testfuncs.expect_raises(KeyError, inc.edit, loop, loop + 1, [])
+    testfuncs.expect(lines, lambda: inc.lines)
+    _expect_same(inc)
+    # directives force a full rebuild
+    testfuncs.expect(False, inc.edit, len(inc.lines), len(inc.lines), [".DEF ACC2 r2", "LD ACC2"])
+    _expect_same(inc)
+    testfuncs.expect(True, inc.update, inc.lines[:-1] + ["LD r3", "LD ACC2"])
+    _expect_same(inc)
+
+    # random edits match a full rebuild
+    rng = random.Random(1)
+    pool = ["NP", "LD ACC", "AD r2", "LI #0xF", "LI #LOOP:0", "LI #START:1", "PUSH2 #5 #6", "GOTO START", "GOTO END", "", "; note", "SM"]
+    inc = IncrementalAssembler(header + body + pool * 3)
+    label_id = 0
+    for _ in range(200):
+        start = rng.randrange(inc.head, len(inc.lines) + 1)
+        end = min(len(inc.lines), start + rng.randrange(3))
+        new_lines = [rng.choice(pool) for _ in range(rng.randrange(3))]
+        if rng.random() < 0.3:
+            label_id += 1
+            new_lines.append(f"L{label_id}: NP")
+            new_lines.append(f"LI #L{label_id}:0")
+        before = list(inc.lines)
+        try:
+            inc.edit(start, end, new_lines)
+        except (KeyError, ValueError):
+            testfuncs.expect(before, lambda: inc.lines)
+            continue
+        _expect_same(inc)
+    print("[OK] incremental.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
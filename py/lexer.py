@@ -0,0 +1,126 @@
+import re
+import sys
+from enum import Enum, auto
+from typing import Iterable, Iterator, Optional, Sequence, Union
+import testfuncs
+
+class opkind(Enum):
+    NONE = auto()
+    REGISTER = auto()
+    IMMEDIATE = auto()
+    LABEL = auto()
+    WORD = auto()
+    INVALID = auto()
+
+REGISTER_RE = re.compile(r"[rR]([0-9]*)")
+LABEL_REF_RE = re.compile(r"#([A-Za-z_][A-Za-z0-9_]*:[0-3])")
+IMMEDIATE_RE = re.compile(r"#((0x|0b)?[0-9a-fA-F]+)")
+
+class Token:
+    """
+    One lexed source line.\n
+    label    : label defined on this line (upper case) or None\n
+    mnemonic : instruction name (upper case, interned) or None\n
+    kind     : kind of the operand\n
+    value    : register number or immediate value, None otherwise\n
+    operand  : operand as written, or the label reference (NAME:n) for opkind.LABEL\n
+    lineno   : source line number\n
+    index    : index of the line in the preprocessed output
+    """
+    __slots__ = ("label", "mnemonic", "kind", "value", "operand", "lineno", "index")
+
+    def __init__(self, label:Optional[str], mnemonic:Optional[str], kind:opkind, value:Optional[int], operand:Optional[str], lineno:int, index:int):
+        self.label = label
+        self.mnemonic = mnemonic
+        self.kind = kind
+        self.value = value
+        self.operand = operand
+        self.lineno = lineno
+        self.index = index
+
+    def __repr__(self) -> str:
+        return f"Token(label={self.label}, mnemonic={self.mnemonic}, kind={self.kind.name}, value={self.value}, operand={self.operand}, lineno={self.lineno}, index={self.index})"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Token):
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in Token.__slots__)
+
+def strip_comment(line:str) -> str:
+    return line.split(";", 1)[0].replace("\t", " ").strip()
+
+def lex_operand(operand:str) -> tuple[opkind, Optional[int], str]:
+    """Classify an operand. Returns (kind, value, operand)"""
+    if operand.startswith("#"):
+        m = LABEL_REF_RE.match(operand)
+        if m:
+            return (opkind.LABEL, None, m.group(1))
+        m = IMMEDIATE_RE.match(operand)
+        if m:
+            try:
+                return (opkind.IMMEDIATE, int(m.group(1), 0), operand)
+            except ValueError:
+                pass
+        return (opkind.INVALID, None, operand)
+    m = REGISTER_RE.search(operand)
+    if m:
+        if m.group(1) == "":
+            return (opkind.INVALID, None, operand)
+        return (opkind.REGISTER, int(m.group(1)), operand)
+    return (opkind.WORD, None, operand)
+
+def lex_line(line:str, lineno:int, index:int=-1) -> Optional[Token]:
+    """Lex one preprocessed line. Returns None for empty lines."""
+    tok = line.split()
+    if not tok:
+        return None
+    label = None
+    if tok[0].endswith(":"):
+        label = tok[0][:-1].upper()
+        if len(tok) == 1:
+            return Token(label, None, opkind.NONE, None, None, lineno, index)
+        tok = tok[1:]
+    mnemonic = sys.intern(tok[0].upper())
+    if len(tok) == 1:
+        return Token(label, mnemonic, opkind.NONE, None, None, lineno, index)
+    kind, value, operand = lex_operand(tok[1])
+    return Token(label, mnemonic, kind, value, operand, lineno, index)
+
+def lex(lines:Iterable[Union[tuple[str, int], Sequence]]) -> list[Token]:
+    """
+    Lex preprocessed lines.\n
+    Input: iterable of tuples starting with (line:str, lineno:int)\n
+    Output: list of Token for the non-empty lines
+    """
+    tokens: list[Token] = []
+    for index, pl in enumerate(lines):
+        token = lex_line(pl[0], pl[1], index)
+        if token is not None:
+            tokens.append(token)
+    return tokens
+
+def as_tokens(code:Iterable[Union[Token, tuple[str, int]]]) -> Iterator[Token]:
+    """Pass Token through and lex (line, lineno) tuples on the fly"""
+    for index, item in enumerate(code):
+        if isinstance(item, Token):
+            yield item
+            continue
+        token = lex_line(item[0], item[1], index)
+        if token is not None:
+            yield token
+
+def self_test():
+    testfuncs.expect("LD r1", strip_comment, "LD\tr1  ; comment")
+    testfuncs.expect(None, lex_line, "   ", 1)
+    testfuncs.expect(Token("LOOP", None, opkind.NONE, None, None, 2, 0), lex_line, "loop:", 2, 0)
+    testfuncs.expect(Token("LOOP", "SM", opkind.NONE, None, None, 3, 1), lex_line, "LOOP: sm", 3, 1)
+    testfuncs.expect(Token(None, "SC", opkind.REGISTER, 10, "r10", 4, 2), lex_line, "SC r10", 4, 2)
+    testfuncs.expect(Token(None, "LI", opkind.IMMEDIATE, 3, "#0b11", 5, 3), lex_line, "li #0b11", 5, 3)
+    testfuncs.expect(Token(None, "LI", opkind.LABEL, None, "wait:2", 6, 4), lex_line, "LI #wait:2", 6, 4)
+    testfuncs.expect(Token(None, "JP", opkind.WORD, None, "nc", 7, 5), lex_line, "jp nc", 7, 5)
+    testfuncs.expect((opkind.INVALID, None, "#zz"), lex_operand, "#zz")
+    testfuncs.expect((opkind.INVALID, None, "r"), lex_operand, "r")
+    print("[OK] lexer.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,376 @@
+import itertools
+import time
+from typing import Iterator, Optional, Sequence
+import testfuncs
+import assembler
+from assembler import Assembler, INST_TYPES, JMP_FLAGS, ProgramImage, insttype
+from lexer import Token, opkind
+from simulator import ARCHS, CYCLES, _IO_INPUTS
+
+# Stack positions (0 = A) each instruction reads before it executes
+_READS = {"SM": (0, 1, 2), "SC": (2,), "SU": (0, 1), "AD": (0, 1), "XR": (0, 1), "OR": (0, 1), "AN": (0, 1),
+          "SA": (0,), "LM": (0, 1), "LD": (), "LI": (), "JP": (0, 1, 2), "NP": ()}
+_PUSHES = {"LI", "LD", "LM"}
+_FOLDS = {"AD", "SU", "XR", "OR", "AN"}
+
+class Saving:
+    """Bytes and cycles (per execution) an optimization saved on a source line"""
+    __slots__ = ("lineno", "bytes", "cycles", "reason")
+
+    def __init__(self, lineno:int, bytes:int, cycles:int, reason:str):
+        self.lineno = lineno
+        self.bytes = bytes
+        self.cycles = cycles
+        self.reason = reason
+
+    def __repr__(self) -> str:
+        return f"Saving(line {self.lineno}, bytes={self.bytes}, cycles={self.cycles}, {self.reason})"
+
+def _valid(tok:Token) -> bool:
+    kind = INST_TYPES.get(tok.mnemonic)  # type: ignore[arg-type]
+    if kind == insttype.REGISTER:
+        return tok.kind is opkind.REGISTER and tok.value is not None and tok.value <= 15
+    if kind == insttype.IMMEDIATE:
+        return tok.kind is opkind.LABEL or (tok.kind is opkind.IMMEDIATE and tok.value is not None and 0 <= tok.value <= 15)
+    if kind == insttype.JUMP:
+        return tok.operand is None or tok.operand.upper() in JMP_FLAGS
+    return kind is not None
+
+class _Block:
+    """Instructions entered only at the top (after a label) up to a label or JP, optimized on symbolic stack values"""
+    def __init__(self, arch:str, insts:list[Token]):
+        self.insts = insts
+        self.depth = ARCHS[arch][1]
+        self.mask = (1 << ARCHS[arch][0]) - 1
+        # HC4E reads INA through r14; HC4 reads its ports through LM, which is never removed
+        self.io_in = _IO_INPUTS[arch].start if arch == "HC4E" else None
+        self.savings: list[Saving] = []
+        # Token.index -> replacement Token (None: removed)
+        self.edits: dict[int, Optional[Token]] = {}
+
+    def pushed(self, tok:Token, regs:dict[int, tuple], fresh:Iterator) -> tuple:
+        if tok.mnemonic == "LI":
+            return ("c", tok.value) if tok.kind is opkind.IMMEDIATE else ("label", tok.operand.upper())  # type: ignore[union-attr]
+        if tok.mnemonic == "LD" and tok.value != self.io_in:
+            return regs.get(tok.value, ("r", tok.value))  # type: ignore[arg-type]
+        return ("?", next(fresh))
+
+    def values(self) -> list[list[tuple]]:
+        """Symbolic stack before each instruction and after the last; equal symbols hold equal values"""
+        stack: list[tuple] = [("in", 0), ("in", 1), ("in", 2)]
+        regs: dict[int, tuple] = {}
+        fresh = itertools.count()
+        out = []
+        for tok in self.insts:
+            out.append(stack)
+            m = tok.mnemonic
+            a, b, c = stack
+            if m in _PUSHES:
+                stack = [self.pushed(tok, regs, fresh), a, b]
+            elif m == "SA":
+                regs[tok.value] = a  # type: ignore[index]
+            elif m == "SC":
+                regs[tok.value] = c  # type: ignore[index]
+            elif m in _FOLDS:
+                v = _fold(m, a[1], b[1]) if a[0] == "c" and b[0] == "c" else None
+                regs[tok.value] = ("c", v) if v is not None else ("?", next(fresh))  # type: ignore[index]
+        out.append(stack)
+        return out
+
+    def liveness(self) -> list[tuple[list[bool], bool, bool]]:
+        """(stack positions, carry, zero) live after each instruction; all of them are live at the end"""
+        stack = [True, True, self.depth > 2]
+        carry = zero = True
+        after: list[tuple[list[bool], bool, bool]] = [([], False, False)] * len(self.insts)
+        for i in range(len(self.insts) - 1, -1, -1):
+            after[i] = (list(stack), carry, zero)
+            tok = self.insts[i]
+            m = tok.mnemonic
+            if m in _PUSHES:
+                stack = [stack[1], stack[2] and self.depth > 2, False]
+            if m in ("AD", "SU"):
+                carry = False
+            if m in ("AD", "SU", "SA", "SC", "SM", "XR", "OR", "AN"):
+                zero = False
+            for p in _READS.get(m, ()):  # type: ignore[arg-type]
+                if p < self.depth:
+                    stack[p] = True
+            if m == "JP":
+                # the code at the target may read anything
+                carry = zero = True
+        return after
+
+    def absolute_jump(self) -> bool:
+        """True if a JP goes to a constant address other than 0, which moving code would break"""
+        values = self.values()
+        for i, tok in enumerate(self.insts):
+            if tok.mnemonic == "JP":
+                a, b, c = values[i]
+                if a[0] == "c" and b[0] == "c" and (c[0] == "c" or self.depth == 2):
+                    target = ((c[1] if c[0] == "c" else 0) << 8 | b[1] << 4 | a[1]) & self.mask
+                    if target != 0:
+                        return True
+        return False
+
+    def remove(self, i:int, reason:str):
+        tok = self.insts.pop(i)
+        self.savings.append(Saving(tok.lineno, 1, CYCLES[tok.mnemonic], reason))  # type: ignore[index]
+        if tok.label is not None:
+            # the label stays on its own line
+            label_only = Token(tok.label, None, opkind.NONE, None, None, tok.lineno, tok.index)
+            self.edits[tok.index] = label_only
+            self.insts.insert(i, label_only)
+        else:
+            self.edits[tok.index] = None
+
+    def drop_loads(self) -> bool:
+        """Drop the first pushes of a run when the stack after the run is the same where it is still read"""
+        values, live = self.values(), self.liveness()
+        i = 0
+        while i < len(self.insts):
+            tok = self.insts[i]
+            if tok.mnemonic not in ("LI", "LD"):
+                i += 1
+                continue
+            k = i
+            while k < len(self.insts) and self.insts[k].mnemonic in ("LI", "LD") and (k == i or self.insts[k].label is None):
+                k += 1
+            stack_live = live[k - 1][0]
+            for j in range(k - i, 0, -1):
+                stack = values[i]
+                for n in range(i + j, k):
+                    stack = [values[n + 1][0], stack[0], stack[1]]
+                if all(not stack_live[p] or stack[p] == values[k][p] for p in range(3)):
+                    for _ in range(j):
+                        self.remove(i, f"redundant {self.insts[i].mnemonic}")
+                        if i < len(self.insts) and self.insts[i].mnemonic is None:
+                            # only the first push of a block can carry a label
+                            i += 1
+                    return True
+            i = k
+        return False
+
+    def fold(self) -> bool:
+        """LI #a; LI #b; op rX becomes LI #v; SA rX where the lost stack values and carry are not read"""
+        values, live = self.values(), self.liveness()
+        for m in range(2, len(self.insts)):
+            t1, t2, t3 = self.insts[m - 2:m + 1]
+            if not (t1.mnemonic == "LI" and t2.mnemonic == "LI" and t1.kind is opkind.IMMEDIATE and t2.kind is opkind.IMMEDIATE
+                    and t3.mnemonic in _FOLDS and t2.label is None and t3.label is None):
+                continue
+            stack_live, carry_live, _ = live[m]
+            if t3.mnemonic in ("AD", "SU") and carry_live:
+                continue
+            v = _fold(t3.mnemonic, t2.value, t1.value)  # type: ignore[arg-type]
+            before = values[m - 2]
+            folded = [("c", v), before[0], before[1]]
+            if not all(not stack_live[p] or folded[p] == values[m + 1][p] for p in range(3)):
+                continue
+            li = Token(t1.label, "LI", opkind.IMMEDIATE, v, f"#{v}", t1.lineno, t1.index)
+            sa = Token(None, "SA", opkind.REGISTER, t3.value, t3.operand, t3.lineno, t3.index)
+            self.insts[m - 2:m + 1] = [li, sa]
+            self.edits[t1.index], self.edits[t3.index] = li, sa
+            self.edits[t2.index] = None
+            self.savings.append(Saving(t3.lineno, 1, CYCLES["LI"], f"constant {t3.mnemonic} folded"))
+            return True
+        return False
+
+    def optimize(self) -> list[Token]:
+        if all(_valid(tok) for tok in self.insts):
+            while self.drop_loads() or self.fold():
+                pass
+        return self.insts
+
+def _fold(mnemonic:str, a:int, b:int) -> Optional[int]:
+    """Result of an ALU instruction with A = a and B = b"""
+    if mnemonic == "AD":
+        return (a + b) & 15
+    if mnemonic == "SU":
+        return (a - b) & 15
+    if mnemonic == "XR":
+        return a ^ b
+    if mnemonic == "OR":
+        return a | b
+    if mnemonic == "AN":
+        return a & b
+    return None
+
+def optimize(job:Assembler) -> list[Saving]:
+    """
+    Peephole pass over the tokens of a preprocessed job, run before assemble.\n
+    Within straight-line code between labels and jumps it drops LI/LD pushes that leave every
+    stack value that is read later unchanged (reloads after MOV/ADD, repeated LI #label:n),
+    folds LI #a; LI #b; op into LI #v; SA where that is unobservable, and removes unreachable
+    code after an unconditional JP. Jumps are assumed to go to labels, so a program that jumps
+    to a constant address other than 0 is left alone. Processed line addresses are recomputed,
+    and labels get their new addresses when the job assembles.
+    """
+    started = time.perf_counter()
+    blocks: list[_Block] = []
+    tokens: list = []
+    savings: list[Saving] = []
+    edits: dict[int, Optional[Token]] = {}
+    current: list[Token] = []
+    dead = False
+    def flush():
+        if current:
+            block = _Block(job.arch, list(current))
+            blocks.append(block)
+            tokens.append(block)
+            current.clear()
+    for tok in job.tokens:
+        if tok.label is not None or tok.mnemonic not in INST_TYPES:
+            flush()
+            dead = False
+            if tok.mnemonic not in INST_TYPES:
+                tokens.append(tok)
+                continue
+        if dead:
+            savings.append(Saving(tok.lineno, 1, 0, "unreachable after JP"))
+            edits[tok.index] = None
+            continue
+        current.append(tok)
+        if tok.mnemonic == "JP" and tok.operand is None:
+            flush()
+            dead = True
+    flush()
+    if any(block.absolute_jump() for block in blocks):
+        job.timings["optimize"] = job.timings.get("optimize", 0.0) + time.perf_counter() - started
+        return []
+
+    optimized: list[Token] = []
+    for item in tokens:
+        if isinstance(item, _Block):
+            optimized.extend(item.optimize())
+            savings.extend(item.savings)
+            edits.update(item.edits)
+        else:
+            optimized.append(item)
+    job.tokens = optimized
+
+    processed = job.processed
+    for index, tok in edits.items():
+        line, lineno, unprocessed_line, address = processed[index]
+        if tok is None:
+            processed[index] = ("", lineno, f"; {unprocessed_line} [-O]", address)
+        elif tok.mnemonic is None:
+            processed[index] = (f"{tok.label}:", lineno, f"{tok.label}:  ; {unprocessed_line} [-O]", address)
+        else:
+            text = f"{tok.mnemonic} {tok.operand}" if tok.operand is not None else tok.mnemonic
+            if tok.label is not None:
+                text = f"{tok.label}: {text}"
+            if text.split() != line.upper().split():
+                unprocessed_line = f"{text}  ; {unprocessed_line} [-O]"
+            processed[index] = (text, lineno, unprocessed_line, address)
+    instructions = {tok.index for tok in optimized if tok.mnemonic in INST_TYPES}
+    address = 0
+    for index, (line, lineno, unprocessed_line, _) in enumerate(processed):
+        processed[index] = (line, lineno, unprocessed_line, address)
+        if index in instructions:
+            address += 1
+    job.address = address
+    job.timings["optimize"] = job.timings.get("optimize", 0.0) + time.perf_counter() - started
+    return sorted(savings, key=lambda s: s.lineno)
+
+def summarize(savings:Sequence[Saving]) -> list[tuple[int, int, int, str]]:
+    """(lineno, bytes, cycles, reasons) per source line"""
+    lines: dict[int, list] = {}
+    for s in savings:
+        entry = lines.setdefault(s.lineno, [0, 0, []])
+        entry[0] += s.bytes
+        entry[1] += s.cycles
+        if s.reason not in entry[2]:
+            entry[2].append(s.reason)
+    return [(lineno, b, c, ", ".join(reasons)) for lineno, (b, c, reasons) in sorted(lines.items())]
+
+def _assemble(lines:list[str], arch:str="HC4", optimize_:bool=True, include_pathes:Optional[list[str]]=None) -> tuple[Assembler, ProgramImage, list[Saving]]:
+    job = Assembler(arch, include_pathes if include_pathes is not None else [])
+    job.preprocess(lines)
+    savings = optimize(job) if optimize_ else []
+    image = job.assemble()
+    return job, image, savings
+
+def self_test():
+    import random
+    from pathlib import Path
+    import simulator
+    # MOVI/MOV reloads, a repeated GOTO and code after it
+    lines = ["LI #3", "SA r1", "LI #3", "SA r2", "LD r2", "SA r3", "LD r2", "SA r4",
+             "LI #END:2", "LI #END:1", "LI #END:0", "JP NC", "LI #END:2", "LI #END:1", "LI #END:0", "JP", "LI #7", "SA r5",
+             "END:", "LI #2", "LI #5", "XR r6", "LI #END2:2", "LI #END2:1", "LI #END2:0", "END2:", "JP"]
+    job, image, savings = _assemble(lines)
+    testfuncs.expect([(3, 1, 1, "redundant LI"), (5, 1, 1, "redundant LD"), (7, 1, 1, "redundant LD"),
+                      (13, 1, 1, "redundant LI"),
+                      (14, 1, 1, "redundant LI"), (15, 1, 1, "redundant LI"), (17, 1, 0, "unreachable after JP"), (18, 1, 0, "unreachable after JP"),
+                      (22, 1, 1, "constant XR folded")], summarize, savings)
+    testfuncs.expect((0x0A, 0x0F, 16), lambda: (job.ls.labels["END"], job.ls.labels["END2"], len(image)))
+    testfuncs.expect([("", 3, "; LI #3 [-O]", 2), ("SA r2", 4, "SA r2", 2)], lambda: job.processed[2:4])
+    testfuncs.expect([("LI #7", 20, "LI #7  ; LI #2 [-O]", 10), ("", 21, "; LI #5 [-O]", 11), ("SA r6", 22, "SA r6  ; XR r6 [-O]", 11)],
+                     lambda: job.processed[19:22])
+    # the carry of AD is read, so it is not folded; B is read by AD, so the second LD stays
+    job, _, savings = _assemble(["LI #9", "LI #8", "AD r1", "LI #0", "LI #0", "LI #0", "JP C", "LD r1", "LD r1", "AD r2"])
+    testfuncs.expect([], lambda: savings)
+    # a jump to a constant address leaves the program alone
+    job, _, savings = _assemble(["LI #0", "SA r1", "LI #0", "SA r1", "LI #0", "LI #1", "LI #0", "JP"])
+    testfuncs.expect([], lambda: savings)
+
+    # random programs run the same with and without -O; label values are pushed over after
+    # every jump and label so that no register or memory nibble depends on where code moved
+    rng = random.Random(4)
+    compared = changed = 0
+    for arch in ("HC4", "HC4E"):
+        mnemonics = list(assembler.INST_DICT_M[arch])
+        flush = ["LI #0", "LI #0", "LI #0"]
+        for case in range(300):
+            body: list = []
+            for n in range(30):
+                if rng.random() < 0.15:
+                    body += [f"L{n}:"] + flush
+                m = rng.choice(mnemonics + ["LI", "LI", "LD", "LD"])
+                if m == "JP":
+                    body.append(("JP", rng.choice(["", " C", " NC", " Z", " NZ"])))
+                elif INST_TYPES[m] == insttype.REGISTER:
+                    body.append(f"{m} r{rng.randrange(16)}")
+                elif m == "LI":
+                    body.append(f"LI #{rng.randrange(4) if rng.random() < 0.5 else rng.randrange(16)}")
+                else:
+                    body.append(m)
+            labels = [line[:-1] for line in body if isinstance(line, str) and line.endswith(":")] + ["END"]
+            lines = []
+            for line in body:
+                if isinstance(line, tuple):
+                    target = rng.choice(labels)
+                    nibbles = (2, 1, 0) if arch == "HC4" else (1, 0)
+                    lines += [f"LI #{target}:{k}" for k in nibbles] + [line[0] + line[1]] + flush
+                else:
+                    lines.append(line)
+            lines += [f"LI #END:{k}" for k in ((2, 1, 0) if arch == "HC4" else (1, 0))] + ["END:", "JP"]
+            results = []
+            for optimize_ in (False, True):
+                job, image, savings = _assemble(lines, arch, optimize_)
+                m = simulator.Machine(arch, bytes(image.code), job.ls.labels)
+                m.inputs = {0xF0: 5, 0xF3: 10, 14: 9}
+                reason = m.run(5000)
+                results.append((reason, m.regs, bytes(m.mem), m.carry, m.zero, [(port, v) for _, port, v in m.io_log]))
+            if results[0][0] == "halt":
+                compared += 1
+                changed += bool(savings)
+                if results[0] != results[1]:
+                    raise AssertionError(f"[FAIL] -O changes what this {arch} program does: {lines}\n{results}")
+    testfuncs.expect(True, lambda: compared > 100 and changed > compared // 2)
+    print(f"[OK] {compared} random programs ({changed} of them changed) behave the same with -O.")
+
+    root = Path(__file__).resolve().parent
+    include = [str(root.parent / "include")]
+    with open(root / "test_files" / "countlcd.asm", 'r', encoding='utf-8') as f:
+        countlcd = f.read().splitlines()
+    _, plain, _ = _assemble(countlcd, "HC4", False, include)
+    job, image, savings = _assemble(countlcd, "HC4", True, include)
+    testfuncs.expect(True, lambda: len(image) + sum(s.bytes for s in savings) == len(plain))
+    m = simulator.Machine("HC4", bytes(image.code), job.ls.labels)
+    testfuncs.expect("until", m.run, 2000000, "main")
+    testfuncs.expect("Hello!", lambda: simulator.lcd_text(m.io_log))
+    print("[OK] optimizer.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
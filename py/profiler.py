@@ -0,0 +1,198 @@
+import json
+from array import array
+from bisect import bisect_right
+from typing import IO, Iterable, Optional, Sequence, Union
+import testfuncs
+import assembler
+from assembler import LinkState, ProgramImage
+import simulator
+from simulator import ARCHS, CYCLES, DECODE
+
+class Profile:
+    """
+    PC histogram of a run, mapped back to the source.\n
+    Samples are PC values, one per instruction executed, from a trace stream, a recording or the
+    simulator. Each address is charged the cycles of its instruction, and is attributed to its
+    source line (the macro call for expanded code) through the line numbers of the image, and to
+    the label at or before it. report() and annotations() follow timing.Analysis, so
+    hcxasm.write_list prints the listing with the share of each instruction.
+    """
+    def __init__(self, image:ProgramImage, ls:LinkState, processed:Sequence[tuple[str, int, str, int]], arch:str="HC4", top:int=10):
+        if arch not in ARCHS:
+            raise ValueError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        self.top = top
+        self.image = image
+        self.ls = ls
+        self.processed = processed
+        pc_bits, _ = ARCHS[arch]
+        self.mask = (1 << pc_bits) - 1
+        self.counts = array("Q", bytes(8 << pc_bits))
+        self.weights = bytes(self._cycles(address) for address in range(1 << pc_bits))
+        names: dict[int, str] = {}
+        for label, address in ls.labels.items():
+            names.setdefault(address, label)
+        self.label_addresses = sorted(names)
+        self.label_names = [names[address] for address in self.label_addresses]
+        # source text of each line: the call for macro expansions, else the instruction
+        self.sources: dict[int, str] = {}
+        for _, lineno, unprocessed, _ in processed:
+            text = unprocessed.strip()
+            if text.startswith(";") and text.endswith("[MACRO]"):
+                self.sources[lineno] = text[1:-len("[MACRO]")].strip() + "  (macro)"
+            elif text and not text.startswith(";"):
+                self.sources.setdefault(lineno, text)
+
+    def __repr__(self) -> str:
+        return f"Profile(arch={self.arch}, samples={self.samples})"
+
+    def _cycles(self, address:int) -> int:
+        if address not in self.image:
+            return 0
+        entry = DECODE[self.arch][self.image[address][0]]
+        return CYCLES[entry[0]] if entry is not None else 0
+
+    def add(self, pcs:Iterable[int]):
+        counts, mask = self.counts, self.mask
+        for pc in pcs:
+            counts[pc & mask] += 1
+
+    def add_counts(self, histogram:dict[int, int]):
+        for pc, count in histogram.items():
+            self.counts[pc & self.mask] += count
+
+    def add_trace(self, stream:IO[str]) -> int:
+        """
+        Add the records of load4e.py trace -j (lines holding a record or a JSON array of them)
+        as they arrive, until the end of stream. Returns the lines that were not records.
+        """
+        skipped = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                self.add(record["pc"] for record in (data if isinstance(data, list) else [data]))
+            except (ValueError, TypeError, KeyError):
+                skipped += 1
+        return skipped
+
+    def add_run(self, machine:simulator.Machine, max_instructions:int, until:Union[None, str, int, Iterable[Union[str, int]]]=None) -> str:
+        """Run machine for at most max_instructions, counting the PC of each; returns the stop reason like Machine.run"""
+        if until is None:
+            stops: set[int] = set()
+        elif isinstance(until, (str, int)):
+            stops = {machine.label(until)}
+        else:
+            stops = {machine.label(u) for u in until}
+        counts, mask = self.counts, self.mask
+        for i in range(max_instructions):
+            pc = machine.pc
+            if i and pc in stops:
+                return "until"
+            counts[pc & mask] += 1
+            if machine.step() == "halt":
+                return "halt"
+        return "limit"
+
+    @property
+    def samples(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def cycles(self) -> int:
+        return sum(count * weight for count, weight in zip(self.counts, self.weights))
+
+    def label_of(self, address:int) -> Optional[str]:
+        """The label at or before address"""
+        i = bisect_right(self.label_addresses, address) - 1
+        return self.label_names[i] if i >= 0 else None
+
+    def by_line(self) -> list[tuple[int, int, int, list[int]]]:
+        """(lineno, samples, cycles, addresses) per source line with samples, most cycles first"""
+        lines: dict[int, list] = {}
+        for address, count in enumerate(self.counts):
+            if count and address in self.image:
+                entry = lines.setdefault(self.image[address][1], [0, 0, []])
+                entry[0] += count
+                entry[1] += count * self.weights[address]
+                entry[2].append(address)
+        return sorted(((lineno, s, c, a) for lineno, (s, c, a) in lines.items()), key=lambda row: (-row[2], row[0]))
+
+    def by_label(self) -> list[tuple[str, int, int]]:
+        """(label, samples, cycles) for the code from each label to the next, most cycles first"""
+        labels: dict[str, list[int]] = {}
+        for address, count in enumerate(self.counts):
+            if count:
+                entry = labels.setdefault(self.label_of(address) or "(no label)", [0, 0])
+                entry[0] += count
+                entry[1] += count * self.weights[address]
+        return sorted(((name, s, c) for name, (s, c) in labels.items()), key=lambda row: (-row[2], row[0]))
+
+    def _share(self, cycles:int, total:int) -> str:
+        return f"{100.0 * cycles / total:5.1f}%" if total else "  0.0%"
+
+    def annotations(self) -> dict[int, str]:
+        """Address -> comment for the listing: share of the cycles and samples"""
+        total = self.cycles
+        return {address: f"{self._share(count * self.weights[address], total).strip()} ({count} samples)"
+                for address, count in enumerate(self.counts) if count and address in self.image}
+
+    def report(self) -> list[str]:
+        """Flat profile: the top lines and labels by cycles"""
+        total = self.cycles
+        outside = sum(count for address, count in enumerate(self.counts) if count and address not in self.image)
+        lines = [f"Profile: {self.samples} samples, {total} cycles"
+                 + (f" ({outside} samples outside the program)" if outside else "") + ":",
+                 f"Top {self.top} lines:"]
+        for lineno, samples, cycles, addresses in self.by_line()[:self.top]:
+            span = f"{addresses[0]:04X}-{addresses[-1]:04X}" if len(addresses) > 1 else f"{addresses[0]:04X}"
+            label = self.label_of(addresses[0]) or ""
+            lines.append(f"  {self._share(cycles, total)} {cycles:10} cycles  line {lineno:4}  {span:<9}  {label:<20} {self.sources.get(lineno, '')}")
+        lines.append(f"Top {self.top} labels:")
+        for name, samples, cycles in self.by_label()[:self.top]:
+            lines.append(f"  {self._share(cycles, total)} {cycles:10} cycles  {name}")
+        return lines
+
+    def to_json(self) -> dict:
+        total = self.cycles
+        return {
+            "samples": self.samples, "cycles": total,
+            "lines": [{"line": lineno, "source": self.sources.get(lineno, ""), "label": self.label_of(addresses[0]),
+                       "addresses": addresses, "samples": samples, "cycles": cycles}
+                      for lineno, samples, cycles, addresses in self.by_line()[:self.top]],
+            "labels": [{"label": name, "samples": samples, "cycles": cycles} for name, samples, cycles in self.by_label()[:self.top]],
+        }
+
+def profile_source(lines:Sequence[str], arch:str="HC4", include_pathes:Optional[list[str]]=None, top:int=10) -> tuple[Profile, simulator.Machine]:
+    """Assemble lines into an empty Profile and a Machine loaded with the same program"""
+    job = assembler.Assembler(arch, include_pathes if include_pathes is not None else [])
+    image = job.run(lines)
+    return Profile(image, job.ls, job.processed, arch, top), simulator.Machine(arch, bytes(image.code), job.ls.labels)
+
+def self_test():
+    import io
+    lines = [".macro COUNT R", "    LD R", "    LI #1", "    AD R", ".ENDM",
+             "START:", "LI #0", "SA r1",
+             "LOOP:", "COUNT r1", "LI #LOOP:2", "LI #LOOP:1", "LI #LOOP:0", "JP NC",
+             "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"]
+    profile, machine = profile_source(lines)
+    testfuncs.expect("halt", profile.add_run, machine, 1000)
+    # LOOP runs 16 times, 7 instructions each; then END jumps to itself
+    testfuncs.expect((2 + 16 * 7 + 4, 2 + 16 * 7 + 4), lambda: (profile.samples, profile.cycles))
+    top = profile.by_line()[0]
+    testfuncs.expect((10, 48, [2, 3, 4], "COUNT r1  (macro)", "LOOP"), lambda: (top[0], top[1], top[3], profile.sources[top[0]], profile.label_of(top[3][0])))
+    testfuncs.expect([("LOOP", 115), ("START", 2), ("END", 1)], lambda: [(name, samples) for name, samples, _ in profile.by_label()])
+    testfuncs.expect("13.6% (16 samples)", lambda: profile.annotations()[2])
+    report = profile.report()
+    testfuncs.expect(("Profile: 118 samples, 118 cycles:", True), lambda: (report[0], report[2].endswith("COUNT r1  (macro)")))
+    # a trace stream: arrays from load4e.py trace -j, single records, and noise
+    profile, _ = profile_source(lines)
+    stream = io.StringIO('[{"regs":[0],"pc":2,"inst":1},{"regs":[0],"pc":3,"inst":1}]\n{"pc":3}\nTrace start\n\n')
+    testfuncs.expect((1, 3, 2), lambda: (profile.add_trace(stream), profile.samples, profile.counts[3]))
+    profile.add_counts({0x1FFF: 1})
+    testfuncs.expect(True, lambda: "(1 samples outside the program)" in profile.report()[0])
+    print("[OK] profiler.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,401 @@
+"""
+Binary upload protocol between load4e.py and the HC4E loader firmware.\n
+    handshake : host "b\\n", device "[BIN] <version> <max chunk> <max window>\\n"
+    data      : 'D' seq addr(2) len data[len] crc(2)        crc over seq .. data
+    end       : 'E' seq length(2) image_crc(2) crc(2)       crc over seq .. image_crc
+    replies   : 'A' seq  every frame up to seq arrived intact and in order
+                'N' seq  frame seq was damaged or missing; resend from seq (sent once per gap,
+                         later frames are dropped until seq arrives)
+    result    : "[OK]\\n" or "[NG] <reason>\\n" once the end frame is acknowledged
+Integers are big-endian, seq counts frames modulo 256 and crc is CRC-16/CCITT-FALSE
+(binascii.crc_hqx with 0xFFFF). The host keeps up to window frames unacknowledged
+(go-back-N), so the line is never idle waiting for a reply and no fixed sleeps are needed.
+
+From version 2, data frames are applied on top of the program already in the device, and the
+device commits the result only if image_crc matches it. The host can then send just the pages
+that changed since its last upload (FlashRecord); if its record is stale the device answers
+"[NG] image CRC mismatch" without touching the program, and the host sends everything again.
+"""
+import binascii
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Protocol, Sequence
+import testfuncs
+
+VERSION = 2
+# first version that keeps the program between uploads (differential upload)
+DIFF_VERSION = 2
+PAGE_SIZE = 16
+HANDSHAKE = b"b\n"
+READY = b"[BIN]"
+DATA = 0x44  # 'D'
+END = 0x45  # 'E'
+ACK = 0x41  # 'A'
+NAK = 0x4E  # 'N'
+# largest window for which a seq modulo 256 is never ambiguous
+MAX_WINDOW = 128
+
+class SerialLike(Protocol):
+    """The parts of serial.Serial used here; the self-test passes a fake device"""
+    @property
+    def timeout(self) -> Optional[float]: ...
+    @timeout.setter
+    def timeout(self, timeout:Optional[float]) -> None: ...
+    def write(self, data:bytes, /) -> Optional[int]: ...
+    def read(self, size:int=1) -> bytes: ...
+    def readline(self) -> bytes: ...
+    def reset_input_buffer(self) -> None: ...
+
+def crc16(data:bytes, crc:int=0xFFFF) -> int:
+    """CRC-16/CCITT-FALSE"""
+    return binascii.crc_hqx(data, crc)
+
+def data_frame(seq:int, address:int, data:bytes) -> bytes:
+    body = struct.pack(">BHB", seq & 0xFF, address, len(data)) + data
+    return bytes([DATA]) + body + struct.pack(">H", crc16(body))
+
+def end_frame(seq:int, image:bytes) -> bytes:
+    body = struct.pack(">BHH", seq & 0xFF, len(image), crc16(image))
+    return bytes([END]) + body + struct.pack(">H", crc16(body))
+
+def frames(image:bytes, chunk_size:int, address:int=0, seq:int=0, ranges:Optional[Sequence[tuple[int, int]]]=None) -> list[bytes]:
+    """Data frames of image from address (only the (start, end) offsets in ranges, if given), then the end frame"""
+    if ranges is None:
+        ranges = [(0, len(image))]
+    out = []
+    for start, end in ranges:
+        for offset in range(start, end, chunk_size):
+            out.append(data_frame(seq + len(out), address + offset, image[offset:min(offset + chunk_size, end)]))
+    out.append(end_frame(seq + len(out), image))
+    return out
+
+def page_hashes(image:bytes, page_size:int=PAGE_SIZE) -> list[str]:
+    return [hashlib.blake2b(image[i:i + page_size], digest_size=8).hexdigest() for i in range(0, len(image), page_size)]
+
+def changed_pages(image:bytes, hashes:Sequence[str], page_size:int=PAGE_SIZE) -> list[tuple[int, int]]:
+    """(start, end) offsets of the pages of image whose hash is not in hashes at the same index; adjacent pages are merged"""
+    ranges: list[tuple[int, int]] = []
+    for i, digest in enumerate(page_hashes(image, page_size)):
+        if i < len(hashes) and hashes[i] == digest:
+            continue
+        start, end = i * page_size, min((i + 1) * page_size, len(image))
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def handshake(ser:SerialLike, timeout:float=0.5) -> Optional[tuple[int, int, int]]:
+    """
+    Ask for binary mode. Returns the device's (version, max chunk, max window), or None if it
+    does not answer with [BIN] within timeout (older firmware), after discarding its reply.
+    """
+    saved = ser.timeout
+    ser.timeout = timeout
+    try:
+        ser.write(HANDSHAKE)
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            line = ser.readline()
+            if line.startswith(READY):
+                fields = line.split()
+                try:
+                    return int(fields[1]), int(fields[2]), int(fields[3])
+                except (IndexError, ValueError):
+                    return None
+            if not line:
+                break
+        ser.reset_input_buffer()
+        return None
+    finally:
+        ser.timeout = saved
+
+class UploadError(Exception):
+    pass
+
+class Rejected(UploadError):
+    """The device answered [NG] to the end frame"""
+    pass
+
+def send_frames(ser:SerialLike, packets:list[bytes], window:int=8, timeout:float=0.5, max_retries:int=8) -> dict:
+    """
+    Send frames with go-back-N and wait for the device's result line.\n
+    Returns {"frames", "wire_bytes", "retries", "seconds"}; raises UploadError after max_retries
+    timeouts or NAKs in a row, or if the device reports [NG].
+    """
+    window = max(1, min(window, MAX_WINDOW))
+    started = time.perf_counter()
+    saved = ser.timeout
+    ser.timeout = timeout
+    base = sent = index = 0
+    retries = failures = 0
+    wire_bytes = 0
+    # seq of packets[0]; frames carry (first_seq + index) & 0xFF
+    first_seq = packets[0][1] if packets else 0
+    try:
+        while base < len(packets):
+            while sent < len(packets) and sent < base + window:
+                ser.write(packets[sent])
+                wire_bytes += len(packets[sent])
+                sent += 1
+            reply = ser.read(2)
+            if len(reply) < 2:
+                kind = None
+            else:
+                kind = reply[0]
+                # index of the frame the reply is about, within the frames in flight
+                index = base + ((reply[1] - first_seq - base) & 0xFF)
+                if not base <= index < sent:
+                    kind = None
+            if kind == ACK:
+                base = index + 1
+                failures = 0
+                continue
+            # NAK, timeout or a reply that makes no sense: resend from the first frame not acknowledged
+            if kind == NAK:
+                base = index
+            retries += 1
+            failures += 1
+            if failures > max_retries:
+                raise UploadError(f"[Error] No acknowledgement from the device after {max_retries} retries")
+            if kind is None:
+                ser.reset_input_buffer()
+            sent = base
+        ser.timeout = max(timeout, 1.0)
+        result = ser.readline()
+        if not result.startswith(b"[OK]"):
+            raise Rejected(f"[Error] Device rejected the image: {result.decode(errors='replace').strip() or 'no response'}")
+    finally:
+        ser.timeout = saved
+    return {"frames": len(packets), "wire_bytes": wire_bytes, "retries": retries, "seconds": time.perf_counter() - started}
+
+def upload(ser:SerialLike, image:bytes, chunk_size:int=64, window:int=8, device:Optional[tuple[int, int, int]]=None, previous:Optional[dict]=None) -> dict:
+    """
+    Send an image in binary mode after a successful handshake (device is its result).\n
+    With previous, a FlashRecord entry of the program the device holds, and a device that keeps
+    its program, only the changed pages are sent; if the device rejects the result, the whole
+    image follows. Returns the counters of send_frames plus bytes, chunk_size, window,
+    bytes_per_second, mode ("full", "diff" or "diff, then full"), pages and pages_sent.
+    """
+    version = VERSION
+    if device is not None:
+        version, max_chunk, max_window = device
+        chunk_size = min(chunk_size, max_chunk)
+        window = min(window, max_window)
+    chunk_size = max(1, min(chunk_size, 255))
+    pages = (len(image) + PAGE_SIZE - 1) // PAGE_SIZE
+    stats = None
+    mode = "full"
+    if previous is not None and previous.get("page_size") == PAGE_SIZE and version >= DIFF_VERSION:
+        ranges = changed_pages(image, previous.get("pages", []))
+        try:
+            stats = send_frames(ser, frames(image, chunk_size, ranges=ranges), window)
+            stats.update(mode="diff", pages_sent=sum((end - start + PAGE_SIZE - 1) // PAGE_SIZE for start, end in ranges))
+        except Rejected:
+            # the record does not match the device: nothing was committed, send it all
+            if handshake(ser) is None:
+                raise UploadError("[Error] The device did not return to binary mode after rejecting the changed pages")
+            stats = None
+            mode = "diff, then full"
+    if stats is None:
+        stats = send_frames(ser, frames(image, chunk_size), window)
+        stats.update(mode=mode, pages_sent=pages)
+    stats.update(bytes=len(image), chunk_size=chunk_size, window=window, pages=pages,
+                 bytes_per_second=len(image) / stats["seconds"] if stats["seconds"] > 0 else 0.0)
+    return stats
+
+class FlashRecord:
+    """
+    Page hashes of the image last uploaded through each port, kept as one JSON file per port
+    in directory. A record only decides which pages are sent; the device verifies the result.
+    """
+    def __init__(self, directory:str):
+        self.directory = Path(directory)
+
+    def __repr__(self) -> str:
+        return f"FlashRecord({str(self.directory)!r})"
+
+    def _path(self, port:str) -> Path:
+        return self.directory / (re.sub(r"[^0-9A-Za-z_.-]", "_", port) + ".json")
+
+    def load(self, port:str) -> Optional[dict]:
+        try:
+            with open(self._path(port), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if isinstance(entry, dict) and entry.get("port") == port else None
+
+    def store(self, port:str, image:bytes):
+        path = self._path(port)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {"port": port, "page_size": PAGE_SIZE, "length": len(image), "pages": page_hashes(image)}
+        # write then rename, so an interrupted upload never leaves a partial record
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def forget(self, port:str):
+        try:
+            self._path(port).unlink()
+        except OSError:
+            pass
+
+def intel_hex(image:bytes) -> bytes:
+    """Intel HEX text of an image in 16-byte records, as hcxasm.py writes it"""
+    lines = []
+    for address in range(0, len(image), 16):
+        chunk = image[address:address + 16]
+        record = bytes([len(chunk), address >> 8 & 0xFF, address & 0xFF, 0]) + chunk
+        lines.append(f":{record.hex().upper()}{-sum(record) & 0xFF:02X}\n")
+    lines.append(":00000001FF\n")
+    return "".join(lines).encode("ascii")
+
+class Receiver:
+    """
+    Device end of the protocol, as the loader firmware implements it; used by the fake device.
+
+    feed() takes whatever arrived on the line and returns the replies. Frames whose CRC fails
+    are skipped one byte at a time to find the next frame start. Once the end frame arrives,
+    result holds the result line and image the received program, which starts as a copy of
+    program (the one in memory) and is only to be used if result is [OK].
+    damage lists frames (counted from 0 as they complete) to treat as corrupted, to test retries.
+    """
+    def __init__(self, size:int=256, max_chunk:int=64, max_window:int=16, damage:Sequence[int]=(), program:bytes=b""):
+        self.image = bytearray(program[:size]) + bytearray(max(0, size - len(program)))
+        self.max_chunk = max_chunk
+        self.max_window = max_window
+        self.damage = set(damage)
+        self.received = 0
+        self.expected = 0
+        self.naked = False
+        self.buffer = bytearray()
+        self.result: Optional[bytes] = None
+
+    def ready(self) -> bytes:
+        return READY + f" {VERSION} {self.max_chunk} {self.max_window}\n".encode()
+
+    def feed(self, data:bytes) -> bytes:
+        self.buffer += data
+        replies = bytearray()
+        while self.buffer and self.result is None:
+            kind = self.buffer[0]
+            if kind == DATA and len(self.buffer) >= 5:
+                size = 7 + self.buffer[4]
+            elif kind == END:
+                size = 8
+            elif kind == DATA:
+                break
+            else:
+                del self.buffer[0]
+                continue
+            if len(self.buffer) < size:
+                break
+            frame = bytes(self.buffer[:size])
+            body = frame[1:-2]
+            intact = crc16(body) == struct.unpack(">H", frame[-2:])[0] and self.received not in self.damage
+            self.received += 1
+            if not intact:
+                del self.buffer[0]
+                if not self.naked:
+                    replies += bytes([NAK, self.expected & 0xFF])
+                    self.naked = True
+                continue
+            del self.buffer[:size]
+            seq = body[0]
+            if seq != self.expected & 0xFF:
+                if 0 < (self.expected - seq) & 0xFF <= MAX_WINDOW:
+                    # a frame sent again after its ACK was lost
+                    replies += bytes([ACK, (self.expected - 1) & 0xFF])
+                elif not self.naked:
+                    replies += bytes([NAK, self.expected & 0xFF])
+                    self.naked = True
+                continue
+            self.naked = False
+            self.expected += 1
+            replies += bytes([ACK, seq])
+            if kind == DATA:
+                address, length = struct.unpack(">HB", body[1:4])
+                if address + length > len(self.image):
+                    self.result = b"[NG] address out of range\n"
+                self.image[address:address + length] = body[4:]
+            else:
+                length, image_crc = struct.unpack(">HH", body[1:5])
+                self.result = b"[OK]\n" if crc16(bytes(self.image[:length])) == image_crc else b"[NG] image CRC mismatch\n"
+        return bytes(replies)
+
+class _Loopback:
+    """A device with a Receiver behind the serial interface, for the self-test; starts in binary mode"""
+    def __init__(self, damage:Sequence[int]=(), program:bytes=b""):
+        self.timeout: Optional[float] = None
+        self.program = bytes(program)
+        self.device: Optional[Receiver] = Receiver(damage=damage, program=program)
+        self.replies = bytearray()
+
+    def write(self, data:bytes) -> int:
+        if self.device is None:
+            if data == HANDSHAKE:
+                self.device = Receiver(program=self.program)
+                self.replies += self.device.ready()
+            return len(data)
+        self.replies += self.device.feed(data)
+        if self.device.result is not None:
+            if self.device.result.startswith(b"[OK]"):
+                self.program = bytes(self.device.image)
+            self.replies += self.device.result
+            self.device = None
+        return len(data)
+
+    def read(self, size:int=1) -> bytes:
+        out, self.replies = bytes(self.replies[:size]), self.replies[size:]
+        return out
+
+    def readline(self) -> bytes:
+        return self.read(self.replies.find(b"\n") + 1 or len(self.replies))
+
+    def reset_input_buffer(self):
+        self.replies.clear()
+
+def self_test():
+    testfuncs.expect(0x29B1, crc16, b"123456789")
+    testfuncs.expect(b"D\x00\x00\x10\x02\xa1\xe0" + struct.pack(">H", crc16(b"\x00\x00\x10\x02\xa1\xe0")), data_frame, 0, 0x10, b"\xa1\xe0")
+    testfuncs.expect(b":03000000A1A1E0DB\n:00000001FF\n", intel_hex, b"\xa1\xa1\xe0")
+    image = bytes(range(200))
+    for damage in ((), (0,), (3, 4, 9)):
+        line = _Loopback(damage)
+        stats = upload(line, image, chunk_size=16, window=4, device=(VERSION, 64, 16))
+        testfuncs.expect((True, 14, len(damage) > 0), lambda: (line.program[:200] == image, stats["frames"], stats["retries"] > 0))
+    # a frame split across reads, with line noise in front of it
+    device = Receiver()
+    packet = data_frame(0, 0, b"\xa1\xe0")
+    testfuncs.expect(b"A\x00", lambda: device.feed(b"\x00\xff" + packet[:3]) + device.feed(packet[3:]))
+    testfuncs.expect(b"A\x00", device.feed, packet)
+    testfuncs.expect_raises(UploadError, send_frames, _Loopback(range(100)), frames(image, 64), 4, 0.01, 2)
+    # differential upload: one changed byte sends one page; a stale record falls back to a full upload
+    testfuncs.expect([(0, 16), (48, 52)], changed_pages, image[:52], page_hashes(bytes(16) + image[16:48] + bytes(4)))
+    edited = image[:100] + b"\x00" + image[101:]
+    previous = {"page_size": PAGE_SIZE, "pages": page_hashes(image)}
+    for program, mode, pages_sent in ((image, "diff", 1), (image[:99], "diff, then full", 13)):
+        line = _Loopback(program=program)
+        stats = upload(line, edited, chunk_size=64, window=4, previous=previous)
+        testfuncs.expect((True, mode, pages_sent), lambda: (line.program[:200] == edited, stats["mode"], stats["pages_sent"]))
+    line = _Loopback(program=image)
+    testfuncs.expect("full", lambda: upload(line, edited, device=(1, 64, 16), previous=previous)["mode"])
+    print("[OK] serialproto.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
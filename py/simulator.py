@@ -0,0 +1,376 @@
+import itertools
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Sequence, TypeVar, Union
+import testfuncs
+import assembler
+from assembler import INST_DICT_M, INST_TYPES, JMP_FLAGS, insttype
+
+# Operation kinds of the dispatch table, roughly in order of how often firmware executes them
+(_INVALID, _LI, _LD, _AD, _SA, _JP, _JPC, _JPNC, _JPZ, _JPNZ,
+ _XR, _OR, _AN, _SU, _SC, _SM, _LM, _NP) = range(18)
+
+_KIND_OF = {"LI": _LI, "LD": _LD, "AD": _AD, "SA": _SA, "XR": _XR, "OR": _OR, "AN": _AN,
+            "SU": _SU, "SC": _SC, "SM": _SM, "LM": _LM, "NP": _NP}
+_JUMP_KIND = {None: _JP, "C": _JPC, "NC": _JPNC, "Z": _JPZ, "NZ": _JPNZ}
+
+# Clock cycles per instruction; both cores execute every instruction in one clock
+CYCLES = {mnemonic: 1 for mnemonic in INST_TYPES}
+
+# arch -> (program counter bits, depth of the A/B/C stack)
+ARCHS = {"HC4": (12, 3), "HC4E": (8, 2)}
+
+# I/O addresses: HC4 maps them into the [AB] memory space, HC4E onto registers
+# (countlcd.asm: 0xF0 buttons/buzzer, 0xF2 LCD command, 0xF3 LCD data; vasm.inc: OUTA/INA r14, OUTB r15)
+IO_PORTS = {"HC4": range(0xF0, 0xF4), "HC4E": range(14, 16)}
+# HC4E reads only INA from the outside; reading OUTB returns the value last written
+_IO_INPUTS = {"HC4": range(0xF0, 0xF4), "HC4E": range(14, 15)}
+
+def _decode_table(arch:str) -> list[Optional[tuple[str, Optional[str]]]]:
+    """
+    256-entry table opcode -> (mnemonic, operand) of an architecture, None for reserved opcodes.\n
+    The operand is written as the assembler reads it ("r3", "#5", "NZ") or None.
+    """
+    table: list[Optional[tuple[str, Optional[str]]]] = [None] * 256
+    for mnemonic, opcode in INST_DICT_M[arch].items():
+        kind = INST_TYPES[mnemonic]
+        if kind == insttype.REGISTER:
+            for n in range(16):
+                table[opcode | n] = (mnemonic, f"r{n}")
+        elif kind == insttype.IMMEDIATE:
+            for n in range(16):
+                table[opcode | n] = (mnemonic, f"#{n}")
+        elif kind == insttype.JUMP:
+            table[opcode] = (mnemonic, None)
+            for flag, n in JMP_FLAGS.items():
+                table[opcode | n] = (mnemonic, flag)
+        else:
+            table[opcode] = (mnemonic, None)
+    return table
+
+DECODE = {arch: _decode_table(arch) for arch in INST_DICT_M}
+
+def _kind_table(arch:str) -> bytes:
+    kinds = bytearray(256)
+    for opcode, entry in enumerate(DECODE[arch]):
+        if entry is not None:
+            mnemonic, operand = entry
+            kinds[opcode] = _JUMP_KIND[operand] if INST_TYPES[mnemonic] == insttype.JUMP else _KIND_OF[mnemonic]
+    return bytes(kinds)
+
+_KINDS = {arch: _kind_table(arch) for arch in INST_DICT_M}
+_OP_CYCLES = {arch: bytes(CYCLES[e[0]] if e is not None else 0 for e in DECODE[arch]) for arch in INST_DICT_M}
+
+class Machine:
+    """
+    Instruction-set simulator of an HC4 or HC4E.\n
+    Models the 16 registers, the A/B/C stack (A/B on HC4E), the carry and zero flags, the 256
+    nibbles of [AB] memory used by SM/LM and the I/O ports. Program memory is separate from data
+    memory and starts out erased (0xFF, a reserved opcode), so running off the program is an error.\n
+    Inputs are read from the inputs dict (port -> nibble) unless on_io_read is set; outputs are
+    kept in outputs and appended to io_log as (cycle, port, value), then passed to on_io_write.
+    Hooks registered with add_hook run before the instruction at their address executes.
+    """
+    def __init__(self, arch:str="HC4", code:Union[bytes, bytearray]=b"", labels:Optional[dict[str, int]]=None):
+        if arch not in ARCHS:
+            raise ValueError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        pc_bits, self.stack_depth = ARCHS[arch]
+        self.rom_size = 1 << pc_bits
+        self.rom = bytearray(b"\xff") * self.rom_size
+        self.labels: dict[str, int] = dict(labels) if labels is not None else {}
+        self.inputs: dict[int, int] = {}
+        self.outputs: dict[int, int] = {}
+        self.io_log: list[tuple[int, int, int]] = []
+        self.on_io_read: Optional[Callable[[int], int]] = None
+        self.on_io_write: Optional[Callable[[int, int], None]] = None
+        self.hooks: dict[int, list[Callable[["Machine"], Optional[bool]]]] = {}
+        self.breakpoints: set[int] = set()
+        self.load(code)
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"Machine(arch={self.arch}, pc=0x{self.pc:03X}, instructions={self.instructions}, cycles={self.cycles})"
+
+    def load(self, code:Union[bytes, bytearray], address:int=0):
+        if address + len(code) > self.rom_size:
+            raise ValueError(f"[Error] Program of {len(code)} bytes does not fit in {self.rom_size} bytes at 0x{address:03X}")
+        self.rom[address:address + len(code)] = code
+
+    def reset(self):
+        """Power-on state; program memory and I/O settings are kept"""
+        self.regs = [0] * 16
+        self.mem = bytearray(256)
+        self.a = self.b = self.c = 0
+        self.carry = False
+        self.zero = False
+        self.pc = 0
+        self.instructions = 0
+        self.cycles = 0
+        self.halted = False
+
+    @property
+    def stack(self) -> tuple[int, ...]:
+        return (self.a, self.b, self.c)[:self.stack_depth]
+
+    def state(self) -> dict:
+        """Register dump, with the keys of load4e.py register -j plus the simulator's own"""
+        return {
+            "regs": list(self.regs), "pc": self.pc, "inst": self.rom[self.pc],
+            "stack": list(self.stack), "carry": self.carry, "zero": self.zero,
+            "instructions": self.instructions, "cycles": self.cycles,
+        }
+
+    def label(self, name_or_address:Union[str, int]) -> int:
+        """Address of a label of the loaded program, or the address itself"""
+        if isinstance(name_or_address, int):
+            return name_or_address
+        try:
+            return int(name_or_address, 0)
+        except ValueError:
+            pass
+        address = self.labels.get(name_or_address.upper())
+        if address is None:
+            raise KeyError(f"[Error] Undefined label: {name_or_address}")
+        return address
+
+    def add_hook(self, address:Union[str, int], hook:Callable[["Machine"], Optional[bool]]):
+        """Call hook(machine) whenever execution reaches address; a truthy return value stops run()"""
+        self.hooks.setdefault(self.label(address), []).append(hook)
+
+    def io_read(self, port:int) -> int:
+        if self.on_io_read is not None:
+            return self.on_io_read(port) & 0xF
+        return self.inputs.get(port, 0) & 0xF
+
+    def io_write(self, port:int, value:int):
+        self.outputs[port] = value
+        self.io_log.append((self.cycles, port, value))
+        if self.on_io_write is not None:
+            self.on_io_write(port, value)
+
+    def step(self) -> Optional[str]:
+        """Execute one instruction. Returns "halt" if it was a jump to itself, else None."""
+        return self._execute(self.instructions + 1, (), False)
+
+    def run(self, max_instructions:Optional[int]=None, until:Union[None, str, int, Iterable[Union[str, int]]]=None) -> str:
+        """
+        Execute until one of:\n
+        "halt"  : a jump to itself (the HALT macro of vasm.inc)\n
+        "until" : the PC reaches an address (or label) of until, or a breakpoint\n
+        "hook"  : a hook returned a truthy value\n
+        "limit" : max_instructions were executed\n
+        The instruction at the current PC always executes, so run() can resume from a stop.
+        """
+        if until is None:
+            targets = set()
+        elif isinstance(until, (str, int)):
+            targets = {self.label(until)}
+        else:
+            targets = {self.label(u) for u in until}
+        targets |= self.breakpoints
+        end = self.instructions + max_instructions if max_instructions is not None else 1 << 62
+        reason = self._execute(end, targets, True)
+        return reason if reason is not None else "limit"
+
+    def _execute(self, end:int, targets:Iterable[int], stops:bool) -> Optional[str]:
+        rom = self.rom
+        kinds = _KINDS[self.arch]
+        op_cycles = _OP_CYCLES[self.arch]
+        regs = self.regs
+        mem = self.mem
+        mask = self.rom_size - 1
+        ports = IO_PORTS[self.arch]
+        inputs = _IO_INPUTS[self.arch]
+        if self.arch == "HC4":
+            io_mem, io_mem_end, io_reg, io_in = ports.start, ports.stop, 16, 16
+        else:
+            io_mem, io_mem_end, io_reg, io_in = 256, 256, ports.start, inputs.start
+        stop = bytearray(self.rom_size)
+        if stops:
+            for address in itertools.chain(targets, self.hooks):
+                stop[address & mask] = 1
+        a, b, c = self.a, self.b, self.c
+        carry, zero, pc = self.carry, self.zero, self.pc
+        n = n0 = self.instructions
+        cycles = self.cycles
+        reason = None
+        while n < end:
+            if stop[pc] and n != n0:
+                self.a, self.b, self.c, self.carry, self.zero, self.pc = a, b, c, carry, zero, pc
+                self.instructions, self.cycles = n, cycles
+                if pc in targets:
+                    reason = "until"
+                    break
+                if any([hook(self) for hook in self.hooks.get(pc, ())]):
+                    reason = "hook"
+                    break
+                a, b, c = self.a, self.b, self.c
+                carry, zero, pc = self.carry, self.zero, self.pc
+            op = rom[pc]
+            k = kinds[op]
+            if k == _LI:
+                c = b
+                b = a
+                a = op & 15
+                pc = (pc + 1) & mask
+            elif k == _LD:
+                x = op & 15
+                if x == io_in:
+                    self.instructions, self.cycles = n, cycles
+                    v = self.io_read(x)
+                else:
+                    v = regs[x]
+                c = b
+                b = a
+                a = v
+                pc = (pc + 1) & mask
+            elif k == _INVALID:
+                self.a, self.b, self.c, self.carry, self.zero, self.pc = a, b, c, carry, zero, pc
+                self.instructions, self.cycles = n, cycles
+                raise ValueError(f"[Error] Invalid instruction 0x{op:02X} at 0x{pc:03X}")
+            elif k <= _SA:
+                # AD, SA
+                if k == _AD:
+                    v = a + b
+                    carry = v > 15
+                    v &= 15
+                else:
+                    v = a
+                zero = v == 0
+                x = op & 15
+                regs[x] = v
+                if x >= io_reg:
+                    self.instructions, self.cycles = n, cycles
+                    self.io_write(x, v)
+                pc = (pc + 1) & mask
+            elif k <= _JPNZ:
+                if k == _JP or (k == _JPC and carry) or (k == _JPNC and not carry) or (k == _JPZ and zero) or (k == _JPNZ and not zero):
+                    target = ((c << 8) | (b << 4) | a) & mask
+                    if target == pc:
+                        n += 1
+                        cycles += op_cycles[op]
+                        self.halted = True
+                        reason = "halt"
+                        break
+                    pc = target
+                else:
+                    pc = (pc + 1) & mask
+            elif k <= _SC:
+                # XR, OR, AN, SU, SC
+                if k == _XR:
+                    v = a ^ b
+                elif k == _OR:
+                    v = a | b
+                elif k == _AN:
+                    v = a & b
+                elif k == _SU:
+                    # carry is bit 4 of the 5-bit difference, i.e. a borrow
+                    v = a - b
+                    carry = v < 0
+                    v &= 15
+                else:
+                    v = c
+                zero = v == 0
+                x = op & 15
+                regs[x] = v
+                if x >= io_reg:
+                    self.instructions, self.cycles = n, cycles
+                    self.io_write(x, v)
+                pc = (pc + 1) & mask
+            elif k == _SM:
+                address = (b << 4) | a
+                zero = c == 0
+                if io_mem <= address < io_mem_end:
+                    self.instructions, self.cycles = n, cycles
+                    self.io_write(address, c)
+                else:
+                    mem[address] = c
+                pc = (pc + 1) & mask
+            elif k == _LM:
+                address = (b << 4) | a
+                if io_mem <= address < io_mem_end:
+                    self.instructions, self.cycles = n, cycles
+                    v = self.io_read(address)
+                else:
+                    v = mem[address]
+                c = b
+                b = a
+                a = v
+                pc = (pc + 1) & mask
+            else:
+                # NP
+                pc = (pc + 1) & mask
+            n += 1
+            cycles += op_cycles[op]
+        self.a, self.b, self.c, self.carry, self.zero, self.pc = a, b, c, carry, zero, pc
+        self.instructions, self.cycles = n, cycles
+        return reason
+
+_Engine = TypeVar("_Engine", bound=Machine)
+
+def load_source(lines:Sequence[str], arch:str="HC4", include_pathes:Optional[list[str]]=None, engine:type[_Engine]=Machine) -> _Engine:
+    """Assemble lines and load the result, labels included, into a new Machine (or subclass engine)"""
+    job = assembler.Assembler(arch, include_pathes if include_pathes is not None else [])
+    image = job.run(lines)
+    return engine(arch, bytes(image.code), job.ls.labels)
+
+def lcd_text(io_log:Iterable[tuple[int, int, int]], port:int=0xF3) -> str:
+    """Characters sent to an HD44780 data port in 4-bit mode, high nibble first"""
+    nibbles = [value for _, p, value in io_log if p == port]
+    return "".join(chr((hi << 4) | lo) for hi, lo in zip(nibbles[0::2], nibbles[1::2]))
+
+def self_test():
+    testfuncs.expect(("AD", "r10"), lambda: DECODE["HC4"][0x3A])
+    testfuncs.expect(("JP", "NZ"), lambda: DECODE["HC4"][0xE5])
+    testfuncs.expect([None, None, ("AD", "r0")], lambda: [DECODE["HC4"][0x01], DECODE["HC4E"][0x00], DECODE["HC4E"][0x30]])
+
+    m = load_source(["LI #9", "LI #8", "AD r1", "LI #3", "SU r2", "SC r3", "LI #7", "LI #5", "LI #0xA", "SM",
+                     "LI #5", "LI #0xA", "LM", "SA r4", "XR r5", "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"])
+    testfuncs.expect("halt", m.run, 1000)
+    testfuncs.expect(([0, 1, 11, 9, 7, 13], True, False, 7, 19, 18), lambda: (m.regs[:6], m.carry, m.zero, m.mem[0x5A], m.instructions, m.pc))
+    m.reset()
+    testfuncs.expect("until", m.run, None, 13)
+    testfuncs.expect(((7, 0xA, 5), [0, 1, 11, 9, 0, 0]), lambda: (m.stack, m.regs[:6]))
+    testfuncs.expect("limit", m.run, 1)
+    # SC [AB] sets Z from the stored value: the first JP Z is taken, the second is not
+    m = load_source(["LI #1", "SA r1", "LI #0", "LI #2", "LI #1", "SM", "LI #SKIP:2", "LI #SKIP:1", "LI #SKIP:0", "JP Z", "LI #5", "SA r2",
+                     "SKIP:", "LI #3", "LI #2", "LI #1", "SM", "LI #END:2", "LI #END:1", "LI #END:0", "JP Z", "LI #6", "SA r3",
+                     "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"])
+    testfuncs.expect(("halt", [1, 0, 6], 3), lambda: (m.run(1000), m.regs[1:4], m.mem[0x21]))
+    testfuncs.expect_raises(ValueError, Machine("HC4", b"\xe1").run, 10)
+    testfuncs.expect("limit", Machine("HC4", b"\xe1" * 4096).run, 10000)
+
+    root = Path(__file__).resolve().parent
+    include = [str(root.parent / "include")]
+    # countlcd.asm greets on the LCD, then counts button presses and beeps on 10000
+    with open(root / "test_files" / "countlcd.asm", 'r', encoding='utf-8') as f:
+        countlcd = f.read().splitlines()
+    m = load_source(countlcd, "HC4", include)
+    testfuncs.expect("until", m.run, 2000000, "main")
+    testfuncs.expect("Hello!", lambda: lcd_text(m.io_log))
+    # wait_100ms is called with the return address in r13-r15 and must take about 100 ms at 1 MHz
+    entered = []
+    m.add_hook("wait_100ms", lambda machine: entered.append(machine.cycles))
+    m.add_hook("done", lambda machine: True)
+    presses = 0
+    def buttons(port:int) -> int:
+        nonlocal presses
+        presses += 1
+        return presses & 1
+    m.on_io_read = buttons
+    # one more press overflows 9999 and sounds the buzzer for 100 ms
+    m.regs[4:8] = [9, 9, 9, 9]
+    testfuncs.expect("hook", m.run, 10000000)
+    testfuncs.expect(True, lambda: 90000 <= m.cycles - entered[0] <= 110000)
+    testfuncs.expect([0, 0, 0, 0], lambda: m.regs[4:8])
+
+    # dice4e.asm counts 1..6 on OUTB while INA is held
+    with open(root / "test_files" / "dice4e.asm", 'r', encoding='utf-8') as f:
+        m = load_source(f.read().splitlines(), "HC4E", include)
+    m.inputs[14] = 1
+    m.run(500)
+    testfuncs.expect([1, 2, 3, 4, 5, 6, 1, 2], lambda: [v for _, port, v in m.io_log if port == 15][:8])
+    print("[OK] simulator.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -1,9 +1,41 @@
+import tempfile
 import testfuncs as tf
 import assembler
+import lexer
+import buildcache
+import incremental
+import simulator
+import translator
+import batchsim
+import timing
+import optimizer
+import disassembler
+import serialproto
+import tracestream
+import tracefile
+import profiler
+import fakedevice
+from bench import generator as bench_generator, runner as bench_runner
 
 if __name__ == "__main__":
     tf.self_test()
+    lexer.self_test()
     assembler.self_test()
+    buildcache.self_test()
+    incremental.self_test()
+    simulator.self_test()
+    translator.self_test()
+    batchsim.self_test()
+    timing.self_test()
+    optimizer.self_test()
+    disassembler.self_test()
+    serialproto.self_test()
+    tracestream.self_test()
+    tracefile.self_test()
+    profiler.self_test()
+    fakedevice.self_test()
+    bench_generator.self_test()
+    bench_runner.self_test()
     tf.expect_assemble(
         expected_file='py/test_files/alltest.hex',
         infile='py/test_files/alltest.asm',
@@ -39,5 +71,76 @@ if __name__ == "__main__":
         format_type='vhex',
         arch='HC4E'
     )
+    tf.expect_assemble(
+        expected_file='py/test_files/countlcd.hex',
+        infile='py/test_files/countlcd.asm',
+        outfile='./__temp__/countlcd_multi.hex',
+        format_type='binary,ihex',
+        arch='HC4',
+        extra_args=['-f', 'list', '--clock', '1000000']
+    )
+    tf.expect_usage_error(['py/test_files/alltest.asm', '-f', 'hex,ihex'], "would write to the same file")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for expected in ('miss', 'hit'):  # cold, then served from the build cache
+            tf.expect_assemble(
+                expected_file='py/test_files/countlcd.hex',
+                infile='py/test_files/countlcd.asm',
+                outfile='./__temp__/countlcd_cached.hex',
+                format_type='ihex',
+                arch='HC4',
+                extra_args=['--cache-dir', cache_dir, '-v'],
+                expected_message=f"[Info] Build cache {expected}"
+            )
+    tf.expect_batch(
+        manifest='py/test_files/batch.txt',
+        expected_dir='py/test_files',
+        outdir='./__temp__/batch',
+        format_type='ihex',
+        jobs=2
+    )
+    tf.expect_serve(
+        expected_file='py/test_files/inctest.hex',
+        infile='py/test_files/inctest.asm',
+        format_type='vhex',
+        arch='HC4E'
+    )
+    tf.expect_diagnostics(
+        expected=[(5, 8, []), (6, 5, []), (7, 10, ["macro"]), (8, 9, []), (9, 1, [])],
+        infile='py/test_files/errortest.asm'
+    )
+    tf.expect_stats(
+        expected_counters={"lines_in": 67, "lines_out": 83, "macro_expansions": 6, "includes": 1, "unresolved_fixups": 6, "bytes": 16},
+        infile='py/test_files/inctest.asm',
+        outfile='./__temp__/inctest_stats.hex',
+        arch='HC4E'
+    )
+    tf.expect_disassemble(
+        infile='py/test_files/countlcd.hex',
+        outfile='./__temp__/countlcd_dis.asm',
+        format_type='ihex',
+        arch='HC4'
+    )
+    tf.expect_disassemble(
+        infile='py/test_files/inctest.hex',
+        outfile='./__temp__/inctest_dis.asm',
+        format_type='vhex',
+        arch='HC4E'
+    )
+    tf.expect_simulate(
+        expected_state={"reason": "until", "pc": 177, "instructions": 115250, "outputs": {"240": 0, "242": 12, "243": 1}},
+        infile='py/test_files/countlcd.asm',
+        extra_args=['--until', 'main']
+    )
+    tf.expect_simulate(
+        expected_state={"reason": "until", "pc": 177, "instructions": 115250, "outputs": {"240": 0, "242": 12, "243": 1}},
+        infile='py/test_files/countlcd.asm',
+        extra_args=['--until', 'main', '--engine', 'interp']
+    )
+    tf.expect_simulate(
+        expected_state={"reason": "limit", "outputs": {"15": 3}, "regs": [3, 0, 0, 0, 0, 0, 0, 13, 0, 0, 0, 0, 0, 0, 0, 3]},
+        infile='py/test_files/dice4e.asm',
+        arch='HC4E',
+        extra_args=['--input', '14=1', '-n', '50']
+    )
 
     print("[OK] test.py : All tests passed.")
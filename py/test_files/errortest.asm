@@ -0,0 +1,10 @@
+; Every statement but the last one has an error; --diagnostics reports all of them
+.MACRO PUSH x
+    LI x
+.ENDM
+    SC r16
+    XX r1
+    PUSH #20
+    LI #missing:0
+.INC "nothere.inc"
+    NP
@@ -1,16 +1,21 @@
-from types import FunctionType
 import difflib
 import os
 from pathlib import Path
 import sys
 import subprocess
+import json
+from typing import Callable
 
-def expect(expected, func : FunctionType, *args, **kwargs):
+def _name(func:Callable) -> str:
+    """Name of a function, bound method or class for the messages (a callable object shows its repr)"""
+    return getattr(func, "__name__", repr(func))
+
+def expect(expected, func : Callable, *args, **kwargs):
     result = func(*args, **kwargs)
     try:
         assert result == expected
     except AssertionError:
-        raise AssertionError(f"[FAIL] {func.__name__}({args}, {kwargs}) == {result}, expected {expected}")
+        raise AssertionError(f"[FAIL] {_name(func)}({args}, {kwargs}) == {result}, expected {expected}")
     restored_args = ", ".join(repr(a) for a in args)
     restored_kwargs = ", ".join(f"{k}={v!r}" for k, v in kwargs.items())
     if restored_kwargs:
@@ -18,17 +23,19 @@ def expect(expected, func : FunctionType, *args, **kwargs):
             restored_args += ", " + restored_kwargs
         else:
             restored_args = restored_kwargs
-    print(f"[OK] {func.__name__}({restored_args}) == {expected}")
+    print(f"[OK] {_name(func)}({restored_args}) == {expected}")
 
-def expect_raises(exc_type, func : FunctionType, *args, **kwargs):
+def expect_raises(exc_type, func : Callable, *args, **kwargs):
     try:
         func(*args, **kwargs)
     except Exception as e:
         assert isinstance(e, exc_type)
         print(f"[OK] Raised expected exception: {e}")
+    else:
+        raise AssertionError(f"[FAIL] {_name(func)} did not raise {exc_type.__name__}")
 
-def expect_assemble(expected_file, infile, outfile, format_type='ihex', arch='HC4', extra_args=None):
-    """アセンブル結果が期待通りか確認する"""
+def expect_assemble(expected_file, infile, outfile, format_type='ihex', arch='HC4', extra_args=None, expected_message=None):
+    """アセンブル結果が期待通りか確認する (expected_message を指定すると標準出力にその文字列が含まれることも確認する)"""
     project_root = Path(__file__).parent.parent
     temp_dir = project_root / '__temp__'
     if not temp_dir.exists():
@@ -38,7 +45,9 @@ def expect_assemble(expected_file, infile, outfile, format_type='ihex', arch='HC
         cmd += ['--output', outfile]
     if extra_args:
         cmd += extra_args
-    subprocess.run(cmd, check=True, cwd=project_root)
+    result = subprocess.run(cmd, check=True, cwd=project_root, capture_output=expected_message is not None, text=True)
+    if expected_message is not None and expected_message not in result.stdout:
+        raise AssertionError(f"[FAIL] '{expected_message}' not in the output for {infile}:\n{result.stdout}")
     
     # 期待ファイルと出力ファイルを比較
     with open(expected_file, 'rb') as f:
@@ -59,6 +68,126 @@ def expect_assemble(expected_file, infile, outfile, format_type='ihex', arch='HC
     print(f"[OK] Assembled output matches expected for {infile}.")
 
 
+def expect_usage_error(args, message):
+    """hcxasm.py が引数の誤りを終了コード 2 と message で報告するか確認する"""
+    project_root = Path(__file__).parent.parent
+    result = subprocess.run([sys.executable, 'hcxasm.py'] + args, capture_output=True, text=True, encoding='utf-8', cwd=project_root)
+    if result.returncode != 2 or message not in result.stderr:
+        raise AssertionError(f"[FAIL] hcxasm.py {' '.join(args)}: exit status {result.returncode}, {result.stderr}")
+    print(f"[OK] hcxasm.py {' '.join(args)} is refused.")
+
+
+def expect_serve(expected_file, infile, format_type='ihex', arch='HC4'):
+    """常駐モード(--serve)のアセンブル結果が期待通りか確認する"""
+    project_root = Path(__file__).parent.parent
+    with open(project_root / infile, 'r', encoding='utf-8') as f:
+        source = f.read()
+    requests = [
+        {"id": 1, "source": source, "architecture": arch, "formats": [format_type],
+         "include_paths": [str((project_root / infile).parent)]},
+        {"id": 2, "source": source, "architecture": arch, "formats": [format_type],
+         "include_paths": [str((project_root / infile).parent)]},
+        {"id": 3, "source": source, "architecture": arch, "formats": [format_type],
+         "include_paths": [str((project_root / infile).parent)], "session": "test"},
+        {"id": 4, "source": source + "\n; edited\n", "architecture": arch, "formats": [format_type],
+         "include_paths": [str((project_root / infile).parent)], "session": "test"},
+        {"id": 5, "source": source, "architecture": "HC8"},
+        {"id": 6, "source": source, "architecture": arch, "formats": [format_type],
+         "include_paths": [str((project_root / infile).parent)], "session": "test"},
+        {"id": 7, "command": "exit"},
+    ]
+    stdin = "".join(json.dumps(r) + "\n" for r in requests)
+    result = subprocess.run([sys.executable, 'hcxasm.py', '--serve'], input=stdin, capture_output=True,
+                            text=True, encoding='utf-8', check=True, cwd=project_root)
+    responses = [json.loads(line) for line in result.stdout.splitlines()]
+    with open(project_root / expected_file, 'r', encoding='utf-8') as f:
+        expected_data = f.read()
+    # the second request must not see defines, macros or labels of the first one,
+    # and a session must give the same result when reassembling incrementally
+    # an unknown architecture is an error response, and the server keeps serving
+    for response in responses[:4] + responses[5:6]:
+        if not response.get("ok") or response.get(format_type) != expected_data:
+            raise AssertionError(f"[FAIL] --serve output does not match expected for {infile}: {response}")
+    if responses[4].get("ok") is not False or "HC8" not in responses[4].get("error", ""):
+        raise AssertionError(f"[FAIL] --serve accepted an unknown architecture: {responses[4]}")
+    print(f"[OK] --serve output matches expected for {infile}.")
+
+
+def expect_batch(manifest, expected_dir, outdir, format_type='ihex', jobs=2):
+    """バッチアセンブル(-m, -j)の結果が期待ファイルと一致し、--clock で各リストに時間が注記されるか確認する"""
+    project_root = Path(__file__).parent.parent
+    cmd = [sys.executable, 'hcxasm.py', '-m', manifest, '-j', str(jobs), '-f', format_type, '-f', 'list', '-o', outdir, '-q', '--clock', '1000000']
+    subprocess.run(cmd, check=True, cwd=project_root)
+    with open(project_root / manifest, 'r', encoding='utf-8') as f:
+        names = [line.split('#', 1)[0].split()[0] for line in f if line.split('#', 1)[0].strip()]
+    for name in names:
+        stem = Path(name).stem
+        with open(project_root / expected_dir / f"{stem}.hex", 'rb') as f:
+            expected_data = f.read()
+        with open(project_root / outdir / f"{stem}.hex", 'rb') as f:
+            output_data = f.read()
+        if expected_data != output_data:
+            raise AssertionError(f"[FAIL] Batch output for {name} does not match expected.")
+        with open(project_root / outdir / f"{stem}.lst", 'r', encoding='utf-8') as f:
+            if "Timing at 1e+06 Hz:" not in f.read():
+                raise AssertionError(f"[FAIL] Batch list output for {name} has no --clock timing.")
+    print(f"[OK] Batch output matches expected for {manifest}.")
+
+
+def expect_diagnostics(expected, infile, arch='HC4'):
+    """--diagnostics json が全てのエラーを (行, 桁, 展開元) 付きで報告するか確認する"""
+    project_root = Path(__file__).parent.parent
+    cmd = [sys.executable, 'hcxasm.py', infile, '-a', arch, '--diagnostics', 'json', '-o', os.devnull]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', cwd=project_root)
+    report = json.loads(result.stdout)
+    found = sorted((d["line"], d["column"], [c["kind"] for c in d["chain"]]) for d in report["diagnostics"])
+    if result.returncode != 1 or report["ok"] or found != sorted(expected):
+        raise AssertionError(f"[FAIL] Diagnostics for {infile}: {found}, expected {sorted(expected)}")
+    print(f"[OK] Diagnostics match expected for {infile}.")
+
+
+def expect_stats(expected_counters, infile, outfile, format_type='ihex', arch='HC4'):
+    """--stats json が各段階の時間とカウンタを報告するか確認する"""
+    project_root = Path(__file__).parent.parent
+    cmd = [sys.executable, 'hcxasm.py', infile, '-o', outfile, '-f', format_type, '-a', arch, '--stats', 'json']
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', check=True, cwd=project_root)
+    report = json.loads(result.stdout)
+    stages = ["read", "preprocess", "assemble", "link", f"write:{format_type}", "total"]
+    counters = {k: report["counters"].get(k) for k in expected_counters}
+    if list(report["timings"]) != stages or counters != expected_counters or report["peak_memory"] <= 0:
+        raise AssertionError(f"[FAIL] --stats report for {infile}: {report}")
+    # with --diagnostics json, stdout still holds one JSON document
+    result = subprocess.run(cmd + ['--diagnostics', 'json'], capture_output=True, text=True, encoding='utf-8', check=True, cwd=project_root)
+    document = json.loads(result.stdout)
+    if not document["ok"] or {k: document["stats"]["counters"].get(k) for k in expected_counters} != expected_counters:
+        raise AssertionError(f"[FAIL] --stats json with --diagnostics json for {infile}: {document}")
+    # and a batch refuses --stats instead of ignoring it
+    result = subprocess.run(cmd + [infile], capture_output=True, text=True, encoding='utf-8', cwd=project_root)
+    if result.returncode == 0 or "--stats" not in result.stderr:
+        raise AssertionError(f"[FAIL] --stats was accepted for several inputs: {result.stderr}")
+    print(f"[OK] --stats report matches expected for {infile}.")
+
+
+def expect_simulate(expected_state, infile, arch='HC4', extra_args=None):
+    """hcxsim.py -j の実行結果が期待通りか確認する"""
+    project_root = Path(__file__).parent.parent
+    cmd = [sys.executable, 'hcxsim.py', infile, '-a', arch, '-j'] + (extra_args or [])
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', check=True, cwd=project_root)
+    state = json.loads(result.stdout)
+    actual = {k: state.get(k) for k in expected_state}
+    if actual != expected_state:
+        raise AssertionError(f"[FAIL] Simulation of {infile}: {actual}, expected {expected_state}")
+    print(f"[OK] Simulation matches expected for {infile}.")
+
+
+def expect_disassemble(infile, outfile, format_type='ihex', arch='HC4'):
+    """hcxdis.py で逆アセンブルし、hcxasm.py で元と同じファイルに戻るか確認する"""
+    project_root = Path(__file__).parent.parent
+    cmd = [sys.executable, 'hcxdis.py', infile, '-a', arch, '-o', outfile]
+    subprocess.run(cmd, check=True, cwd=project_root, capture_output=True)
+    expect_assemble(infile, outfile, os.path.splitext(outfile)[0] + os.path.splitext(infile)[1], format_type, arch)
+
+
 def self_test():
     expect(2, lambda x,y: x + y, 1, 1)
     expect(3, lambda x, y, z: (x + z) * y, 1, z=2, y=1)
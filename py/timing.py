@@ -0,0 +1,611 @@
+from pathlib import Path
+from typing import Optional, Union
+import testfuncs
+import assembler
+import simulator
+from assembler import LinkState, ProgramImage
+from simulator import ARCHS, CYCLES, DECODE
+
+# Abstract nibble of the loop analysis: an int is known, ("r", x, k) is the value register x had
+# when the loop header was entered plus k, None is unknown
+Value = Union[None, int, tuple[str, int, int]]
+# (best, worst) cycles; a worst case of None is unbounded
+Bounds = tuple[int, Optional[int]]
+
+class BasicBlock:
+    """
+    Straight-line code from start up to end (excluded).\n
+    kind is how it ends: "fall" into the next block, "jump" or "branch" (conditional) to target,
+    "call" to target returning to ret, "return" through a computed address, "halt" on a jump to
+    itself, or "stop" when it runs off the program.
+    """
+    __slots__ = ("start", "end", "cycles", "kind", "cond", "target", "ret", "succs")
+
+    def __init__(self, start:int, end:int, cycles:int, kind:str, cond:Optional[str], target:Optional[int], ret:Optional[int], succs:list[int]):
+        self.start = start
+        self.end = end
+        self.cycles = cycles
+        self.kind = kind
+        self.cond = cond
+        self.target = target
+        self.ret = ret
+        self.succs = succs
+
+    def __repr__(self) -> str:
+        return f"BasicBlock(0x{self.start:03X}-0x{self.end:03X}, {self.kind}, cycles={self.cycles})"
+
+class Loop:
+    """Natural loop of a routine; trips and cycles are (best, worst) bounds, the worst being None if unbounded"""
+    __slots__ = ("header", "latches", "body", "counter", "trips", "iteration", "cycles")
+
+    def __init__(self, header:int, latches:list[int], body:set[int]):
+        self.header = header
+        self.latches = latches
+        self.body = body
+        # register counted up until it carries, or None if the trip count is not known
+        self.counter: Optional[int] = None
+        self.trips: Bounds = (1, None)
+        self.iteration: Bounds = (0, None)
+        self.cycles: Bounds = (0, None)
+
+    def __repr__(self) -> str:
+        return f"Loop(0x{self.header:03X}, trips={self.trips}, cycles={self.cycles})"
+
+class Routine:
+    """Blocks reachable from entry without entering called routines; cycles from entry to a return or halt"""
+    __slots__ = ("entry", "blocks", "loops", "cycles")
+
+    def __init__(self, entry:int, blocks:set[int]):
+        self.entry = entry
+        self.blocks = blocks
+        self.loops: list[Loop] = []
+        self.cycles: Optional[Bounds] = None
+
+    def __repr__(self) -> str:
+        return f"Routine(0x{self.entry:03X}, blocks={len(self.blocks)}, cycles={self.cycles})"
+
+class _State:
+    """Abstract machine state of the loop analysis, with the registers and memory written so far"""
+    __slots__ = ("regs", "mem", "stack", "carry", "symbolic", "wregs", "wmem")
+
+    def __init__(self, symbolic:bool):
+        self.regs: dict[int, Value] = {}
+        # None after a store to an unknown address
+        self.mem: Optional[dict[int, Value]] = {}
+        self.stack: list[Value] = [None, None, None]
+        self.carry: Optional[tuple[str, Value]] = None
+        self.symbolic = symbolic
+        self.wregs: set[int] = set()
+        self.wmem: Optional[set[int]] = set()
+
+    def copy(self) -> "_State":
+        s = _State(self.symbolic)
+        s.regs = dict(self.regs)
+        s.mem = dict(self.mem) if self.mem is not None else None
+        s.stack = list(self.stack)
+        s.carry = self.carry
+        s.wregs = set(self.wregs)
+        s.wmem = set(self.wmem) if self.wmem is not None else None
+        return s
+
+    def reg(self, x:int) -> Value:
+        if x in self.regs:
+            return self.regs[x]
+        return ("r", x, 0) if self.symbolic else None
+
+    def havoc(self, wregs:set[int], wmem:Optional[set[int]]):
+        """Forget what a called routine or an inner loop may have written"""
+        for x in wregs:
+            self.regs[x] = None
+        self.wregs |= wregs
+        if wmem is None or self.mem is None:
+            self.mem = None
+            self.wmem = None
+        else:
+            for address in wmem:
+                self.mem[address] = None
+            if self.wmem is not None:
+                self.wmem |= wmem
+        self.stack = [None, None, None]
+        self.carry = None
+
+def _join(states:list[_State]) -> _State:
+    s = states[0].copy()
+    for other in states[1:]:
+        s.regs = {x: v for x, v in s.regs.items() if other.reg(x) == v}
+        for x in other.regs:
+            if x not in s.regs and s.reg(x) != other.regs[x]:
+                s.regs[x] = None
+        if s.mem is None or other.mem is None:
+            s.mem = None
+        else:
+            s.mem = {a: v for a, v in s.mem.items() if other.mem.get(a) == v}
+        s.stack = [v if v == w else None for v, w in zip(s.stack, other.stack)]
+        s.carry = s.carry if s.carry == other.carry else None
+        s.wregs |= other.wregs
+        s.wmem = s.wmem | other.wmem if s.wmem is not None and other.wmem is not None else None
+    return s
+
+def _add(a:Value, b:Value) -> Value:
+    if isinstance(a, int) and isinstance(b, int):
+        return a + b
+    if isinstance(a, tuple) and isinstance(b, int):
+        return ("r", a[1], a[2] + b)
+    if isinstance(a, int) and isinstance(b, tuple):
+        return ("r", b[1], b[2] + a)
+    return None
+
+def _nibble(v:Value) -> Value:
+    return v & 15 if isinstance(v, int) else v
+
+class Analysis:
+    """
+    Static timing of an assembled program.\n
+    Jump targets are taken from the LI loads in front of each JP. An unconditional jump after
+    three (HC4E: two) LI/SA pairs that store the address of a label, as countlcd.asm does before
+    "li #wait_1ms:2 ... jp", is a call returning to that label; a JP through a computed address
+    is a return. Loops that count a register up with AD until the carry is set have a known trip
+    count, tightened to one value when the register is loaded with LI/SA right before the loop.
+    """
+    def __init__(self, image:ProgramImage, ls:LinkState, arch:str="HC4", clock:float=1e6):
+        if arch not in ARCHS:
+            raise ValueError(f"[Error] Unsupported architecture: {arch}")
+        self.arch = arch
+        self.clock = clock
+        pc_bits, _ = ARCHS[arch]
+        self.mask = (1 << pc_bits) - 1
+        self.names: dict[int, str] = {}
+        for label, address in ls.labels.items():
+            self.names.setdefault(address, label)
+        self.insts: dict[int, tuple[str, Optional[str]]] = {}
+        for address in sorted(image):
+            entry = DECODE[arch][image[address][0]]
+            if entry is not None:
+                self.insts[address] = entry
+        self.blocks: dict[int, BasicBlock] = {}
+        self._split(ls)
+        self.routines: dict[int, Routine] = {}
+        self._writes: dict[int, tuple[set[int], Optional[set[int]]]] = {}
+        entries = [min(self.blocks)] if self.blocks else []
+        entries += sorted({b.target for b in self.blocks.values() if b.kind == "call" and b.target in self.blocks})
+        for entry in entries:
+            self.routine(entry)
+
+    def name(self, address:int) -> str:
+        return self.names.get(address, f"0x{address:03X}")
+
+    def _split(self, ls:LinkState):
+        """Find the jump sites, then cut the program into basic blocks"""
+        digits = 3 if self.mask > 0xFF else 2
+        sites: dict[int, tuple[Optional[str], Optional[int], Optional[int]]] = {}
+        stack: list[Value] = [None, None, None]
+        stored: list[int] = []
+        previous = None
+        for address, (mnemonic, operand) in self.insts.items():
+            if previous is not None and address != previous + 1:
+                stack, stored = [None, None, None], []
+            previous = address
+            if mnemonic == "LI" and operand is not None:
+                stack = [int(operand[1:]), stack[0], stack[1]]
+            elif mnemonic in ("LD", "LM"):
+                stack = [None, stack[0], stack[1]]
+            elif mnemonic == "SA":
+                if isinstance(stack[0], int):
+                    stored.append(stack[0])
+            elif mnemonic == "JP":
+                a, b, c = stack
+                target = None
+                if isinstance(a, int) and isinstance(b, int) and (isinstance(c, int) or digits == 2):
+                    target = (((c if isinstance(c, int) else 0) << 8) | (b << 4) | a) & self.mask
+                ret = None
+                if operand is None and target is not None and len(stored) >= digits:
+                    nibbles = stored[-digits:]
+                    candidate = sum(n << (4 * (digits - 1 - i)) for i, n in enumerate(nibbles))
+                    if candidate in self.names and candidate != target:
+                        ret = candidate
+                sites[address] = (operand, target, ret)
+                stack, stored = [None, None, None], []
+
+        leaders = set(self.names) | {t for _, t, r in sites.values() if t is not None} | {r for _, _, r in sites.values() if r is not None}
+        leaders |= {address + 1 for address in sites}
+        previous = None
+        for address in self.insts:
+            if previous is None or address != previous + 1:
+                leaders.add(address)
+            previous = address
+        start: Optional[int] = None
+        cycles = 0
+        for address, (mnemonic, _) in self.insts.items():
+            if start is None:
+                start, cycles = address, 0
+            cycles += CYCLES[mnemonic]
+            following = address + 1
+            if address in sites or following in leaders or following not in self.insts:
+                self.blocks[start] = self._block(start, following, cycles, sites.get(address))
+                start = None
+
+    def _block(self, start:int, end:int, cycles:int, site:Optional[tuple[Optional[str], Optional[int], Optional[int]]]) -> BasicBlock:
+        following = end & self.mask
+        fall = [following] if following in self.insts else []
+        if site is None:
+            return BasicBlock(start, end, cycles, "fall" if fall else "stop", None, None, None, fall)
+        cond, target, ret = site
+        known = [target] if target is not None and target in self.insts else []
+        if target == end - 1:
+            return BasicBlock(start, end, cycles, "halt", cond, target, None, fall if cond is not None else [])
+        if cond is not None:
+            return BasicBlock(start, end, cycles, "branch", cond, target, None, known + [f for f in fall if f not in known])
+        if target is None:
+            return BasicBlock(start, end, cycles, "return", None, None, None, [])
+        if ret is not None:
+            return BasicBlock(start, end, cycles, "call", None, target, ret, [ret] if ret in self.insts else [])
+        return BasicBlock(start, end, cycles, "jump", None, target, None, known)
+
+    def routine(self, entry:int) -> Routine:
+        """Analyse the routine at entry, and the routines it calls, once"""
+        routine = self.routines.get(entry)
+        if routine is not None:
+            return routine
+        seen = {entry}
+        todo = [entry]
+        while todo:
+            for succ in self.blocks[todo.pop()].succs:
+                if succ in self.blocks and succ not in seen:
+                    seen.add(succ)
+                    todo.append(succ)
+        routine = Routine(entry, seen)
+        # a recursive call finds the routine without bounds
+        self.routines[entry] = routine
+        for start in seen:
+            block = self.blocks[start]
+            if block.kind == "call" and block.target in self.blocks:
+                self.routine(block.target)
+        routine.loops = self._loops(routine)
+        for loop in routine.loops:
+            self._time_loop(routine, loop)
+        exits = {start for start in seen if self.blocks[start].kind in ("return", "halt")
+                 or (self.blocks[start].kind == "branch" and self.blocks[start].target is None)}
+        if exits:
+            routine.cycles = self._paths(routine, seen, entry, exits, None)
+        return routine
+
+    def _loops(self, routine:Routine) -> list[Loop]:
+        """Natural loops of a routine, innermost first"""
+        nodes = routine.blocks
+        preds: dict[int, list[int]] = {n: [] for n in nodes}
+        for n in nodes:
+            for s in self.blocks[n].succs:
+                if s in nodes:
+                    preds[s].append(n)
+        dom = {n: set(nodes) for n in nodes}
+        dom[routine.entry] = {routine.entry}
+        changed = True
+        while changed:
+            changed = False
+            for n in sorted(nodes):
+                if n == routine.entry:
+                    continue
+                ps = [dom[p] for p in preds[n]]
+                d = set.intersection(*ps) | {n} if ps else {n}
+                if d != dom[n]:
+                    dom[n], changed = d, True
+        loops: dict[int, Loop] = {}
+        for n in nodes:
+            for h in self.blocks[n].succs:
+                if h in nodes and h in dom[n]:
+                    loop = loops.setdefault(h, Loop(h, [], {h}))
+                    loop.latches.append(n)
+                    todo = [n]
+                    while todo:
+                        m = todo.pop()
+                        if m not in loop.body:
+                            loop.body.add(m)
+                            todo.extend(preds[m])
+        return sorted(loops.values(), key=lambda loop: (len(loop.body), loop.header))
+
+    def _inner(self, routine:Routine, region:set[int], n:int) -> Optional[Loop]:
+        """Outermost loop strictly inside region that contains block n"""
+        best = None
+        for loop in routine.loops:
+            if n in loop.body and loop.body < region and (best is None or len(loop.body) > len(best.body)):
+                best = loop
+        return best
+
+    def _graph(self, routine:Routine, region:set[int], entry:int) -> Optional[tuple[list[int], dict[int, list[int]], dict[int, Optional[Loop]]]]:
+        """Region with its inner loops collapsed onto their headers, in topological order without edges back to entry"""
+        nodes: dict[int, Optional[Loop]] = {}
+        rep: dict[int, int] = {}
+        for n in region:
+            loop = self._inner(routine, region, n)
+            rep[n] = loop.header if loop is not None else n
+            nodes[rep[n]] = loop
+        succs: dict[int, list[int]] = {n: [] for n in nodes}
+        for n in region:
+            for s in self.blocks[n].succs:
+                if s in region and s != entry and rep[s] != rep[n] and rep[s] not in succs[rep[n]]:
+                    succs[rep[n]].append(rep[s])
+        order: list[int] = []
+        state: dict[int, int] = {}
+        def visit(n:int) -> bool:
+            state[n] = 1
+            for s in succs[n]:
+                if state.get(s) == 1 or (s not in state and not visit(s)):
+                    return False
+            state[n] = 2
+            order.append(n)
+            return True
+        for n in sorted(nodes, key=lambda n: n != entry):
+            if n not in state and not visit(n):
+                return None
+        order.reverse()
+        return order, succs, nodes
+
+    def _cost(self, n:int, loop:Optional[Loop]) -> Bounds:
+        if loop is not None:
+            return loop.cycles
+        block = self.blocks[n]
+        if block.kind == "call":
+            callee = self.routines.get(block.target) if block.target is not None else None
+            if callee is None or callee.cycles is None:
+                return (block.cycles, None)
+            best, worst = callee.cycles
+            return (block.cycles + best, block.cycles + worst if worst is not None else None)
+        return (block.cycles, block.cycles)
+
+    def _paths(self, routine:Routine, region:set[int], entry:int, targets:set[int], loop:Optional[Loop]) -> Optional[Bounds]:
+        """Best and worst cycles from entry through one of targets (included)"""
+        graph = self._graph(routine, region, entry)
+        if graph is None:
+            return None
+        order, succs, nodes = graph
+        reach: dict[int, Bounds] = {}
+        for n in order:
+            if n == entry:
+                into: Optional[Bounds] = (0, 0)
+            else:
+                into = None
+                for p in order:
+                    if n in succs[p] and p in reach:
+                        b, w = reach[p]
+                        if into is None:
+                            into = (b, w)
+                        else:
+                            into = (min(into[0], b), None if into[1] is None or w is None else max(into[1], w))
+            if into is None:
+                continue
+            cb, cw = self._cost(n, nodes[n] if n != entry or loop is None else None)
+            reach[n] = (into[0] + cb, None if into[1] is None or cw is None else into[1] + cw)
+        found = []
+        for n in reach:
+            inner = nodes[n]
+            if n in targets or inner is not None and inner.body & targets:
+                found.append(reach[n])
+        if not found:
+            return None
+        worsts = [w for _, w in found if w is not None]
+        return (min(b for b, _ in found), max(worsts) if len(worsts) == len(found) else None)
+
+    def _time_loop(self, routine:Routine, loop:Loop):
+        iteration = self._paths(routine, loop.body, loop.header, set(loop.latches), loop)
+        loop.iteration = iteration if iteration is not None else (0, None)
+        counter, start = self._counter(routine, loop)
+        if counter is not None:
+            loop.counter, step = counter
+            loop.trips = ((15 - start) // step + 1, (15 - start) // step + 1) if start is not None else (1, 15 // step + 1)
+        b, w = loop.iteration
+        loop.cycles = (loop.trips[0] * b, None if w is None or loop.trips[1] is None else loop.trips[1] * w)
+
+    def _counter(self, routine:Routine, loop:Loop) -> tuple[Optional[tuple[int, int]], Optional[int]]:
+        """((register, step), value on entry or None) of a loop counting up until it carries, else (None, None)"""
+        if len(loop.latches) != 1:
+            return None, None
+        latch = self.blocks[loop.latches[0]]
+        if latch.kind != "branch" or latch.cond != "NC" or latch.target != loop.header:
+            return None, None
+        graph = self._graph(routine, loop.body, loop.header)
+        if graph is None or graph[2].get(latch.start, False) is not None:
+            return None, None
+        order, succs, nodes = graph
+        out: dict[int, _State] = {}
+        for n in order:
+            if n == loop.header:
+                state = _State(True)
+            else:
+                ins = [out[p] for p in order if p in out and n in succs[p]]
+                if not ins:
+                    continue
+                state = _join(ins)
+            inner = nodes[n]
+            if inner is not None and n != loop.header:
+                state.havoc(*self._loop_writes(inner))
+            else:
+                self._run(self.blocks[n], state)
+            out[n] = state
+        state = out.get(latch.start)
+        if state is None or state.carry is None or state.carry[0] != "add" or not isinstance(state.carry[1], tuple):
+            return None, None
+        _, x, step = state.carry[1]
+        if step <= 0 or state.regs.get(x) != ("r", x, step):
+            return None, None
+        starts = set()
+        for p in routine.blocks:
+            if p not in loop.body and loop.header in self.blocks[p].succs:
+                entering = _State(False)
+                self._run(self.blocks[p], entering)
+                starts.add(entering.reg(x))
+        start = starts.pop() if len(starts) == 1 else None
+        return (x, step), start if isinstance(start, int) else None
+
+    def _run(self, block:BasicBlock, state:_State):
+        """Abstract execution of a block; a call forgets what the callee writes"""
+        if self.arch == "HC4":
+            io_mem, io_in = simulator.IO_PORTS["HC4"], None
+        else:
+            io_mem, io_in = range(0), simulator._IO_INPUTS["HC4E"].start
+        for address in range(block.start, block.end):
+            mnemonic, operand = self.insts[address]
+            a, b, c = state.stack
+            if mnemonic == "LI" and operand is not None:
+                state.stack = [int(operand[1:]), a, b]
+            elif mnemonic == "LD" and operand is not None:
+                x = int(operand[1:])
+                state.stack = [None if x == io_in else state.reg(x), a, b]
+            elif mnemonic in ("LM", "SM"):
+                address_ = (b << 4) | a if isinstance(a, int) and isinstance(b, int) else None
+                if mnemonic == "LM":
+                    v = None
+                    if address_ is not None and address_ not in io_mem and state.mem is not None:
+                        v = state.mem.get(address_)
+                    state.stack = [v, a, b]
+                elif address_ is None:
+                    state.mem, state.wmem = None, None
+                elif address_ not in io_mem:
+                    if state.mem is not None:
+                        state.mem[address_] = c
+                    if state.wmem is not None:
+                        state.wmem.add(address_)
+            elif mnemonic in ("JP", "NP"):
+                pass
+            elif operand is not None:
+                x = int(operand[1:])
+                if mnemonic == "AD":
+                    v = _add(a, b)
+                    state.carry = ("add", v)
+                elif mnemonic == "SU":
+                    v = a - b if isinstance(a, int) and isinstance(b, int) else None
+                    state.carry = None
+                elif mnemonic == "SA":
+                    v = a
+                elif mnemonic == "SC":
+                    v = c
+                elif isinstance(a, int) and isinstance(b, int):
+                    v = {"XR": a ^ b, "OR": a | b, "AN": a & b}[mnemonic]
+                else:
+                    v = None
+                state.regs[x] = _nibble(v)
+                state.wregs.add(x)
+        if block.kind == "call" and block.target in self.routines:
+            state.havoc(*self._routine_writes(block.target))
+
+    def _routine_writes(self, entry:int) -> tuple[set[int], Optional[set[int]]]:
+        """Registers and [AB] addresses (None: any) a routine and its callees may write"""
+        writes = self._writes.get(entry)
+        if writes is not None:
+            return writes
+        self._writes[entry] = (set(range(16)), None)
+        state = _State(False)
+        for start in self.routines[entry].blocks:
+            s = _State(False)
+            self._run(self.blocks[start], s)
+            state.havoc(s.wregs, s.wmem)
+        self._writes[entry] = (state.wregs, state.wmem)
+        return self._writes[entry]
+
+    def _loop_writes(self, loop:Loop) -> tuple[set[int], Optional[set[int]]]:
+        state = _State(False)
+        for start in loop.body:
+            s = _State(False)
+            self._run(self.blocks[start], s)
+            state.havoc(s.wregs, s.wmem)
+        return state.wregs, state.wmem
+
+    def duration(self, cycles:Optional[int]) -> str:
+        """Cycles as time at the clock frequency"""
+        if cycles is None:
+            return "unbounded"
+        seconds = cycles / self.clock
+        if seconds >= 1:
+            return f"{seconds:.3f} s"
+        if seconds >= 1e-3:
+            return f"{seconds * 1e3:.3f} ms"
+        return f"{seconds * 1e6:.1f} us"
+
+    def _bounds(self, bounds:Optional[Bounds]) -> str:
+        if bounds is None:
+            return "no exit"
+        best, worst = bounds
+        if best == worst:
+            return f"{best} cycles ({self.duration(best)})"
+        worst_cycles = worst if worst is not None else "?"
+        return f"{best}..{worst_cycles} cycles ({self.duration(best)} .. {self.duration(worst)})"
+
+    def annotations(self) -> dict[int, str]:
+        """Address -> comment for the listing: routine entries and loop headers"""
+        notes: dict[int, list[str]] = {}
+        for routine in self.routines.values():
+            notes.setdefault(routine.entry, []).append(f"routine: {self._bounds(routine.cycles)}")
+            for loop in routine.loops:
+                best, worst = loop.trips
+                trips = f"x{best}" if best == worst else f"x{best}..{worst if worst is not None else '?'}"
+                notes.setdefault(loop.header, []).append(f"loop {trips}: {self._bounds(loop.cycles)}")
+        return {address: "; ".join(dict.fromkeys(n)) for address, n in notes.items()}
+
+    def report(self) -> list[str]:
+        """Timing section of the listing"""
+        lines = [f"Timing at {self.clock:g} Hz:", "Basic blocks:"]
+        for block in self.blocks.values():
+            name = self.names.get(block.start, "")
+            lines.append(f"  {block.start:04X}-{block.end - 1:04X}  {name:<24} {block.kind:<7} {block.cycles:6} cycles")
+        lines.append("Loops:")
+        for routine in self.routines.values():
+            for loop in routine.loops:
+                best, worst = loop.trips
+                trips = f"{best}" if best == worst else f"{best}..{worst if worst is not None else '?'}"
+                counter = f"r{loop.counter}" if loop.counter is not None else "-"
+                lines.append(f"  {loop.header:04X}  {self.name(loop.header):<24} trips {trips:<6} counter {counter:<4} "
+                             f"iteration {self._bounds(loop.iteration)}, total {self._bounds(loop.cycles)}")
+        lines.append("Routines:")
+        for routine in self.routines.values():
+            lines.append(f"  {routine.entry:04X}  {self.name(routine.entry):<24} {self._bounds(routine.cycles)}")
+        return lines
+
+def analyze(image:ProgramImage, ls:LinkState, arch:str="HC4", clock:float=1e6) -> Analysis:
+    """Build the control-flow graph of an assembled program and bound the cycles of its loops and routines"""
+    return Analysis(image, ls, arch, clock)
+
+def _machine_at(lines:list[str], include:list[str], label:str) -> simulator.Machine:
+    """countlcd.asm on the simulator, stopped at label after one button press that overflows the counter"""
+    m = simulator.load_source(lines, "HC4", include)
+    m.run(None, "main")
+    m.regs[4:8] = [9, 9, 9, 9]
+    m.inputs[0xF0] = 1
+    m.add_hook("poll_release", lambda machine: machine.inputs.update({0xF0: 0}))
+    m.add_hook("poll", lambda machine: machine.inputs.update({0xF0: 1}))
+    m.run(None, label)
+    return m
+
+def self_test():
+    lines = ["LI #3", "SA r1", "LOOP:", "LD r1", "LI #1", "AD r1", "LI #LOOP:2", "LI #LOOP:1", "LI #LOOP:0", "JP NC",
+             "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"]
+    job = assembler.Assembler("HC4", [])
+    a = analyze(job.run(lines), job.ls)
+    testfuncs.expect([(0, "fall"), (2, "branch"), (9, "fall"), (12, "halt")], lambda: [(b.start, b.kind) for b in a.blocks.values()])
+    loop = a.routines[0].loops[0]
+    testfuncs.expect((2, 1, (13, 13), (7, 7), (91, 91)), lambda: (loop.header, loop.counter, loop.trips, loop.iteration, loop.cycles))
+    testfuncs.expect((2 + 91 + 4, 2 + 91 + 4), lambda: a.routines[0].cycles)
+    # without the LI/SA in front, the counter may start anywhere
+    job = assembler.Assembler("HC4", [])
+    a = analyze(job.run(lines[2:]), job.ls)
+    testfuncs.expect((1, 16), lambda: a.routines[0].loops[0].trips)
+
+    root = Path(__file__).resolve().parent
+    include = [str(root.parent / "include")]
+    with open(root / "test_files" / "countlcd.asm", 'r', encoding='utf-8') as f:
+        countlcd = f.read().splitlines()
+    job = assembler.Assembler("HC4", include)
+    a = analyze(job.run(countlcd), job.ls)
+    labels = job.ls.labels
+    trips = {a.name(loop.header): loop.trips for r in a.routines.values() for loop in r.loops}
+    testfuncs.expect({"WAIT_1MS_LOOP": (11, 11), "WAIT_1MS_LOOP2": (12, 12), "WAIT_100MS_LOOP": (14, 14), "WAIT_100MS_LOOP2": (7, 7)},
+                     lambda: {k: v for k, v in trips.items() if k.startswith("WAIT_1")})
+    # the bounds match the cycles the simulator measures between call and return
+    for name, ret in (("WAIT_1MS", "WAIT_1MS_RET"), ("WAIT_100MS", "DONE"), ("WAIT_264US", "WRITE1000")):
+        m = _machine_at(countlcd, include, name)
+        entered = m.cycles
+        m.run(None, ret)
+        testfuncs.expect((m.cycles - entered,) * 2, lambda: a.routines[labels[name]].cycles)
+    testfuncs.expect(True, lambda: "loop x11: 1023 cycles (1.023 ms)" in a.annotations()[labels["WAIT_1MS_LOOP"]])
+    print("[OK] timing.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
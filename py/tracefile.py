@@ -0,0 +1,339 @@
+"""
+Trace recordings: fixed-width packed records in a memory-mapped file, with a sidecar index.\n
+    FILE      : header(32) record*
+                header = magic(8) version(4) record size(4) records(8) start time(8, float, epoch)
+                record = regs(8, r0 | r1 << 4, ...) pc(2) inst(1) pad(1) time(8, µs since start)
+    FILE.idx  : header(32) pc table, time table, postings
+                header = magic(8) version(4) records(8) pc slots(4) time entries(8)
+                pc table  : (first posting, count) per PC value, 2 x u32
+                time table: (time, first record) per batch of records sharing a time, 2 x u64
+                postings  : record numbers in order, u32, grouped by PC
+All integers are little-endian. Records are appended in time order, so both tables answer a
+query by PC and/or time range with binary searches, without decoding the recording.
+"""
+import bisect
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import Iterator, Optional, Sequence
+import testfuncs
+
+MAGIC = b"HCXTRACE"
+INDEX_MAGIC = b"HCXTIDX\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQd")
+RECORD = struct.Struct("<8sHBxQ")
+INDEX_HEADER = struct.Struct("<8sIQIQ")
+# 12-bit PC of HC4
+PC_SLOTS = 4096
+_GROW = 64 * 1024
+
+class TraceFileError(Exception):
+    pass
+
+def _values(lines:bytes) -> list[int]:
+    """Fields of "r0,...,r15,pc,inst" lines, 18 per record"""
+    return list(map(int, lines.replace(b"\r", b"").replace(b"\n", b",").split(b",")))
+
+class TraceWriter:
+    """
+    Appends records to a recording (created if missing); close() writes the index.\n
+    The record count in the header is updated with every append, so a recording cut short
+    stays readable; its index is rebuilt by the reader.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        self._file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            magic, version, size, self.records, self.start = HEADER.unpack(self._file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION or size != RECORD.size:
+                self._file.close()
+                raise TraceFileError(f"[Error] '{path}' is not a trace recording of this version")
+        else:
+            self.records, self.start = 0, time.time()
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0, self.start))
+        # the index of what is already there, extended as records arrive
+        index = TraceIndex.build(path) if exists else TraceIndex()
+        self._postings = index.postings_by_pc()
+        self._times = list(zip(index.times, index.firsts))
+        self._last_time = self._times[-1][0] if self._times else 0
+        index.close()
+        self._capacity = 0
+        self._map: Optional[mmap.mmap] = None
+        self._reserve(0)
+
+    def __repr__(self) -> str:
+        return f"TraceWriter({self.path!r}, records={self.records})"
+
+    def __enter__(self) -> "TraceWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reserve(self, count:int):
+        needed = HEADER.size + (self.records + count) * RECORD.size
+        if self._map is not None and needed <= self._capacity:
+            return
+        if self._map is not None:
+            self._map.close()
+        self._capacity = max(needed, 2 * self._capacity, HEADER.size + _GROW)
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def append_lines(self, lines:bytes, now:Optional[float]=None) -> int:
+        """
+        Append "r0,...,r15,pc,inst" lines (newline separated) received at now (epoch seconds).\n
+        Returns the number of lines skipped because a register, the PC or the instruction is out of range.
+        """
+        if not lines:
+            return 0
+        values = _values(lines)
+        count = len(values) // 18
+        stamp = max(self._last_time, int(((time.time() if now is None else now) - self.start) * 1e6))
+        self._reserve(count)
+        assert self._map is not None
+        first = self.records
+        offset = HEADER.size + self.records * RECORD.size
+        pack_into = RECORD.pack_into
+        for i in range(0, count * 18, 18):
+            pc = values[i + 16]
+            if pc >= PC_SLOTS or values[i + 17] > 0xFF or max(values[i:i + 16]) > 15:
+                continue
+            regs = bytes(values[i + k] | values[i + k + 1] << 4 for k in range(0, 16, 2))
+            pack_into(self._map, offset, regs, pc, values[i + 17], stamp)
+            self._postings.setdefault(pc, array("I")).append(self.records)
+            self.records += 1
+            offset += RECORD.size
+        if self.records > first and (not self._times or self._times[-1][0] != stamp):
+            self._times.append((stamp, first))
+        self._last_time = stamp
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, self.records, self.start)
+        return count - (self.records - first)
+
+    def close(self):
+        if self._map is None:
+            return
+        self._map.close()
+        self._map = None
+        self._file.truncate(HEADER.size + self.records * RECORD.size)
+        self._file.close()
+        TraceIndex(self.records, self._postings, self._times).write(self.path + ".idx")
+
+class TraceIndex:
+    """
+    Record numbers by PC and first records by time. Read from a sidecar file, the tables are
+    views of its memory map, so opening an index costs the same for any length of recording.
+    """
+    def __init__(self, records:int=0, postings:Optional[dict[int, array]]=None, times:Sequence[tuple[int, int]]=()):
+        self.records = records
+        table = array("I", bytes(8 * PC_SLOTS))
+        flat = array("I")
+        for pc in sorted(postings or {}):
+            table[2 * pc] = len(flat)
+            table[2 * pc + 1] = len(postings[pc])  # type: ignore[index]
+            flat.extend(postings[pc])  # type: ignore[index]
+        self.table: Sequence[int] = table
+        self.postings: Sequence[int] = flat
+        self.times: Sequence[int] = array("Q", (t for t, _ in times))
+        self.firsts: Sequence[int] = array("Q", (first for _, first in times))
+        self._map: Optional[mmap.mmap] = None
+
+    def __repr__(self) -> str:
+        return f"TraceIndex(records={self.records}, times={len(self.times)})"
+
+    def close(self):
+        if self._map is not None:
+            for view in (self.table, self.postings, self.times, self.firsts):
+                view.release()  # type: ignore[attr-defined]
+            self._map.close()
+            self._map = None
+
+    def postings_by_pc(self) -> dict[int, array]:
+        return {pc: array("I", self.at_pc(pc)) for pc in range(PC_SLOTS) if self.table[2 * pc + 1]}
+
+    def histogram(self) -> dict[int, int]:
+        """Records per PC, read off the PC table"""
+        return {pc: self.table[2 * pc + 1] for pc in range(PC_SLOTS) if self.table[2 * pc + 1]}
+
+    def at_pc(self, pc:int) -> Sequence[int]:
+        first, count = self.table[2 * pc], self.table[2 * pc + 1]
+        return self.postings[first:first + count]
+
+    def write(self, path:str):
+        times = array("Q")
+        for t, first in zip(self.times, self.firsts):
+            times.extend((t, first))
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, self.records, PC_SLOTS, len(self.times)))
+            f.write(array("I", self.table).tobytes())
+            f.write(times.tobytes())
+            f.write(array("I", self.postings).tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path:str, records:int) -> Optional["TraceIndex"]:
+        """The index in path, or None if it is missing or does not cover exactly records records"""
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, version, indexed, slots, entries = INDEX_HEADER.unpack_from(data)
+        except struct.error:
+            data.close()
+            return None
+        size = INDEX_HEADER.size + 8 * PC_SLOTS + 16 * entries + 4 * records
+        if magic != INDEX_MAGIC or version != VERSION or indexed != records or slots != PC_SLOTS or len(data) != size:
+            data.close()
+            return None
+        index = cls(records)
+        view = memoryview(data)
+        offset = INDEX_HEADER.size
+        index.table = view[offset:offset + 8 * PC_SLOTS].cast("I")
+        offset += 8 * PC_SLOTS
+        times = view[offset:offset + 16 * entries].cast("Q")
+        index.times, index.firsts = times[0::2], times[1::2]
+        times.release()
+        offset += 16 * entries
+        index.postings = view[offset:].cast("I")
+        view.release()
+        index._map = data
+        return index
+
+    @classmethod
+    def build(cls, path:str) -> "TraceIndex":
+        """
+        Index of the recording in path, from its sidecar, or rebuilt from the records (and saved)
+        if the sidecar is missing or out of date, e.g. because the recording was cut short.
+        """
+        with TraceReader(path, index=False) as reader:
+            index = cls.read(path + ".idx", reader.records)
+            if index is not None:
+                return index
+            postings: dict[int, array] = {}
+            times: list[tuple[int, int]] = []
+            for n, (_, pc, _, stamp) in enumerate(RECORD.iter_unpack(reader.data)):
+                postings.setdefault(pc, array("I")).append(n)
+                if not times or times[-1][0] != stamp:
+                    times.append((stamp, n))
+            index = cls(reader.records, postings, times)
+        try:
+            index.write(path + ".idx")
+        except OSError:
+            pass
+        return index
+
+class TraceReader:
+    """Read-only view of a recording; select() finds records through the index"""
+    def __init__(self, path:str, index:bool=True):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            try:
+                magic, version, size, records, self.start = HEADER.unpack(header)
+            except struct.error:
+                raise TraceFileError(f"[Error] '{path}' is not a trace recording") from None
+            if magic != MAGIC or version != VERSION or size != RECORD.size:
+                raise TraceFileError(f"[Error] '{path}' is not a trace recording of this version")
+            length = os.fstat(f.fileno()).st_size
+            self.records = min(records, (length - HEADER.size) // RECORD.size)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if length else None
+        self.data = memoryview(self._map)[HEADER.size:HEADER.size + self.records * RECORD.size] if self._map else memoryview(b"")
+        self.index: Optional[TraceIndex] = None
+        if index:
+            self.index = TraceIndex.build(path)
+            if self.index.records != self.records:
+                raise TraceFileError(f"[Error] The index of '{path}' does not match the recording")
+
+    def __repr__(self) -> str:
+        return f"TraceReader({self.path!r}, records={self.records})"
+
+    def __enter__(self) -> "TraceReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.data.release()
+        if self._map is not None:
+            self._map.close()
+        if self.index is not None:
+            self.index.close()
+
+    def __len__(self) -> int:
+        return self.records
+
+    def record(self, n:int) -> dict:
+        regs, pc, inst, stamp = RECORD.unpack_from(self.data, n * RECORD.size)
+        return {"regs": [v for b in regs for v in (b & 0xF, b >> 4)], "pc": pc, "inst": inst, "time": stamp / 1e6, "n": n}
+
+    def span(self, start:Optional[float]=None, end:Optional[float]=None) -> tuple[int, int]:
+        """Record numbers [first, stop) with start <= time (seconds from the start of the recording) <= end"""
+        assert self.index is not None
+        times, firsts = self.index.times, self.index.firsts
+        first = 0
+        if start is not None:
+            i = bisect.bisect_left(times, int(start * 1e6))
+            first = firsts[i] if i < len(times) else self.records
+        stop = self.records
+        if end is not None:
+            i = bisect.bisect_right(times, int(end * 1e6))
+            stop = firsts[i] if i < len(times) else self.records
+        return first, max(first, stop)
+
+    def select(self, pc:Optional[int]=None, start:Optional[float]=None, end:Optional[float]=None, limit:Optional[int]=None) -> Iterator[dict]:
+        """Records at pc (any if None) within the time range, in order"""
+        assert self.index is not None
+        first, stop = self.span(start, end)
+        if pc is None:
+            numbers: Sequence[int] = range(first, stop)
+        else:
+            postings = self.index.at_pc(pc) if 0 <= pc < PC_SLOTS else []
+            numbers = postings[bisect.bisect_left(postings, first):bisect.bisect_left(postings, stop)]
+        if limit is not None:
+            numbers = numbers[:limit]
+        for n in numbers:
+            yield self.record(n)
+
+def self_test():
+    import tempfile
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, "trace.hct")
+    line = lambda pc, r0=0: b",".join(b"%d" % v for v in [r0] + list(range(1, 16)) + [pc, 0xE1])  # noqa: E731
+    with TraceWriter(path) as writer:
+        writer.append_lines(b"\n".join(line(pc) for pc in (0, 1, 2, 1)), writer.start)
+        writer.append_lines(line(1, 15) + b"\r\n" + line(3), writer.start + 0.5)
+    testfuncs.expect((32 + 6 * 20, 32 + 8 * 4096 + 6 * 4 + 2 * 16), lambda: (os.path.getsize(path), os.path.getsize(path + ".idx")))
+    # appending in a later session extends both the recording and the index
+    with TraceWriter(path) as writer:
+        writer.append_lines(line(1, 7), writer.start + 2.0)
+        # fields that do not fit a record are skipped, not wrapped into another register or PC
+        testfuncs.expect(2, writer.append_lines, line(PC_SLOTS) + b"\n" + line(1, 16), writer.start + 3.0)
+    with TraceReader(path) as reader:
+        testfuncs.expect({"regs": [15] + list(range(1, 16)), "pc": 1, "inst": 0xE1, "time": 0.5, "n": 4}, reader.record, 4)
+        testfuncs.expect([1, 3, 4, 6], lambda: [r["n"] for r in reader.select(pc=1)])
+        testfuncs.expect([4], lambda: [r["n"] for r in reader.select(pc=1, start=0.1, end=1.0)])
+        testfuncs.expect([(4, 0.5), (5, 0.5), (6, 2.0)], lambda: [(r["n"], r["time"]) for r in reader.select(start=0.5)])
+        testfuncs.expect([1, 3], lambda: [r["n"] for r in reader.select(pc=1, limit=2)])
+        testfuncs.expect([], lambda: list(reader.select(pc=9)))
+        testfuncs.expect({0: 1, 1: 4, 2: 1, 3: 1}, reader.index.histogram)  # type: ignore[union-attr]
+    # a recording whose index was lost (the trace was killed) is indexed again from its records
+    os.unlink(path + ".idx")
+    with TraceReader(path) as reader:
+        testfuncs.expect([0.0, 0.5, 2.0], lambda: list(t / 1e6 for t in reader.index.times))  # type: ignore[union-attr]
+    testfuncs.expect(True, os.path.exists, path + ".idx")
+    with open(os.path.join(directory.name, "other.bin"), "wb") as f:
+        f.write(b"\0" * 64)
+    testfuncs.expect_raises(TraceFileError, TraceReader, os.path.join(directory.name, "other.bin"))
+    directory.cleanup()
+    print("[OK] tracefile.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,179 @@
+"""
+Trace streaming for load4e.py: an asyncio loop over the serial port and stdin.\n
+The loader firmware sends one "r0,...,r15,pc,inst" line per instruction after "t\\n". Lines are
+converted in whole batches by one regex substitution (no per-record int parsing) and written
+as one JSON array (or block of text) per batch, rate times per second, so high-rate traces
+are read as fast as they arrive. Commands typed on stdin go to the device at once; "q" (or
+the end of stdin) stops the stream without waiting for another trace line.
+"""
+import asyncio
+import os
+import re
+import threading
+from typing import BinaryIO, Callable, Optional, Union
+import testfuncs
+
+FIELDS = 18
+_RECORD = re.compile(rb"^" + rb",".join([rb"(\d+)"] * FIELDS) + rb"\r?$", re.M)
+_JSON = b'{"regs":[' + b",".join(b"\\g<%d>" % i for i in range(1, 17)) + b'],"pc":\\g<17>,"inst":\\g<18>}'
+# the layout load4e.py has always printed
+_TEXT = b"".join(b"R%d: \\g<%d>  " % (i, i + 1) for i in range(16)) + b"\nPC: \\g<17>, INST: \\g<18>"
+
+class TraceParser:
+    """
+    Splits what arrives from the device into records and converts them.\n
+    feed() returns the converted complete lines (JSON objects, or the text layout) in pieces to
+    be joined with separator, keeping a partial line for the next call; lines keeps the record
+    lines of the last call as received. Lines that are not records are counted in skipped.
+    """
+    def __init__(self, json_out:bool=True):
+        self.template = _JSON if json_out else _TEXT
+        self.separator = b"," if json_out else b"\n"
+        self.records = 0
+        self.skipped = 0
+        self.lines = b""
+        self._partial = b""
+
+    def feed(self, data:bytes) -> list[bytes]:
+        end = data.rfind(b"\n")
+        if end < 0:
+            self._partial += data
+            self.lines = b""
+            return []
+        lines = self._partial + data[:end]
+        self._partial = data[end + 1:]
+        count = lines.count(b"\n") + 1
+        out, n = _RECORD.subn(self.template, lines)
+        if n == count:
+            self.records += n
+            self.lines = lines
+            return [out.replace(b"\n", self.separator)]
+        # noise on the line: convert the records one by one
+        good = [line for line in lines.split(b"\n") if _RECORD.fullmatch(line)]
+        self.records += len(good)
+        self.skipped += count - len(good)
+        self.lines = b"\n".join(good)
+        return [_RECORD.sub(self.template, line) for line in good]
+
+def _watch(loop:asyncio.AbstractEventLoop, fileno:Callable[[], int], read:Callable[[], bytes], put:Callable[[Union[bytes, Exception]], None], eof:bool) -> Callable[[], object]:
+    """
+    Pass everything read() returns to put, calling read from the event loop whenever fileno()
+    is readable; where the loop cannot watch it (Windows, regular files), a daemon thread calls
+    read in a loop instead. With eof, an empty read is the end of input: b"" is put once and
+    watching stops. Errors are put too. Returns a function that stops watching.
+    """
+    def once(emit:Callable[[Union[bytes, Exception]], object]) -> bool:
+        try:
+            data = read()
+        except Exception as e:
+            emit(e)
+            return False
+        if data or eof:
+            emit(data)
+        return bool(data) or not eof
+    try:
+        fd = fileno()
+        def ready():
+            if not once(put):
+                loop.remove_reader(fd)
+        loop.add_reader(fd, ready)
+        return lambda: loop.remove_reader(fd)
+    except (AttributeError, NotImplementedError, OSError, ValueError):
+        pass
+    stopped = threading.Event()
+    def pump():
+        emit = lambda item: loop.call_soon_threadsafe(put, item)  # noqa: E731
+        while not stopped.is_set() and once(emit):
+            pass
+    threading.Thread(target=pump, daemon=True).start()
+    return stopped.set
+
+async def stream(ser, out:BinaryIO, stdin:Optional[BinaryIO]=None, json_out:bool=True, rate:float=20.0, record=None) -> dict:
+    """
+    Stream a trace that has been started on ser to out until "q" or the end of stdin.\n
+    ser is a pyserial port; its timeout is changed. Records also go to record (a
+    tracefile.TraceWriter) if given; records it cannot hold are counted as skipped.
+    Returns {"records", "skipped", "batches"}.
+    """
+    loop = asyncio.get_running_loop()
+    parser = TraceParser(json_out)
+    pending: list[bytes] = []
+    batches = 0
+    stop = asyncio.Event()
+    failure: list[Exception] = []
+    commands = b""
+
+    def serial_data(item:Union[bytes, Exception]):
+        if stop.is_set():
+            return
+        if isinstance(item, Exception):
+            failure.append(item)
+            stop.set()
+        else:
+            pending.extend(parser.feed(item))
+            if record is not None and parser.lines:
+                parser.skipped += record.append_lines(parser.lines)
+
+    def stdin_data(item:Union[bytes, Exception]):
+        nonlocal commands
+        if stop.is_set():
+            return
+        if isinstance(item, Exception) or not item:
+            stop.set()
+            return
+        commands += item
+        while b"\n" in commands:
+            line, _, commands = commands.partition(b"\n")
+            ser.write(line.strip() + b"\n")
+            if line.strip().lower() == b"q":
+                stop.set()
+                return
+
+    def flush():
+        nonlocal batches
+        if not pending:
+            return
+        if json_out:
+            out.write(b"[" + b",".join(pending) + b"]\n")
+        else:
+            out.write(b"\n".join(pending) + b"\n")
+        out.flush()
+        pending.clear()
+        batches += 1
+
+    # reads are immediate once the port is readable; the timeout bounds them in the thread fallback
+    ser.timeout = 0.05
+    stoppers = []
+    stoppers.append(_watch(loop, ser.fileno, lambda: ser.read(ser.in_waiting or 1), serial_data, eof=False))
+    if stdin is not None:
+        stoppers.append(_watch(loop, stdin.fileno, lambda: os.read(stdin.fileno(), 4096), stdin_data, eof=True))
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 1.0 / rate)
+            except asyncio.TimeoutError:
+                pass
+            flush()
+    finally:
+        for stopper in stoppers:
+            stopper()
+        flush()
+    if failure:
+        raise failure[0]
+    return {"records": parser.records, "skipped": parser.skipped, "batches": batches}
+
+def self_test():
+    regs = b"1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,0,"
+    parser = TraceParser()
+    testfuncs.expect([], parser.feed, regs + b"16")
+    testfuncs.expect([b'{"regs":[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,0],"pc":16,"inst":225},{"regs":[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0],"pc":1,"inst":2}'],
+                     parser.feed, b",225\r\n" + b"0," * 16 + b"1,2\n")
+    testfuncs.expect([b'{"regs":[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,0],"pc":17,"inst":2}'], parser.feed, b"Trace start\n" + regs + b"17,2\n1,2\n")
+    testfuncs.expect((3, 2, regs + b"17,2"), lambda: (parser.records, parser.skipped, parser.lines))
+    text = TraceParser(json_out=False)
+    testfuncs.expect([b"R0: 0  R1: 0  R2: 0  R3: 0  R4: 0  R5: 0  R6: 0  R7: 0  R8: 0  R9: 0  R10: 0  R11: 0  R12: 0  R13: 0  R14: 0  R15: 0  \nPC: 3, INST: 4"],
+                     text.feed, b"0," * 16 + b"3,4\n")
+    print("[OK] tracestream.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()
@@ -0,0 +1,356 @@
+import random
+import time
+from pathlib import Path
+from typing import Iterable, Optional, Union
+import testfuncs
+import simulator
+from simulator import Machine, _KINDS, _OP_CYCLES, IO_PORTS, _IO_INPUTS
+from simulator import (_INVALID, _LI, _LD, _AD, _SA, _JP, _JPC, _JPNC, _JPZ, _JPNZ,
+                       _XR, _OR, _AN, _SU, _SC, _SM, _LM, _NP)
+
+# Operand of the translated code: an int is a constant known at translation time, a str a local variable
+Value = Union[int, str]
+
+class Block:
+    """Straight-line code from start up to a JP (included) or the next leader, compiled into one function"""
+    __slots__ = ("start", "end", "count", "cycles", "jump", "fn", "source")
+
+    def __init__(self, start:int, end:int, count:int, cycles:int, jump:int, fn, source:str):
+        self.start = start
+        self.end = end
+        self.count = count
+        self.cycles = cycles
+        # address of the closing JP, which is a halt if it returns its own address; -1 without one
+        self.jump = jump
+        self.fn = fn
+        self.source = source
+
+    def __repr__(self) -> str:
+        return f"Block(0x{self.start:03X}-0x{self.end:03X}, count={self.count})"
+
+class _Emitter:
+    """Translates one block into Python source, tracking the stack and the flags symbolically"""
+    def __init__(self, arch:str, mask:int):
+        self.mask = mask
+        if arch == "HC4":
+            ports = IO_PORTS[arch]
+            self.io_mem, self.io_mem_end, self.io_reg, self.io_in = ports.start, ports.stop, 16, 16
+        else:
+            self.io_mem, self.io_mem_end = 256, 256
+            self.io_reg, self.io_in = IO_PORTS[arch].start, _IO_INPUTS[arch].start
+        self.lines: list[str] = ["a0 = m.a", "b0 = m.b", "c0 = m.c"]
+        self.stack: list[Value] = ["a0", "b0", "c0"]
+        self.carry: Optional[str] = None
+        self.zero: Optional[str] = None
+        self.temps = 0
+        # instructions and cycles executed in the block so far
+        self.count = 0
+        self.cycles = 0
+
+    def temp(self, expr:str) -> str:
+        self.temps += 1
+        name = f"t{self.temps}"
+        self.lines.append(f"{name} = {expr}")
+        return name
+
+    def push(self, value:Value):
+        self.stack = [value, self.stack[0], self.stack[1]]
+
+    def sync(self):
+        """Counters as the interpreter has them when an I/O callback runs"""
+        self.lines.append(f"m.instructions = n + {self.count}; m.cycles = cycles + {self.cycles}")
+
+    def store(self, x:int, value:Value):
+        self.lines.append(f"regs[{x}] = {value}")
+        if x >= self.io_reg:
+            self.sync()
+            self.lines.append(f"m.io_write({x}, {value})")
+        self.zero = str(value == 0) if isinstance(value, int) else f"{value} == 0"
+
+    def alu(self, k:int, x:int):
+        a, b = self.stack[0], self.stack[1]
+        if k == _SA:
+            self.store(x, a)
+            return
+        if k == _SC:
+            self.store(x, self.stack[2])
+            return
+        if k in (_AD, _SU):
+            op = "+" if k == _AD else "-"
+            if isinstance(a, int) and isinstance(b, int):
+                s = a + b if k == _AD else a - b
+                self.carry = str(s > 15 if k == _AD else s < 0)
+                self.store(x, s & 15)
+                return
+            s = self.temp(f"{a} {op} {b}")
+            self.carry = f"{s} > 15" if k == _AD else f"{s} < 0"
+            self.store(x, self.temp(f"{s} & 15"))
+            return
+        op = {_XR: "^", _OR: "|", _AN: "&"}[k]
+        if isinstance(a, int) and isinstance(b, int):
+            self.store(x, eval(f"{a} {op} {b}"))
+            return
+        self.store(x, self.temp(f"{a} {op} {b}"))
+
+    def memory(self, k:int):
+        a, b, c = self.stack
+        if isinstance(a, int) and isinstance(b, int):
+            address = (b << 4) | a
+            io = self.io_mem <= address < self.io_mem_end
+            if k == _SM:
+                self.zero = str(c == 0) if isinstance(c, int) else f"{c} == 0"
+                if io:
+                    self.sync()
+                    self.lines.append(f"m.io_write({address}, {c})")
+                else:
+                    self.lines.append(f"mem[{address}] = {c}")
+            elif io:
+                self.sync()
+                self.push(self.temp(f"m.io_read({address})"))
+            else:
+                self.push(self.temp(f"mem[{address}]"))
+            return
+        address = self.temp(f"({b} << 4) | {a}")
+        self.lines.append(f"if {self.io_mem} <= {address} < {self.io_mem_end}:")
+        self.lines.append(f"    m.instructions = n + {self.count}; m.cycles = cycles + {self.cycles}")
+        if k == _SM:
+            self.zero = str(c == 0) if isinstance(c, int) else f"{c} == 0"
+            self.lines.append(f"    m.io_write({address}, {c})")
+            self.lines.append("else:")
+            self.lines.append(f"    mem[{address}] = {c}")
+        else:
+            self.temps += 1
+            name = f"t{self.temps}"
+            self.lines.append(f"    {name} = m.io_read({address})")
+            self.lines.append("else:")
+            self.lines.append(f"    {name} = mem[{address}]")
+            self.push(name)
+
+    def load(self, x:int):
+        if x == self.io_in:
+            self.sync()
+            self.push(self.temp(f"m.io_read({x})"))
+        else:
+            self.push(self.temp(f"regs[{x}]"))
+
+    def target(self) -> Value:
+        a, b, c = self.stack
+        if isinstance(a, int) and isinstance(b, int) and isinstance(c, int):
+            return ((c << 8) | (b << 4) | a) & self.mask
+        return f"(({c} << 8) | ({b} << 4) | {a}) & {self.mask}"
+
+    def finish(self, next_pc:Value) -> str:
+        a, b, c = self.stack
+        self.lines.append(f"m.a = {a}; m.b = {b}; m.c = {c}")
+        if self.carry is not None:
+            self.lines.append(f"m.carry = {self.carry}")
+        if self.zero is not None:
+            self.lines.append(f"m.zero = {self.zero}")
+        self.lines.append(f"return {next_pc}")
+        return "def block(m, regs, mem, n, cycles):\n" + "\n".join("    " + line for line in self.lines) + "\n"
+
+class BlockMachine(Machine):
+    """
+    Machine that translates straight-line code into Python functions.\n
+    The program is split into basic blocks at labels, jump targets and the addresses run() stops
+    at; each block is compiled once on first use and runs without per-instruction dispatch, the
+    stack and constant jump targets being resolved at translation time. Instruction and cycle
+    counts, flags, I/O and stop reasons are exactly those of the interpreter. Loading code into
+    program memory drops the blocks it overlaps; [AB] memory is data only and never holds code.
+    """
+    def __init__(self, arch:str="HC4", code:Union[bytes, bytearray]=b"", labels:Optional[dict[str, int]]=None):
+        self.blocks: dict[int, Block] = {}
+        self.leaders: set[int] = set()
+        self.translations = 0
+        super().__init__(arch, code, labels)
+        self.leaders.update(address & (self.rom_size - 1) for address in self.labels.values())
+
+    def load(self, code:Union[bytes, bytearray], address:int=0):
+        super().load(code, address)
+        end = address + len(code)
+        for start, block in list(self.blocks.items()):
+            if block.start < end and address < block.end:
+                del self.blocks[start]
+
+    def add_leader(self, address:int):
+        """Start a block at address, dropping translated blocks that run across it"""
+        if address in self.leaders:
+            return
+        self.leaders.add(address)
+        for start, block in list(self.blocks.items()):
+            if block.start < address < block.end:
+                del self.blocks[start]
+
+    def translate(self, pc:int) -> Optional[Block]:
+        """Block starting at pc, or None if the instruction at pc is invalid"""
+        kinds = _KINDS[self.arch]
+        op_cycles = _OP_CYCLES[self.arch]
+        mask = self.rom_size - 1
+        e = _Emitter(self.arch, mask)
+        address = pc
+        jump = -1
+        next_pc: Value = pc
+        while address < self.rom_size:
+            if address != pc and address in self.leaders:
+                break
+            op = self.rom[address]
+            k = kinds[op]
+            if k == _INVALID:
+                break
+            x = op & 15
+            if k == _LI:
+                e.push(x)
+            elif k == _LD:
+                e.load(x)
+            elif k in (_SM, _LM):
+                e.memory(k)
+            elif _JP <= k <= _JPNZ:
+                target = e.target()
+                following = (address + 1) & mask
+                if k == _JP:
+                    next_pc = target
+                else:
+                    flag = {_JPC: e.carry or "m.carry", _JPNC: e.carry or "m.carry",
+                            _JPZ: e.zero or "m.zero", _JPNZ: e.zero or "m.zero"}[k]
+                    taken = f"({flag})" if k in (_JPC, _JPZ) else f"not ({flag})"
+                    next_pc = f"{target} if {taken} else {following}"
+                e.count += 1
+                e.cycles += op_cycles[op]
+                jump = address
+                address += 1
+                break
+            elif k != _NP:
+                e.alu(k, x)
+            e.count += 1
+            e.cycles += op_cycles[op]
+            address += 1
+            next_pc = address & mask
+        if e.count == 0:
+            return None
+        source = e.finish(next_pc)
+        namespace: dict = {}
+        exec(compile(source, f"<block 0x{pc:03X}>", "exec"), namespace)
+        block = Block(pc, address, e.count, e.cycles, jump, namespace["block"], source)
+        self.blocks[pc] = block
+        self.translations += 1
+        target = e.target()
+        if jump >= 0 and isinstance(target, int):
+            self.add_leader(target)
+        return block
+
+    def _execute(self, end:int, targets:Iterable[int], stops:bool) -> Optional[str]:
+        if not stops:
+            return super()._execute(end, targets, stops)
+        mask = self.rom_size - 1
+        stop = {address & mask for address in targets} | {address & mask for address in self.hooks}
+        for address in stop:
+            self.add_leader(address)
+        blocks = self.blocks
+        regs, mem = self.regs, self.mem
+        n0 = self.instructions
+        while self.instructions < end:
+            pc = self.pc
+            if pc in stop and self.instructions != n0:
+                if pc in targets:
+                    return "until"
+                if any([hook(self) for hook in self.hooks.get(pc, ())]):
+                    return "hook"
+                pc = self.pc
+                regs, mem = self.regs, self.mem
+            block = blocks.get(pc)
+            if block is None:
+                block = self.translate(pc)
+            n = self.instructions
+            if block is None or n + block.count > end:
+                # an invalid instruction raises, a partial block runs on the interpreter
+                reason = super()._execute(min(end, n + 1) if block is None else end, (), False)
+                if reason is not None:
+                    return reason
+                continue
+            cycles = self.cycles
+            self.pc = pc = block.fn(self, regs, mem, n, cycles)
+            self.instructions = n + block.count
+            self.cycles = cycles + block.cycles
+            if pc == block.jump:
+                self.halted = True
+                return "halt"
+        return None
+
+def _compare(a:Machine, b:Machine) -> bool:
+    return (a.state(), a.mem, a.io_log, a.halted) == (b.state(), b.mem, b.io_log, b.halted)
+
+def self_test():
+    m = simulator.load_source(["LI #9", "LI #8", "AD r1", "LI #3", "SU r2", "SC r3", "LI #7", "LI #5", "LI #0xA", "SM",
+                               "LI #5", "LI #0xA", "LM", "SA r4", "XR r5", "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"], engine=BlockMachine)
+    testfuncs.expect("halt", m.run, 1000)
+    testfuncs.expect(([0, 1, 11, 9, 7, 13], True, False, 7, 19, 18), lambda: (m.regs[:6], m.carry, m.zero, m.mem[0x5A], m.instructions, m.pc))
+    # END: splits the code, the first block resolves the whole stack at translation time
+    testfuncs.expect([(0, 18), (18, 19)], lambda blocks: sorted((b.start, b.end) for b in blocks.values()), m.blocks)
+    testfuncs.expect(True, lambda blocks: "m.a = 2; m.b = 1; m.c = 0" in blocks[0].source, m.blocks)
+    m.reset()
+    testfuncs.expect(("until", 13), lambda: (m.run(None, 13), m.instructions))
+    testfuncs.expect(("limit", 14), lambda: (m.run(1), m.instructions))
+    testfuncs.expect_raises(ValueError, BlockMachine("HC4", b"\xe1").run, 10)
+    # SC [AB] sets Z from the stored value: the first JP Z is taken, the second is not
+    m = simulator.load_source(["LI #1", "SA r1", "LI #0", "LI #2", "LI #1", "SM", "LI #SKIP:2", "LI #SKIP:1", "LI #SKIP:0", "JP Z", "LI #5", "SA r2",
+                               "SKIP:", "LI #3", "LI #2", "LI #1", "SM", "LI #END:2", "LI #END:1", "LI #END:0", "JP Z", "LI #6", "SA r3",
+                               "LI #END:2", "LI #END:1", "LI #END:0", "END:", "JP"], engine=BlockMachine)
+    testfuncs.expect(("halt", [1, 0, 6], 3), lambda: (m.run(1000), m.regs[1:4], m.mem[0x21]))
+    # loading code drops the blocks it overlaps
+    m = BlockMachine("HC4", b"\xa0\xa0\xa3\xe0")
+    testfuncs.expect("halt", m.run, 10)
+    m.load(b"\xe1\xe1\xa0\xa0\xa5\xe0")
+    m.reset()
+    testfuncs.expect(("halt", 6), lambda: (m.run(10), m.instructions))
+
+    # random programs behave exactly like on the interpreter
+    rng = random.Random(2)
+    for arch in ("HC4", "HC4E"):
+        valid = [op for op, entry in enumerate(simulator.DECODE[arch]) if entry is not None and op not in (0xE2, 0xE3, 0xE4, 0xE5, 0xE0)]
+        for _ in range(200):
+            size = 48
+            code = bytearray(rng.choice(valid) for _ in range(size))
+            for _ in range(4):
+                # jumps to valid addresses
+                i = rng.randrange(size - 4)
+                target = rng.randrange(size)
+                code[i:i + 4] = bytes([0xA0 | (target >> 8), 0xA0 | ((target >> 4) & 15), 0xA0 | (target & 15), rng.choice([0xE0, 0xE2, 0xE3, 0xE4, 0xE5])])
+            if arch == "HC4E":
+                code = bytes(0xA0 if (op & 0xF0) == 0xA0 and i % 4 == 0 else op for i, op in enumerate(code))
+            plain, fast = Machine(arch, bytes(code)), BlockMachine(arch, bytes(code))
+            for machine in (plain, fast):
+                machine.inputs = {0xF0: 3, 0xF3: 1, 14: 5}
+            limit, until = rng.randrange(1, 3000), rng.randrange(size)
+            results = []
+            for machine in (plain, fast):
+                try:
+                    results.append(machine.run(limit, until))
+                except ValueError as e:
+                    results.append(str(e))
+            if results[0] != results[1] or not _compare(plain, fast):
+                raise AssertionError(f"[FAIL] translator differs from the interpreter on {bytes(code).hex()} ({arch}, {limit}, {until}): {results}")
+    print("[OK] Random programs match the interpreter.")
+
+    root = Path(__file__).resolve().parent
+    include = [str(root.parent / "include")]
+    with open(root / "test_files" / "countlcd.asm", 'r', encoding='utf-8') as f:
+        countlcd = f.read().splitlines()
+    rates = []
+    machines = []
+    for engine in (Machine, BlockMachine):
+        m = simulator.load_source(countlcd, "HC4", include, engine=engine)
+        m.run(None, "main")
+        m.regs[4:8] = [9, 9, 9, 9]
+        # release the button, press it once more and time the 100 ms beep
+        m.add_hook("poll_release", lambda machine: machine.inputs.update({0xF0: 0}))
+        m.add_hook("poll", lambda machine: machine.inputs.update({0xF0: 1}))
+        started = time.perf_counter()
+        m.run(None, "done")
+        rates.append(m.instructions / (time.perf_counter() - started))
+        machines.append(m)
+    testfuncs.expect(True, _compare, *machines)
+    print(f"[Info] translator.py : {rates[1] / 1e6:.2f} M instructions/s, {rates[1] / rates[0]:.1f}x the interpreter")
+    print("[OK] translator.py : All tests passed.")
+
+if __name__ == "__main__":
+    self_test()